@@ -1,8 +1,19 @@
 """APIv2 client library for interacting with the OSF API"""
 
 import abc
+import collections
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+import email.utils
+import functools
+import http.client
 import iso8601
+import itertools
+import logging
 import threading
+import time
 
 import requests
 
@@ -10,6 +21,8 @@ from osfsync import settings
 from osfsync.utils import Singleton
 from osfsync.utils.authentication import get_current_user
 
+logger = logging.getLogger(__name__)
+
 
 class ClientLoadError(Exception):
     def __init__(self, *args, resource=None, status=None, errors=None):
@@ -19,19 +32,226 @@ class ClientLoadError(Exception):
         self.errors = errors
 
 
+# Per-thread accumulator that responses are counted against; see OSFClient.track
+_tracking = threading.local()
+
+
+def _track_response(resp, *args, **kwargs):
+    stats = getattr(_tracking, 'stats', None)
+    if stats is not None:
+        # Only ever set on threads that make non-streaming requests, so reading the body is free
+        stats.count(requests=1, bytes=len(resp.content))
+
+
+def _retry_after(resp):
+    """:return float: Seconds the server asked us to wait before trying again, if it did"""
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), settings.HTTP_MAX_RETRY_AFTER)
+
+
+class AdaptiveLimiter:
+    """
+    Additive increase, multiplicative decrease control of the number of requests in flight.
+
+    While responses come back healthy the window grows by one request per window's worth of responses. It
+    halves when the server pushes back: a 429 or 503, a connection error, or a response much slower than
+    the fastest seen recently. Only requests that send and receive little are timed or have their connection
+    errors counted, since the time a transfer takes says more about its size than about the server. A Retry-After stops any new request from starting until it has passed.
+    The window never halves more than once per HTTP_DECREASE_INTERVAL, so one burst of errors counts once.
+    """
+
+    def __init__(self, *, initial=None, minimum=None, maximum=None):
+        self.minimum = minimum or settings.HTTP_MIN_REQUESTS
+        self.maximum = maximum or settings.HTTP_MAX_REQUESTS
+        self.window = float(min(initial or settings.HTTP_INITIAL_REQUESTS, self.maximum))
+        self.in_flight = 0
+        # Why the window last changed, as counts of 'increase', 'decrease' and 'pause'
+        self.decisions = collections.Counter()
+        self._base_latency = None
+        self._last_decrease = 0
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.window):
+                    break
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, *, latency=None, status=None, retry_after=None, error=False):
+        """
+        Adjust the window to the outcome of a request
+
+        :param float latency: Seconds until the response headers arrived
+        :param int status: Response status code
+        :param float retry_after: Seconds the server asked to wait
+        :param bool error: Whether the request failed without a response
+        """
+        now = time.monotonic()
+        with self._condition:
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self.decisions['pause'] += 1
+            slow = (
+                latency is not None and self._base_latency is not None
+                and latency > self._base_latency * settings.HTTP_LATENCY_FACTOR
+            )
+            if error or slow or status in (http.client.TOO_MANY_REQUESTS, http.client.SERVICE_UNAVAILABLE):
+                if now - self._last_decrease >= settings.HTTP_DECREASE_INTERVAL:
+                    self._last_decrease = now
+                    self.window = max(self.minimum, self.window / 2)
+                    self.decisions['decrease'] += 1
+                    logger.info('Server pushed back (status={}, latency={}, error={}); {!r}'.format(
+                        status, latency, error, self
+                    ))
+            elif self.window < self.maximum:
+                before = int(self.window)
+                self.window = min(self.maximum, self.window + 1 / self.window)
+                if int(self.window) > before:
+                    self.decisions['increase'] += 1
+            if latency is not None and not slow:
+                # The fastest response seen, drifting slowly upwards so one lucky response does not count forever
+                if self._base_latency is None or latency < self._base_latency:
+                    self._base_latency = latency
+                else:
+                    self._base_latency += (latency - self._base_latency) * 0.01
+            self._condition.notify_all()
+
+    def __repr__(self):
+        return '<{}(window={:.1f}, in_flight={}, base_latency={}, decisions={})>'.format(
+            self.__class__.__name__, self.window, self.in_flight,
+            None if self._base_latency is None else round(self._base_latency, 3), dict(self.decisions)
+        )
+
+
+class ThrottledSession(requests.Session):
+    """
+    A requests Session whose requests in flight, across every thread using it, are bounded by an
+    AdaptiveLimiter. Requests turned away with 429, or 503 and a Retry-After, are retried once the wait is
+    over, up to HTTP_THROTTLE_RETRIES times, unless their body is a stream that can not be sent again.
+
+    A slot is held from the moment a request is sent until its response has been read. Streamed responses
+    keep their slot until they are closed, so they must always be closed.
+    """
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    @staticmethod
+    def _is_transfer(method, kwargs):
+        """Whether a request sends a body or streams its response, so its timing depends on how much it moves"""
+        if kwargs.get('stream') or method.upper() not in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        return any(kwargs.get(name) is not None for name in ('data', 'files', 'json'))
+
+    def request(self, method, url, *args, **kwargs):
+        replayable = not hasattr(kwargs.get('data'), 'read')
+        transfer = self._is_transfer(method, kwargs)
+        attempt = 0
+        while True:
+            resp = self._send(method, url, *args, transfer=transfer, **kwargs)
+            retry_after = _retry_after(resp)
+            throttled = resp.status_code == http.client.TOO_MANY_REQUESTS or (
+                resp.status_code == http.client.SERVICE_UNAVAILABLE and retry_after is not None
+            )
+            self.limiter.record(
+                latency=None if transfer else resp.elapsed.total_seconds(),
+                status=resp.status_code,
+                retry_after=retry_after
+            )
+            if not (throttled and replayable and attempt < settings.HTTP_THROTTLE_RETRIES):
+                return resp
+            attempt += 1
+            resp.close()
+            if retry_after is None:
+                # Nothing to go by; the limiter has already shrunk the window
+                time.sleep(min(2 ** attempt, settings.HTTP_MAX_RETRY_AFTER))
+
+    def _send(self, *args, transfer=False, **kwargs):
+        self.limiter.acquire()
+        try:
+            resp = super().request(*args, **kwargs)
+        except requests.exceptions.ConnectionError:
+            self.limiter.release()
+            if not transfer:
+                self.limiter.record(error=True)
+            raise
+        except BaseException:
+            self.limiter.release()
+            raise
+        if not kwargs.get('stream'):
+            self.limiter.release()
+            return resp
+
+        close, released = resp.close, []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.limiter.release()
+        resp.close = close_and_release
+        return resp
+
+
 class OSFClient(metaclass=Singleton):
-    def __init__(self, *, limit=5):
+    def __init__(self, *, limit=None):
+        """:param int limit: Most requests ever allowed in flight; settings.HTTP_MAX_REQUESTS by default"""
         self.user = get_current_user()
         self.headers = {
             'User-Agent': 'OSF Sync',
             'Authorization': 'Bearer {}'.format(self.user.oauth_token),
         }
-        self.throttler = threading.Semaphore(limit)  # TODO: Is throttling active?
-        self.request_session = requests.Session()
+        # Shared by every request, including those made by BaseResource.load and fetch_related, so crawling
+        # and transfers together adapt to what the server can take
+        self.limiter = AdaptiveLimiter(maximum=limit)
+        self.request_session = ThrottledSession(self.limiter)
+        # One pool per host (API, files, WaterButler), each able to keep a connection alive for every request
+        # the limiter lets through, so connections are reused rather than opened and dropped
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=settings.HTTP_POOL_HOSTS,
+            pool_maxsize=settings.HTTP_MAX_REQUESTS,
+        )
+        self.request_session.mount('https://', adapter)
+        self.request_session.mount('http://', adapter)
         self.request_session.headers.update(self.headers)
+        self.request_session.hooks['response'].append(_track_response)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def track(stats):
+        """
+        Count every response received by the calling thread against stats, via stats.count(requests=, bytes=).
+        Must not be used on threads that make streaming requests.
+        """
+        _tracking.stats = stats
+        try:
+            yield stats
+        finally:
+            _tracking.stats = None
 
     def get_node(self, id):
-        return Node.load(self.request_session, id)
+        return RemoteCache().get(('nodes', id), lambda: Node.load(self.request_session, id))
 
     def get_user(self, *, id='me'):
         return User.load(self.request_session, id=id)
@@ -40,21 +260,282 @@ class OSFClient(metaclass=Singleton):
         return self.request_session.request(*args, **kwargs)
 
     def stop(self):
+        ListingCache().clear()
+        RemoteCache().clear()
         del type(self.__class__)._instances[self.__class__]
 
 
+class ListingCache(metaclass=Singleton):
+    """
+    Remembers listings fetched from the API so later crawls can avoid downloading them again.
+
+    Pages are stored with the ETag / Last-Modified validators the server sent, and re-requested
+    conditionally. The children built from a folder's listing are reused when every page of the next
+    listing of that folder comes back 304 Not Modified. Both are bounded by LISTING_CACHE_SIZE, least
+    recently used first out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = collections.OrderedDict()
+        self._children = collections.OrderedDict()
+
+    @staticmethod
+    def _key(url, params):
+        return (url, tuple(sorted((params or {}).items())))
+
+    @staticmethod
+    def _put(entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > settings.LISTING_CACHE_SIZE:
+            entries.popitem(last=False)
+
+    def validators(self, url, params):
+        """:return dict: Conditional request headers for a page, if it has been seen before"""
+        with self._lock:
+            etag, last_modified, _ = self._pages.get(self._key(url, params), (None, None, None))
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def page(self, url, params):
+        """:return dict: The page stored for a request, or None if it has been evicted since"""
+        key = self._key(url, params)
+        with self._lock:
+            if key not in self._pages:
+                return None
+            self._pages.move_to_end(key)
+            return self._pages[key][2]
+
+    def store_page(self, url, params, resp, data):
+        etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+        with self._lock:
+            if etag or last_modified:
+                self._put(self._pages, self._key(url, params), (etag, last_modified, data))
+            else:
+                self._pages.pop(self._key(url, params), None)
+
+    def children(self, folder_id):
+        """:return list: The children built from the folder's last listing, if they are still around"""
+        with self._lock:
+            if folder_id not in self._children:
+                return None
+            self._children.move_to_end(folder_id)
+            return self._children[folder_id]
+
+    def store_children(self, folder_id, children):
+        with self._lock:
+            self._put(self._children, folder_id, children)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._children.clear()
+
+
+class _SingleFlight:
+    """Collapses concurrent calls made for the same key into one, whose result every caller shares"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class RemoteCache(metaclass=Singleton):
+    """
+    Remote objects by id, kept for settings.REMOTE_CACHE_TTL seconds.
+
+    The crawler fills it with everything it lists during an audit, so the operations that follow find the
+    objects they act on without loading each of them again. Concurrent loads of the same missing object are
+    made once. Keys are ('files', id), ('nodes', id) and ('storage', node id, provider).
+
+    Objects are kept in the order they were put, so expired ones are dropped from the front as new ones come
+    in. At most settings.REMOTE_CACHE_SIZE are kept, oldest first out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = collections.OrderedDict()
+        self._flights = _SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        :param tuple key:
+        :param load: Called without arguments to fetch the object when it is not cached, or has expired
+        """
+        with self._lock:
+            now = time.monotonic()
+            expires, value = self._objects.get(key, (0, None))
+            if expires > now:
+                self.hits += 1
+                return value
+            self.misses += 1
+            self._objects.pop(key, None)
+            self._expire(now)
+        return self._flights.do(key, lambda: self._load(key, load))
+
+    def _load(self, key, load):
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._objects[key] = (now + settings.REMOTE_CACHE_TTL, value)
+            self._objects.move_to_end(key)
+            self._expire(now)
+            while len(self._objects) > settings.REMOTE_CACHE_SIZE:
+                self._objects.popitem(last=False)
+
+    def _expire(self, now):
+        # Everything is put with the same time to live, so the objects that expired are at the front
+        while self._objects:
+            expires, _ = next(iter(self._objects.values()))
+            if expires > now:
+                break
+            self._objects.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+    def __repr__(self):
+        return '<RemoteCache hits={} misses={} shared={}>'.format(self.hits, self.misses, self._flights.shared)
+
+
+def _page_count(data):
+    """:return int: Number of pages in the listing data is the first page of, if the server says"""
+    # Newer API versions report the counts in the top level meta, older ones under links
+    meta = data.get('meta') or data.get('links', {}).get('meta') or {}
+    total, per_page = meta.get('total'), meta.get('per_page')
+    if not isinstance(total, int) or not per_page:
+        return None
+    return -(-total // per_page)
+
+
+def _paginate(first, fetch_page, url, params):
+    """
+    Iterate over the items of a paginated listing, in order.
+
+    When the first page reports how many items there are, the rest of the pages are requested by number, a few
+    at a time, and held until their turn comes. Otherwise links.next is followed one page at a time.
+
+    :param dict first: The first page, already fetched
+    :param fetch_page: Called with (url, params) to fetch any other page
+    """
+    for item in first['data']:
+        yield item
+
+    pages = _page_count(first)
+    if pages is None:
+        data = first
+        while data['links'].get('next'):
+            data = fetch_page(data['links']['next'], params)
+            for item in data['data']:
+                yield item
+        return
+
+    # Responses fetched on behalf of this thread are still counted against its OSFClient.track
+    stats = getattr(_tracking, 'stats', None)
+
+    def fetch(number):
+        _tracking.stats = stats
+        try:
+            return fetch_page(url, dict(params, page=number))
+        finally:
+            _tracking.stats = None
+
+    numbers = iter(range(2, pages + 1))
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=settings.PAGE_PREFETCH_WORKERS) as executor:
+        try:
+            # Never more than a couple of pages per worker waiting to be consumed
+            for number in itertools.islice(numbers, settings.PAGE_PREFETCH_WORKERS * 2):
+                pending.append(executor.submit(fetch, number))
+            while pending:
+                data = pending.popleft().result()
+                for number in itertools.islice(numbers, 1):
+                    pending.append(executor.submit(fetch, number))
+                for item in data['data']:
+                    yield item
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 class BaseResource(abc.ABC):
+    """
+    An object of the API. Its attributes are read from the JSON it was built from as they are accessed, so a
+    crawl creating many of them only pays for the fields that end up being used.
+    """
+    __slots__ = ('request_session', 'id', 'type', 'raw', '_dates')
+
     OSF_HOST = settings.API_BASE
     API_PREFIX = settings.API_VERSION
     BASE_URL = '{}/{}'.format(OSF_HOST, API_PREFIX)
+    # Attributes parsed into datetimes the first time they are read
+    DATES = ()
+
+    # Identical GETs in flight at the same time are only sent once
+    _flights = _SingleFlight()
 
     def __init__(self, request_session, data):
         self.request_session = request_session
         self.id = data['id']
         self.type = data['type']
         self.raw = data
-        for attribute, value in data['attributes'].items():
-            setattr(self, attribute, value)
+        self._dates = None
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots, i.e. the attributes of the object in the API
+        if name.startswith('_') or name in BaseResource.__slots__:
+            raise AttributeError(name)
+        try:
+            value = self.raw['attributes'][name]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+        if name not in self.DATES or not value:
+            return value
+        if self._dates is None:
+            self._dates = {}
+        if name not in self._dates:
+            self._dates[name] = iso8601.parse_date(value)
+        return self._dates[name]
 
     @classmethod
     def get_url(cls, *args, **kwargs):
@@ -65,10 +546,15 @@ class BaseResource(abc.ABC):
         return cls(request_session, data)
 
     @classmethod
-    def load(cls, request_session, *args, **kwargs):
+    def _load_page(cls, request_session, url, params):
+        key = (request_session, url, tuple(sorted(params.items())))
+        return BaseResource._flights.do(key, lambda: cls._request_page(request_session, url, params))
+
+    @classmethod
+    def _request_page(cls, request_session, url, params):
         resp = request_session.get(
-            cls.get_url(*args, **kwargs),
-            params={'page[size]': 250},
+            url,
+            params=params,
             timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
         )
         if resp.status_code >= 500:
@@ -85,54 +571,65 @@ class BaseResource(abc.ABC):
                 status=resp.status_code,
                 errors=data['errors']
             )
+        return data
+
+    @classmethod
+    def load(cls, request_session, *args, **kwargs):
+        url, params = cls.get_url(*args, **kwargs), {'page[size]': 250}
+        data = cls._load_page(request_session, url, params)
 
         if isinstance(data['data'], list):
-            l = data['data']
-            while data['links'].get('next'):
-                resp = request_session.get(
-                    data['links']['next'],
-                    params={'page[size]': 250},
-                    timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
-                )
-                data = resp.json()
-                l.extend(data['data'])
-            return [cls.from_data(request_session, item) for item in l]
+            fetch_page = functools.partial(cls._load_page, request_session)
+            return [cls.from_data(request_session, item) for item in _paginate(data, fetch_page, url, params)]
         return cls.from_data(request_session, data['data'])
 
-    def _fetch_related(self, relationship, data):
-        items = data['data']
-        for item in items:
-            yield item
-        if data['links'].get('next'):
-            for item in self.fetch_related(
-                    relationship,
-                    next_url=data['links']['next']
-            ):
-                yield item
+    def _get_page(self, url, params, *, unchanged=None):
+        key = (self.request_session, url, tuple(sorted(params.items())))
+        data, not_modified = BaseResource._flights.do(key, lambda: self._request_related_page(url, params))
+        if unchanged is not None:
+            unchanged.append(not_modified)
+        return data
 
-    def fetch_related(self, relationship, *, query=None, next_url=None):
-        relation = self.raw['relationships'].get(relationship)
-        if not relation:
-            return None
-
-        url = next_url or self.raw['relationships'][relationship]['links']['related']['href']
-        params = {'page[size]': 250}
-        params.update(query or {})
+    def _request_related_page(self, url, params):
+        """:return: (page, whether the server reported it unchanged since it was stored)"""
         resp = self.request_session.get(
             url,
             params=params,
+            headers=ListingCache().validators(url, params),
             timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
         )
+        if resp.status_code == http.client.NOT_MODIFIED:
+            data = ListingCache().page(url, params)
+            if data is not None:
+                return data, True
+            # Evicted since the request was made; ask for it again in full
+            resp = self.request_session.get(url, params=params, timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT))
         data = resp.json()
-        items = data['data']
-        if not isinstance(items, list):
-            return items
-        else:
-            return self._fetch_related(relationship, data)
+        ListingCache().store_page(url, params, resp, data)
+        return data, False
+
+    def fetch_related(self, relationship, *, query=None, unchanged=None):
+        """
+        :param list unchanged: Gets, for every page requested, whether the server reported it unchanged
+        :return: The related item, or an iterator over every related item when the relationship is a list
+        """
+        relation = self.raw['relationships'].get(relationship)
+        if not relation:
+            return None
+
+        url = relation['links']['related']['href']
+        params = {'page[size]': 250}
+        params.update(query or {})
+        fetch_page = functools.partial(self._get_page, unchanged=unchanged)
+        data = fetch_page(url, params)
+        if not isinstance(data['data'], list):
+            return data['data']
+        return _paginate(data, fetch_page, url, params)
 
 
 class User(BaseResource):
     """Fetch API data relevant to a specific user"""
+    __slots__ = ()
     RESOURCE = 'users'
 
     @classmethod
@@ -145,13 +642,12 @@ class User(BaseResource):
 
 class Node(BaseResource):
     """Fetch API data relevant to a specific Node"""
+    __slots__ = ('parent',)
     RESOURCE = 'nodes'
+    DATES = ('date_created', 'date_modified')
 
     def __init__(self, request_session, data):
         super().__init__(request_session, data)
-        self.date_created = iso8601.parse_date(self.date_created)
-        self.date_modified = iso8601.parse_date(self.date_modified)
-
         if 'embeds' in data and data['embeds']['parent'].get('data'):
             self.parent = Node(request_session, data['embeds']['parent']['data'])
         else:
@@ -182,6 +678,7 @@ class Node(BaseResource):
 
 class UserNode(Node):
     """Fetch API data about nodes owned by a specific user"""
+    __slots__ = ()
 
     @classmethod
     def get_url(cls, id):
@@ -190,14 +687,33 @@ class UserNode(Node):
 
 class StorageObject(BaseResource):
     """Represent API data for files or folders under a specific node"""
+    __slots__ = ('parent',)
+    RESOURCE = 'files'
+    DATES = ('date_modified', 'last_touched')
+    # All a compact object keeps of its attributes, besides the sha256 and md5 hashes: what the auditor
+    # compares, and what the operations that follow it need to act on the object
+    COMPACT_ATTRIBUTES = ('name', 'kind', 'provider', 'path', 'size', 'date_modified')
 
     def __init__(self, request_session, data, *, parent=None):
         super().__init__(request_session, data)
         self.parent = parent
-        if hasattr(self, 'date_modified') and self.date_modified:
-            self.date_modified = iso8601.parse_date(self.date_modified)
-        if hasattr(self, 'last_touched') and self.last_touched:
-            self.last_touched = iso8601.parse_date(self.last_touched)
+
+    @classmethod
+    def compact(cls, data):
+        """:return dict: The parts of an object's JSON that compact objects are built from"""
+        attributes = data['attributes']
+        hashes = (attributes.get('extra') or {}).get('hashes') or {}
+        compact = {name: attributes[name] for name in cls.COMPACT_ATTRIBUTES if name in attributes}
+        compact['extra'] = {'hashes': {name: hashes[name] for name in ('sha256', 'md5') if name in hashes}}
+        # Folders are listed through their files relationship
+        files = data.get('relationships', {}).get('files')
+        return {
+            'id': data['id'],
+            'type': data['type'],
+            'attributes': compact,
+            'links': data.get('links', {}),
+            'relationships': {'files': files} if files else {},
+        }
 
     @classmethod
     def get_url(cls, id):
@@ -205,19 +721,7 @@ class StorageObject(BaseResource):
 
     @classmethod
     def load(cls, request_session, *args):
-        resp = request_session.get(
-            cls.get_url(*args),
-            params={'page[size]': 250},
-            timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
-        )
-        data = resp.json()
-
-        if 'errors' in data:
-            raise ClientLoadError(
-                resource=cls.RESOURCE,
-                status=resp.status_code,
-                errors=data['errors']
-            )
+        data = cls._load_page(request_session, cls.get_url(*args), {'page[size]': 250})
 
         if isinstance(data['data'], list):
             return [
@@ -229,24 +733,40 @@ class StorageObject(BaseResource):
 
 class Folder(StorageObject):
     """Represent API data for folders under a specific node"""
+    __slots__ = ()
     is_dir = True
 
     def __repr__(self):
         return '<{0} {1} name={2} path={2}>'.format(self.__class__.__name__, id(self), self.name, self.path)
 
-    def get_children(self, *, lazy=False):
-        related = map(
-            lambda item: (Folder if item['attributes']['kind'] == 'folder' else File)(self.request_session, item, parent=self),
-            self.fetch_related('files')
-        )
+    def get_children(self, *, lazy=False, reuse=False, compact=False):
+        """
+        :param bool reuse: Return the children built from the last listing of this folder if the server
+        reports every page of this listing unchanged since then. Ignored when lazy.
+        :param bool compact: Keep only what StorageObject.compact does of each child's JSON
+        """
+        unchanged = []
+        items = self.fetch_related('files', unchanged=unchanged)
         if lazy:
-            return related
-        else:
-            return list(related)
+            return (self._child(item, compact) for item in items)
+
+        items = list(items)
+        if reuse and all(unchanged):
+            children = ListingCache().children(self.id)
+            if children is not None:
+                return children
+        children = [self._child(item, compact) for item in items]
+        ListingCache().store_children(self.id, children)
+        return children
+
+    def _child(self, item, compact):
+        cls = Folder if item['attributes']['kind'] == 'folder' else File
+        return cls(self.request_session, self.compact(item) if compact else item, parent=self)
 
 
 class NodeStorage(Folder):
     """Fetch API list of storage options under a node"""
+    __slots__ = ()
 
     @classmethod
     def get_url(cls, node_id):
@@ -259,6 +779,7 @@ class NodeStorage(Folder):
 
 class File(StorageObject):
     """Represent API data for files under a specific node"""
+    __slots__ = ()
     is_dir = False
 
     def __repr__(self):
@@ -1,27 +1,178 @@
 import logging
 import contextlib
 import threading
+import time
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from osfsync import settings
 from osfsync.database.models import Base, User, Node, File
+from osfsync.database.models import update_materialized_paths
 from osfsync.settings import PROJECT_DB_FILE
 
 CORE_OSFO_MODELS = [User, Node, File]
 URL = 'sqlite:///{}'.format(PROJECT_DB_FILE)
+logger = logging.getLogger(__name__)
+
+
+def upgrade_schema(engine):
+    """Add columns and indexes introduced after a database was first created. create_all only creates missing tables."""
+    with contextlib.closing(engine.connect()) as con:
+        for table in (Node.__table__, File.__table__):
+            columns = {row[1] for row in con.execute('PRAGMA table_info({})'.format(table.name))}
+            if 'rel_path' not in columns:
+                logger.info('Adding materialized path column to table {}'.format(table.name))
+                con.execute('ALTER TABLE {} ADD COLUMN rel_path VARCHAR'.format(table.name))
+            con.execute('CREATE INDEX IF NOT EXISTS ix_{0}_rel_path ON {0} (rel_path)'.format(table.name))
+        con.execute('CREATE INDEX IF NOT EXISTS ix_file_node_id_parent_id_name ON file (node_id, parent_id, name)')
+        con.execute('CREATE INDEX IF NOT EXISTS ix_file_sha256 ON file (sha256)')
+        con.execute('CREATE INDEX IF NOT EXISTS ix_file_size ON file (size)')
+
+
+def backfill_paths(session):
+    """Materialize the paths of any rows written before the rel_path columns existed"""
+    for model in (Node, File):
+        for row in session.query(model).filter(model._rel_path.is_(None)).all():
+            row._rel_path = row.rel_path
+    session.commit()
+
+
+def _configure_connection(dbapi_connection, connection_record):
+    # WAL lets any number of readers proceed while a single writer commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # Durable at each checkpoint rather than at every commit; the database can not be corrupted either way
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-{}'.format(settings.DB_CACHE_SIZE_KB))
+    cursor.close()
 
-engine = create_engine(URL, connect_args={'check_same_thread': False}, )
+
+# Connections are pooled and handed from thread to thread, never shared by two threads at once
+engine = create_engine(
+    URL,
+    connect_args={'check_same_thread': False, 'timeout': settings.DB_BUSY_TIMEOUT},
+    poolclass=QueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_POOL_SIZE,
+)
+event.listen(engine, 'connect', _configure_connection)
 Base.metadata.create_all(engine)
-_session = sessionmaker(bind=engine)()
-_session_rlock = threading.RLock()
-logger = logging.getLogger(__name__)
+upgrade_schema(engine)
+_session_factory = sessionmaker(bind=engine)
+event.listen(_session_factory, 'before_flush', update_materialized_paths)
+# Every thread gets a session of its own
+_session = scoped_session(_session_factory)
+backfill_paths(_session())
 
 
 @contextlib.contextmanager
 def Session():
-    with _session_rlock:
-        yield _session
+    yield _session()
+
+
+def reset_session():
+    """
+    Begin a new unit of work on the calling thread.
+
+    Anything left uncommitted by a failed unit of work is rolled back, and every loaded row is expired
+    so that changes committed by other threads are picked up.
+    """
+    session = _session()
+    session.rollback()
+    session.expire_all()
+
+
+_batches = threading.local()
+
+
+class WriteBatch:
+    """
+    Group the commits made on one thread into transactions of up to `size` changes that stay open at most
+    `latency` seconds. While a batch is active on a thread, commit() adds to it instead of committing.
+
+    Only commit() and close() are durability points: a crash loses the changes made since the last one,
+    which the next audit finds and redoes.
+    """
+
+    def __init__(self, *, size=None, latency=None):
+        self.size = size or settings.DB_BATCH_SIZE
+        self.latency = settings.DB_BATCH_LATENCY if latency is None else latency
+        self.pending = 0
+        self._opened = None
+
+    def __enter__(self):
+        _batches.current = self
+        return self
+
+    def __exit__(self, *exc):
+        _batches.current = None
+        self.commit()
+
+    def add(self, session):
+        # Flush so the rest of the batch, and this thread's queries, see the change
+        session.flush()
+        if not self.pending:
+            self._opened = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.size or self.expired:
+            self.commit()
+
+    @property
+    def expired(self):
+        return self.pending > 0 and time.monotonic() - self._opened >= self.latency
+
+    def commit(self):
+        if not self.pending:
+            return
+        logger.debug('Committing a batch of {} changes'.format(self.pending))
+        try:
+            _session().commit()
+        except Exception:
+            _session().rollback()
+            raise
+        finally:
+            self.pending = 0
+
+    def discard(self):
+        """Roll back the changes batched so far, leaving the session usable again after a failed flush"""
+        self.pending = 0
+        _session().rollback()
+
+
+def commit(session):
+    """Commit session now, or as part of the calling thread's WriteBatch if one is active"""
+    batch = getattr(_batches, 'current', None)
+    if batch is None:
+        session.commit()
+    else:
+        batch.add(session)
+
+
+def close_session():
+    """Discard the calling thread's session. Short-lived threads must call this before they exit."""
+    _session.remove()
+
+
+def rebind(obj):
+    """
+    ORM objects belong to the session of the thread that loaded them. Return the copy of obj that belongs
+    to the calling thread's session, or None if its row no longer exists.
+
+    :param obj: A mapped object, possibly loaded by another thread
+    """
+    if obj is None:
+        return None
+    state = inspect(obj)
+    session = _session()
+    if state.session is session or state.key is None:
+        return obj
+    return session.query(type(obj)).get(state.identity)
 
 
 def drop_db():
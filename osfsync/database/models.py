@@ -1,11 +1,15 @@
 import os
 import datetime
+import itertools
 
 from sqlalchemy import Column, Integer, Boolean, String, DateTime
-from sqlalchemy import ForeignKey, Enum
+from sqlalchemy import ForeignKey, Enum, Index
+from sqlalchemy import func
+from sqlalchemy import inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, backref, validates
+from sqlalchemy.orm.attributes import set_committed_value
 
 from osfsync import settings
 
@@ -54,6 +58,9 @@ class Node(Base):
     # - syncing a child Node but not its parent
     parent_id = Column(Integer, ForeignKey('node.id'), nullable=True)
 
+    # Materialized copy of rel_path, kept up to date by update_materialized_paths
+    _rel_path = Column('rel_path', String, index=True)
+
     children = relationship('Node', backref=backref('parent', remote_side=[id]), cascade='all')
     files = relationship('File', backref=backref('node'), cascade='all, delete-orphan')
 
@@ -65,18 +72,27 @@ class Node(Base):
     def path(self):
         return os.path.join(self.user.folder, self.rel_path)
 
-    @property
+    @hybrid_property
     def rel_path(self):
         """
         Path on the local filesystem.
 
-        Recursively walk up the path of the node. Top level node joins with the osf folder path of the user
+        Read from the materialized column once flushed. Top level node joins with the osf folder path of the user
         """
+        if self._rel_path is not None:
+            return self._rel_path
+        return self._compute_rel_path(self.parent)
+
+    @rel_path.expression
+    def rel_path(cls):
+        return cls._rel_path
+
+    def _compute_rel_path(self, parent):
         # +os.path.sep+ instead of os.path.join: http://stackoverflow.com/a/14504695
         name = '{} - {}'.format(self.title, self.id)
-        if self.parent:
+        if parent:
             return os.path.join(
-                self.parent.rel_path,
+                parent.rel_path,
                 settings.COMPONENTS_FOLDER,
                 name
             )
@@ -127,9 +143,11 @@ class File(Base):
     name = Column(String)
 
     md5 = Column(String)
-    sha256 = Column(String)
+    # Indexed so content that is already on disk can be found by hash; see transfers.reuse
+    sha256 = Column(String, index=True)
 
-    size = Column(Integer)
+    # Indexed so a new file can be matched to tracked files before it is hashed; see RemoteCreateFile
+    size = Column(Integer, index=True)
 
     kind = Column(Enum(FOLDER, FILE), nullable=False)
     date_modified = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
@@ -139,6 +157,14 @@ class File(Base):
     node_id = Column(Integer, ForeignKey('node.id'), nullable=False)
     parent_id = Column(Integer, ForeignKey('file.id'))
 
+    # Materialized copy of rel_path, kept up to date by update_materialized_paths
+    _rel_path = Column('rel_path', String, index=True)
+
+    __table_args__ = (
+        # Resolving a local path walks (parent_id, name) one component at a time
+        Index('ix_file_node_id_parent_id_name', 'node_id', 'parent_id', 'name'),
+    )
+
     # remote_side=[id] makes it so that when someone calls myFile.parent, we can determine what variable to
     # match myFile.parent_id with. We go through all File's that are not myFile and then match them on their id field
     # to determine which has the same id as myFile.parent_id.
@@ -177,26 +203,37 @@ class File(Base):
 
     @property
     def path(self):
-        return self.rel_path.replace(self.node.rel_path, self.node.path)
+        return os.path.join(self.user.folder, self.rel_path)
 
-    @property
+    @hybrid_property
     def rel_path(self):
         """
         Local filesystem path to the file or folder.
 
-        Recursively walk up the path of the file/folder. Top level joins with the path of the containing node.
+        Read from the materialized column once flushed. Top level joins with the path of the containing node.
         """
+        if self._rel_path is not None:
+            return self._rel_path
+        return self._compute_rel_path(self.parent, self.node)
+
+    @rel_path.expression
+    def rel_path(cls):
+        return cls._rel_path
+
+    def _compute_rel_path(self, parent, node):
         # +os.path.sep+ instead of os.path.join: http://stackoverflow.com/a/14504695
-        if self.parent:
-            return os.path.join(self.parent.rel_path, self.name) + (os.path.sep if self.is_folder else '')
+        if parent:
+            return os.path.join(parent.rel_path, self.name) + (os.path.sep if self.is_folder else '')
         else:
-            return os.path.join(self.node.rel_path, settings.OSF_STORAGE_FOLDER) + (os.path.sep if self.is_folder else '')
+            return os.path.join(node.rel_path, settings.OSF_STORAGE_FOLDER) + (os.path.sep if self.is_folder else '')
 
     @property
     def pretty_path(self):
-        if not self.parent:
+        """Path relative to the storage folder of the containing node"""
+        if not (self.parent_id or self.parent):
             return ''
-        return os.path.join(self.parent.pretty_path, self.name) + (os.path.sep if self.is_folder else '')
+        storage = os.path.join(self.node.rel_path, settings.OSF_STORAGE_FOLDER, '')
+        return self.rel_path[len(storage):]
 
     def locally_create_children(self):
         self.locally_created = True
@@ -224,3 +261,110 @@ class File(Base):
 
     def __repr__(self):
         return '<DBFile({}, {}, {}, {}>'.format(self.id, self.name, self.kind, self.parent_id)
+
+
+class JournalEntry(Base):
+    """An operation that has been queued but not yet carried out"""
+    __tablename__ = 'operation_journal'
+
+    # Entries are replayed in the order they were queued
+    id = Column(Integer, primary_key=True)
+    # Identifies the operation by what it does, so queuing it twice is harmless
+    key = Column(String, unique=True, nullable=False)
+    # JSON description of the operation and its contexts
+    operation = Column(String, nullable=False)
+    date_created = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return '<JournalEntry({}, {})>'.format(self.id, self.key)
+
+
+class DirtyFolder(Base):
+    """A local folder whose contents have changed since they were last audited"""
+    __tablename__ = 'dirty_folder'
+
+    path = Column(String, primary_key=True)
+
+    def __repr__(self):
+        return '<DirtyFolder({})>'.format(self.path)
+
+
+def _parent(session, obj, name, cls):
+    """The parent obj will have once flushed, whether it was assigned via the relationship or the foreign key"""
+    if inspect(obj).attrs[name + '_id'].history.has_changes():
+        parent_id = getattr(obj, name + '_id')
+        if parent_id is None:
+            return None
+        # The parent may be part of the same flush, in which case it is not in the database yet
+        for pending in session.new:
+            if isinstance(pending, cls) and pending.id == parent_id:
+                return pending
+        return session.query(cls).get(parent_id)
+    return getattr(obj, name)
+
+
+def _rewrite_prefix(session, cls, old, new, skip):
+    """Point every row of cls whose rel_path starts with old at new instead"""
+    table = cls.__table__
+    session.execute(
+        table.update()
+        .where(func.substr(table.c.rel_path, 1, len(old)) == old)
+        .values(rel_path=new + func.substr(table.c.rel_path, len(old) + 1))
+    )
+    # Keep already loaded objects in line with the rows that were just rewritten. Expired ones reload anyway.
+    for obj in list(session.identity_map.values()):
+        if not isinstance(obj, cls) or obj in skip:
+            continue
+        loaded = inspect(obj).dict.get('_rel_path')
+        if loaded and loaded.startswith(old):
+            set_committed_value(obj, '_rel_path', new + loaded[len(old):])
+
+
+def update_materialized_paths(session, flush_context, instances):
+    """
+    before_flush hook that keeps Node.rel_path and File.rel_path materialized.
+
+    The paths of new and modified objects are recomputed; if one moved, the rows below it are rewritten
+    with a single prefix update in the same transaction as the flush itself.
+    """
+    computed = {}
+
+    def compute(obj):
+        if obj in computed:
+            return computed[obj]
+        if isinstance(obj, Node):
+            parent = _parent(session, obj, 'parent', Node)
+            if parent is not None and (parent in session.new or parent in session.dirty):
+                compute(parent)
+            rel_path = obj._compute_rel_path(parent)
+        else:
+            parent = _parent(session, obj, 'parent', File)
+            node = _parent(session, obj, 'node', Node)
+            for ancestor in (parent, node):
+                if ancestor is not None and (ancestor in session.new or ancestor in session.dirty):
+                    compute(ancestor)
+            rel_path = obj._compute_rel_path(parent, node)
+        computed[obj] = rel_path
+        obj._rel_path = rel_path
+        return rel_path
+
+    with session.no_autoflush:
+        changed = [
+            obj for obj in itertools.chain(session.new, session.dirty)
+            if isinstance(obj, (Node, File)) and obj not in session.deleted
+        ]
+        # Read every stored path before any are recomputed; computing a child also computes its ancestors
+        previous = {obj: None if obj in session.new else obj._rel_path for obj in changed}
+        moves = []
+        for obj in changed:
+            new = compute(obj)
+            if previous[obj] is not None and previous[obj] != new:
+                moves.append((obj, previous[obj], new))
+
+        for obj, old, new in moves:
+            if isinstance(obj, Node):
+                old, new = os.path.join(old, ''), os.path.join(new, '')
+                _rewrite_prefix(session, Node, old, new, computed)
+                _rewrite_prefix(session, File, old, new, computed)
+            elif obj.is_folder:
+                _rewrite_prefix(session, File, old, new, computed)
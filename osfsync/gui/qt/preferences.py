@@ -18,6 +18,7 @@ import osfsync
 from osfsync import language
 from osfsync.application.background import BackgroundHandler
 from osfsync.client.osf import OSFClient
+from osfsync.database import reset_session
 from osfsync.database import Session
 from osfsync.database.models import User, Node
 from osfsync.gui.qt.generated.preferences import Ui_Settings
@@ -205,6 +206,8 @@ class Preferences(QDialog, Ui_Settings):
             tree_item.setCheckState(self.PROJECT_SYNC_COLUMN, Qt.Unchecked)
 
     def open_window(self, *, tab=GENERAL):
+        # The sync threads may have changed the database since this window last read from it
+        reset_session()
         if self.isVisible():
             self.tabWidget.setCurrentIndex(tab)
             self.selector(tab)
@@ -21,6 +21,10 @@ FILE_BASE = 'https://test-files.osf.io'
 # Interval (in seconds) to poll the OSF for server-side file changes
 REMOTE_CHECK_INTERVAL = 60 * 5  # Every 5 minutes
 
+# Between remote checks only local folders that watchdog saw change are rescanned. Every so often
+# (in seconds) the entire local tree is rescanned anyway, in case watchdog missed something.
+FULL_AUDIT_INTERVAL = 60 * 60  # Every hour
+
 #internet checker interval
 INTERNET_CHECK_INTERVAL = 60
 
@@ -47,6 +51,7 @@ IGNORED_PATTERNS = [
     r'~\$.*',
     r'.*\.tmp',
     r'\..*\.swp',
+    r'\.~tmp\..*',
 ]
 
 OSF_STORAGE_FOLDER = 'OSF Storage'
@@ -55,12 +60,79 @@ COMPONENTS_FOLDER = 'Components'
 # Variables used to control where application config data is stored
 PROJECT_DB_DIR = user_data_dir(appname=PROJECT_NAME, appauthor=PROJECT_AUTHOR)
 PROJECT_DB_FILE = os.path.join(PROJECT_DB_DIR, 'osf.db')
+# Content hashes of local files, keyed on (device, inode, size, mtime, ctime). Safe to delete.
+PROJECT_HASH_CACHE_FILE = os.path.join(PROJECT_DB_DIR, 'hashes.db')
 
 PROJECT_LOG_DIR = user_log_dir(appname=PROJECT_NAME, appauthor=PROJECT_AUTHOR)
 PROJECT_LOG_FILE = os.path.join(PROJECT_LOG_DIR, 'osfsync.log')
 
 EVENT_DEBOUNCE = 3
 
+# Number of threads used to list remote folders during an audit. How many of them have a request in flight
+# at once is decided by OSFClient's AdaptiveLimiter.
+REMOTE_CRAWL_WORKERS = 16
+
+# API listing pages, and the folder children built from them, remembered for conditional requests
+LISTING_CACHE_SIZE = 1000
+
+# Pages of a long API listing requested ahead of the one being read, when the server reports the listing's size
+PAGE_PREFETCH_WORKERS = 4
+
+# Seconds remote objects found by a crawl are reused for, by the operations that follow it, before being loaded again
+REMOTE_CACHE_TTL = 60
+# Most remote objects remembered at once; the oldest are dropped first
+REMOTE_CACHE_SIZE = 50000
+
+# Number of remote nodes (projects and components) whose children are fetched at once
+REMOTE_NODE_WORKERS = 4
+
+# Number of threads used to hash local files
+HASH_WORKERS = os.cpu_count() or 1
+
+# Number of local path -> database File lookups to remember
+DB_PATH_CACHE_SIZE = 4096
+
+# Database connections kept open for the worker threads; each thread has its own session
+DB_POOL_SIZE = 5
+# Seconds a writer waits for another thread's write transaction before giving up
+DB_BUSY_TIMEOUT = 30
+# SQLite page cache per connection, in KiB
+DB_CACHE_SIZE_KB = 8192
+# Database changes made by the OperationWorker are committed in batches of at most this many changes,
+# kept open for at most DB_BATCH_LATENCY seconds
+DB_BATCH_SIZE = 500
+DB_BATCH_LATENCY = 1
+
+# Number of operations run at once. Operations on related paths always run one after the other.
+OPERATION_WORKERS = 4
+# How far down the queue to look for an operation that can run alongside those already running
+OPERATION_LOOKAHEAD = 200
+
+# Requests to the OSF in flight at once, across every thread, adapt between these bounds to what the server
+# can take. HTTP_MAX_REQUESTS is also the number of connections kept alive per host.
+HTTP_MIN_REQUESTS = 1
+HTTP_INITIAL_REQUESTS = 8
+HTTP_MAX_REQUESTS = 32
+# A response this many times slower than the fastest recent one counts as the server struggling
+HTTP_LATENCY_FACTOR = 4
+# Seconds between two reductions of the number of requests in flight
+HTTP_DECREASE_INTERVAL = 1
+# Requests turned away with 429 are retried this many times, waiting at most HTTP_MAX_RETRY_AFTER seconds
+HTTP_THROTTLE_RETRIES = 3
+HTTP_MAX_RETRY_AFTER = 60
+# Hosts connections are kept alive to: the API, files and WaterButler servers, with room to spare
+HTTP_POOL_HOSTS = 4
+
+# Downloads interrupted by a dropped connection are resumed with a Range request at most this many times
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+# Files at least this large are downloaded as DOWNLOAD_SEGMENTS byte ranges over parallel connections
+SEGMENTED_DOWNLOAD_MIN_SIZE = 1024 * 1024 * 64
+DOWNLOAD_SEGMENTS = 4
+# New files at least this large are copied on the OSF from a tracked file with the same content, if there is one,
+# instead of being uploaded
+SERVER_COPY_MIN_SIZE = 1024 * 1024
+
 # updater
 REPO = 'CenterForOpenScience/OSF-Sync'
 VERSION = '0.5.0'
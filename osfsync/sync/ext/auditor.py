@@ -1,18 +1,26 @@
-from concurrent.futures import ThreadPoolExecutor
+import bisect
+import collections
 from enum import Enum
+import itertools
 import logging
 import os
 from pathlib import Path
 
 from osfsync import settings
 from osfsync.client.osf import OSFClient
+from osfsync.client.osf import RemoteCache
 from osfsync.database import Session
 from osfsync.database.models import Node, File
+from osfsync.sync.ext.crawler import RemoteCrawler
+from osfsync.sync.ext.crawler import walk_nodes
+from osfsync.sync.ext.dirty import DirtyJournal
+from osfsync.sync.ext.dirty import is_within
 from osfsync.tasks import operations
 from osfsync.tasks.operations import OperationContext
 from osfsync.utils import EventType
-from osfsync.utils import hash_file
-from osfsync.utils import is_ignored
+from osfsync.utils import walk_local
+from osfsync.utils.hashing import HashCache
+from osfsync.utils.hashing import HashPool
 from osfsync.utils.authentication import get_current_user
 
 logger = logging.getLogger(__name__)
@@ -80,9 +88,22 @@ class Audit(object):
 NULL_AUDIT = Audit(None, None, None)
 
 
+def _prefixed(keys, prefix):
+    """Yield every item of the sorted list keys that starts with prefix"""
+    for key in itertools.islice(keys, bisect.bisect_left(keys, prefix), None):
+        if not key.startswith(prefix):
+            break
+        yield key
+
+
 class Auditor:
-    def __init__(self):
+    def __init__(self, *, dirty=None):
+        """
+        :param dict dirty: A DirtyJournal snapshot. If given, only these folders are rescanned locally and
+        everything else is assumed to still match the database. If None, the whole local tree is scanned.
+        """
         self._unreachable = []
+        self._dirty = dirty
         self.user_folder = get_current_user().folder + os.path.sep
 
     def audit(self):
@@ -147,93 +168,70 @@ class Auditor:
             }
 
     def collect_all_remote(self):
-        ret = {}
-        with ThreadPoolExecutor(max_workers=5) as tpe:
+        crawler = RemoteCrawler().start()
+        try:
+            self._discover_remote(crawler)
+        finally:
+            crawler.close()
+            crawler.join()
+        logger.info('Crawled remote storage: {}'.format(crawler.stats))
+        self.crawl_stats = crawler.stats
+
+        prefixes = []
+        for node_id in crawler.failed:
+            # A partially crawled node would look like a mass deletion; skip it entirely this time around
+            logger.warning('Could not fully crawl Remote node {}. Marking as unreachable.'.format(node_id))
+            self._unreachable.append(node_id)
             with Session() as session:
-                nodes = session.query(Node).filter(Node.sync)
-            # first get top level nodes selected in settings
-            for node in nodes:
-                try:
-                    remote_node = OSFClient().get_node(node.id)
-                except Exception as e:
-                    # If the node can't be reached, skip auditing of this project and go on to the next node
-                    # TODO: The client should be made smart enough to check return code before parsing and yield a custom exception
-                    # TODO: The user should be notified about projects that failed to sync, and given a way to deselect them
-                    self._unreachable.append(node.id)
-                    logger.exception('Could not fetch Remote node {!r}. Marking as unreachable.'.format(node))
-                    continue
-                remote_files = remote_node.get_storage(id='osfstorage')
-                rel_path = os.path.join(node.rel_path, settings.OSF_STORAGE_FOLDER)
-                tpe.submit(
-                    self._collect_node_remote,
-                    remote_files,
-                    ret,
-                    rel_path,
-                    tpe
-                )
-                try:
-                    stack = remote_node.get_children(lazy=False)
-                except Exception as e:
-                    # If the node can't be reached, skip auditing of this project and go on to the next node
-                    # TODO: The client should be made smart enough to check return code before parsing and yield a custom exception
-                    # TODO: The user should be notified about projects that failed to sync, and given a way to deselect them
-                    self._unreachable.append(node.id)
-                    logger.exception('Could not fetch Remote node {!r}\'s children. Marking as unreachable.'.format(node))
-                    continue
-                while len(stack):
-                    remote_child = stack.pop(0)
-                    child_files = remote_child.get_storage(id='osfstorage')
-                    # RemoteSyncWorker's _preprocess_node guarantees a db entry exists
-                    # for each Node in the remote project hierarchy. Use the db Node's
-                    # path representation to ensure consistent path naming conventions.
-                    with Session() as session:
-                        child_path = session.query(Node).filter(
-                            Node.id == remote_child.id
-                        ).one().rel_path
-                    tpe.submit(
-                        self._collect_node_remote,
-                        child_files,
-                        ret,
-                        os.path.join(child_path, settings.OSF_STORAGE_FOLDER),
-                        tpe
-                    )
-                    try:
-                        stack = stack + remote_child.get_children(lazy=False)
-                    except Exception as e:
-                        # If the node can't be reached, skip auditing of this project and go on to the next node
-                        # TODO: The client should be made smart enough to check return code before parsing and yield a custom exception
-                        # TODO: The user should be notified about projects that failed to sync, and given a way to deselect them
-                        logger.exception(e)
-                        continue
-            tpe._work_queue.join()
-        return ret
+                node = session.query(Node).filter(Node.id == node_id).one()
+            prefixes.append(os.path.join(node.rel_path, settings.OSF_STORAGE_FOLDER) + os.path.sep)
 
-    def _collect_node_remote(self, root, acc, rel_path, tpe):
-        if root.parent:
-            rel_path = os.path.join(rel_path, root.name)
+        return {
+            path: Audit(*info)
+            for path, info in crawler.results.items()
+            if not any(path.startswith(prefix) for prefix in prefixes)
+        }
 
-        acc[rel_path + os.path.sep] = Audit(
-            root.id,
-            None if root.is_dir else root.extra['hashes']['sha256'],
-            root
-        )
+    def _discover_remote(self, crawler):
+        with Session() as session:
+            nodes = session.query(Node).filter(Node.sync).all()
 
-        for child in root.get_children():
-            # is_ignored matches on full paths and requires at least a leading /
-            if is_ignored(os.path.sep + child.name):
+        # Storage roots are handed to the crawler as soon as their node is found, so listing the
+        # first projects overlaps with discovering deeper components.
+        for visit in walk_nodes([(node.id, None) for node in nodes], self._expand_remote):
+            node_id = visit.item[0]
+            with Session() as session:
+                node = session.query(Node).filter(Node.id == node_id).one()
+            if visit.error:
+                # If the node can't be reached, skip auditing of it and everything below it
+                # TODO: The user should be notified about projects that failed to sync, and given a way to deselect them
+                logger.error('Could not fetch Remote node {!r}. Marking it and its descendants as unreachable.'.format(node), exc_info=visit.error)
+                stack = collections.deque([node])
+                while stack:
+                    unreachable = stack.popleft()
+                    self._unreachable.append(unreachable.id)
+                    stack.extend(unreachable.children)
                 continue
-            if child.kind == 'folder':
-                tpe.submit(self._collect_node_remote, child, acc, rel_path, tpe)
-            else:
-                acc[os.path.join(rel_path, child.name)] = Audit(
-                    child.id,
-                    child.extra['hashes']['sha256'],
-                    child
-                )
-        tpe._work_queue.task_done()
+            # RemoteSyncWorker's _preprocess_node guarantees a db entry exists
+            # for each Node in the remote project hierarchy. Use the db Node's
+            # path representation to ensure consistent path naming conventions.
+            crawler.add(node.id, visit.value, os.path.join(node.rel_path, settings.OSF_STORAGE_FOLDER))
+
+    def _expand_remote(self, item):
+        node_id, remote_node = item
+        if remote_node is None:
+            remote_node = OSFClient().get_node(node_id)
+        storage = remote_node.get_storage(id='osfstorage')
+        children = remote_node.get_children(lazy=False)
+        for child in children:
+            RemoteCache().put(('nodes', child.id), child)
+        return storage, [(child.id, child) for child in children]
 
     def collect_all_local(self, db_map):
         ret = {}
+        # Files are hashed in the background while the tree is walked; (audit, future) pairs
+        pending = []
+        db_paths = sorted(db_map) if self._dirty is not None else None
         with Session() as session:
             nodes = session.query(Node).filter(Node.sync)
         for node in nodes:
@@ -241,42 +239,86 @@ class Auditor:
                 logger.warning('Node {!r} is marked as unreachable. Not collection local structure.'.format(node))
                 continue
             node_path = Path(os.path.join(node.path, settings.OSF_STORAGE_FOLDER))
-            self._collect_node_local(node_path, ret, db_map)
-
-            stack = [c for c in node.children]
-            while len(stack):
-                child = stack.pop(0)
+            self._collect_node_local(node_path, ret, db_map, pending, db_paths)
+
+            stack = collections.deque(node.children)
+            while stack:
+                child = stack.popleft()
+                stack.extend(child.children)
+                if child.id in self._unreachable:
+                    logger.warning('Node {!r} is marked as unreachable. Not collection local structure.'.format(child))
+                    continue
                 child_path = Path(
                     os.path.join(
                         child.path,
                         settings.OSF_STORAGE_FOLDER
                     )
                 )
-                self._collect_node_local(child_path, ret, db_map)
-                stack = stack + child.children
+                self._collect_node_local(child_path, ret, db_map, pending, db_paths)
+        for audit, future in pending:
+            try:
+                audit.sha256 = future.result()
+            except OSError as e:
+                self._unhashable(audit, e, ret, db_map)
+        HashCache().flush()
         return ret
 
-    def _collect_node_local(self, root, acc, db_map):
-        rel_path = str(root).replace(self.user_folder, '') + os.path.sep
+    def _unhashable(self, audit, error, acc, db_map):
+        """Account for a file that was deleted, renamed or locked between being found and being hashed"""
+        path = self.user_folder + audit.fobj
+        # Whatever happened to it will be looked at again by the next audit
+        DirtyJournal().mark(os.path.dirname(path))
+        known = db_map.get(audit.fobj)
+        if isinstance(error, FileNotFoundError) or known is None:
+            logger.info('{} changed while being audited ({}); skipping it'.format(path, error))
+            del acc[audit.fobj]
+        else:
+            # Still there but unreadable; treat it as unchanged rather than as deleted
+            logger.warning('Could not hash {} ({}); assuming it is unchanged'.format(path, error))
+            audit.sha256 = known.sha256
+
+    def _collect_node_local(self, root, acc, db_map, pending, db_paths=None):
+        root = str(root)
+        if (
+            self._dirty is None
+            or root[len(self.user_folder):] + os.path.sep not in db_map
+            or any(is_within(root, folder) for folder in self._dirty)
+        ):
+            return self._scan_local(root, acc, db_map, pending)
+
+        # Nothing has been seen to change outside of the dirty folders, so the database
+        # is an accurate picture of the local state everywhere else.
+        for rel_path in _prefixed(db_paths, root[len(self.user_folder):] + os.path.sep):
+            acc[rel_path] = Audit(db_map[rel_path].fid, db_map[rel_path].sha256, rel_path)
+
+        for folder in self._dirty:
+            if not is_within(folder, root):
+                continue
+            for rel_path in _prefixed(db_paths, folder[len(self.user_folder):] + os.path.sep):
+                acc.pop(rel_path, None)
+            if os.path.isdir(folder):
+                self._scan_local(folder, acc, db_map, pending)
+        return acc
+
+    def _scan_local(self, root, acc, db_map, pending):
+        rel_path = root[len(self.user_folder):] + os.path.sep
         acc[rel_path] = Audit(
             db_map.get(rel_path, NULL_AUDIT).fid,
             None,
             rel_path
         )
 
-        for child in root.iterdir():
-            # Ignore matches full paths
-            if is_ignored(str(child)):
-                continue
-            if child.is_dir():
-                self._collect_node_local(child, acc, db_map)
-            else:
-                rel_path = str(child).replace(self.user_folder, '')
-                acc[rel_path] = Audit(
-                    db_map.get(rel_path, NULL_AUDIT).fid,
-                    hash_file(child),
-                    rel_path
-                )
+        for entry in walk_local(root, base=self.user_folder):
+            acc[entry.rel_path] = Audit(
+                db_map.get(entry.rel_path, NULL_AUDIT).fid,
+                None,
+                entry.rel_path
+            )
+            if not entry.is_dir:
+                pending.append((
+                    acc[entry.rel_path],
+                    HashPool().submit(self.user_folder + entry.rel_path, st=entry.stat)
+                ))
         return acc
 
     def _diff(self, source, target):
@@ -0,0 +1,192 @@
+"""Parallel crawl of the remote project hierarchy and storage of synced nodes"""
+import collections
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import logging
+import os
+import threading
+import time
+
+from osfsync import settings
+from osfsync.client.osf import OSFClient
+from osfsync.client.osf import RemoteCache
+from osfsync.utils import is_ignored
+
+logger = logging.getLogger(__name__)
+
+
+NodeVisit = collections.namedtuple('NodeVisit', ['item', 'value', 'children', 'error'])
+
+
+def walk_nodes(roots, expand, *, workers=None):
+    """
+    Breadth-first traversal of a node hierarchy, expanding up to `workers` nodes at once.
+
+    expand(item) is called on a worker thread and must return a (value, children) pair; children are
+    expanded in turn. Visits are yielded on the calling thread as their expansions complete, and a node is
+    always yielded before any of its children, so the caller may do its database work between yields.
+    If expand raises, the visit carries the exception and none of that node's descendants are visited.
+
+    :param iterable roots: Items to start from
+    :param callable expand: item -> (value, list of child items)
+    :param int workers: Maximum number of expansions in flight
+    """
+    workers = workers or settings.REMOTE_NODE_WORKERS
+    frontier = collections.deque(roots)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while frontier or running:
+            while frontier and len(running) < workers:
+                item = frontier.popleft()
+                running[executor.submit(expand, item)] = item
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                try:
+                    value, children = future.result()
+                except Exception as e:
+                    yield NodeVisit(item, None, None, e)
+                    continue
+                frontier.extend(children)
+                yield NodeVisit(item, value, children, None)
+
+
+class CrawlStats:
+    """Counters describing a single crawl"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.folders = 0
+        self.files = 0
+        self.requests = 0
+        self.bytes = 0
+        # rel_path of each folder that could not be listed -> the exception raised
+        self.errors = {}
+        self.started = None
+        self.finished = None
+
+    def count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def wall_time(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def __repr__(self):
+        return '<{}(folders={}, files={}, requests={}, bytes={}, errors={}, wall_time={:.2f}s)>'.format(
+            self.__class__.__name__, self.folders, self.files, self.requests,
+            self.bytes, len(self.errors), self.wall_time
+        )
+
+
+class RemoteCrawler:
+    """
+    Lists remote folders in parallel, starting from the storage root of each node added.
+
+    Folders waiting to be listed form the frontier; a fixed number of worker threads drain it
+    and push any subfolders they find back onto it. A folder counts as outstanding from the
+    moment it is pushed until its worker is done with it, whether that worker succeeded or not,
+    so join() returns exactly once the frontier is empty, close() has been called and nothing
+    is outstanding.
+
+    Results map rel_path -> (id, sha256, remote object). Folder rel_paths end in a path separator.
+    Every object found is also put in the RemoteCache, for the operations that follow the audit.
+    """
+
+    def __init__(self, *, workers=None):
+        self.workers = workers or settings.REMOTE_CRAWL_WORKERS
+        self.stats = CrawlStats()
+        self.results = {}
+        # Ids of nodes that had at least one folder fail to list. Their results are incomplete.
+        self.failed = set()
+
+        self._frontier = collections.deque()
+        self._outstanding = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        self.stats.started = time.time()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='RemoteCrawler-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def add(self, node_id, storage, rel_path):
+        """
+        Crawl a node's storage
+
+        :param str node_id:
+        :param osf.Folder storage: The storage root of the node
+        :param str rel_path: Local path, relative to the user's folder, that storage maps to
+        """
+        RemoteCache().put(('storage', node_id, storage.provider), storage)
+        self._push((node_id, storage, rel_path))
+
+    def close(self):
+        """Signal that no more nodes will be added"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def join(self):
+        with self._condition:
+            while not (self._closed and self._outstanding == 0):
+                self._condition.wait()
+        for thread in self._threads:
+            thread.join()
+        self.stats.finished = time.time()
+        return self
+
+    def _push(self, item):
+        with self._condition:
+            self._outstanding += 1
+            self._frontier.append(item)
+            self._condition.notify()
+
+    def _work(self):
+        with OSFClient.track(self.stats):
+            while True:
+                with self._condition:
+                    while not self._frontier and not (self._closed and self._outstanding == 0):
+                        self._condition.wait()
+                    if not self._frontier:
+                        return
+                    node_id, folder, rel_path = self._frontier.popleft()
+                try:
+                    self._visit(node_id, folder, rel_path)
+                except Exception as e:
+                    logger.exception('Could not list remote folder {}'.format(rel_path))
+                    self.stats.errors[rel_path] = e
+                    self.failed.add(node_id)
+                finally:
+                    with self._condition:
+                        self._outstanding -= 1
+                        self._condition.notify_all()
+
+    def _visit(self, node_id, folder, rel_path):
+        self.results[rel_path + os.path.sep] = (folder.id, None, folder)
+
+        files = 0
+        for child in folder.get_children(reuse=True, compact=True):
+            # is_ignored matches on full paths and requires at least a leading /
+            if is_ignored(os.path.sep + child.name):
+                continue
+            RemoteCache().put(('files', child.id), child)
+            if child.kind == 'folder':
+                self._push((node_id, child, os.path.join(rel_path, child.name)))
+            else:
+                files += 1
+                self.results[os.path.join(rel_path, child.name)] = (
+                    child.id,
+                    child.extra['hashes']['sha256'],
+                    child
+                )
+        self.stats.count(folders=1, files=files)
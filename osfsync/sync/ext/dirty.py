@@ -0,0 +1,88 @@
+"""Track which parts of the local tree changed between audits, so only those need to be rescanned"""
+import itertools
+import logging
+import os
+import threading
+
+from watchdog.events import EVENT_TYPE_MODIFIED
+
+from osfsync.database import Session
+from osfsync.database.models import DirtyFolder
+from osfsync.utils import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+def is_within(path, folder):
+    """Whether path is folder or lies somewhere below it"""
+    return path == folder or path.startswith(folder + os.path.sep)
+
+
+class DirtyJournal(metaclass=Singleton):
+    """
+    The set of local folders that watchdog has seen change since the auditor last scanned them.
+
+    Only the outermost dirty folder of any subtree is kept. The journal is mirrored into the
+    dirty_folder table so a restart does not forget about changes that were never audited.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps folder -> the mark it was last dirtied by, so a clear never forgets a newer change
+        self._folders = {}
+        self._marks = itertools.count(1)
+        with Session() as session:
+            for row in session.query(DirtyFolder):
+                self._folders[row.path] = next(self._marks)
+
+    def mark(self, folder):
+        """
+        Record that something in or below folder has changed
+
+        :param str folder: Absolute path of the folder
+        """
+        folder = os.path.normpath(str(folder))
+        with self._lock:
+            if any(is_within(folder, dirty) for dirty in self._folders):
+                return
+            covered = [dirty for dirty in self._folders if is_within(dirty, folder)]
+            for dirty in covered:
+                del self._folders[dirty]
+            self._folders[folder] = next(self._marks)
+
+            with Session() as session:
+                if covered:
+                    session.query(DirtyFolder).filter(DirtyFolder.path.in_(covered)).delete(synchronize_session=False)
+                session.merge(DirtyFolder(path=folder))
+                session.commit()
+        logger.debug('Marked {} as dirty'.format(folder))
+
+    def mark_event(self, event):
+        """Mark whichever folders a watchdog event could have changed the contents of"""
+        if event.is_directory and event.event_type == EVENT_TYPE_MODIFIED:
+            self.mark(event.src_path)
+        else:
+            self.mark(os.path.dirname(event.src_path))
+        if getattr(event, 'dest_path', None):
+            self.mark(os.path.dirname(event.dest_path))
+
+    def snapshot(self):
+        """
+        :return dict: The currently dirty folders, to be handed back to clear() once they are audited
+        """
+        with self._lock:
+            return dict(self._folders)
+
+    def clear(self, snapshot):
+        """Forget every folder in snapshot that has not been marked again since it was taken"""
+        with self._lock:
+            cleared = [
+                folder for folder, mark in snapshot.items()
+                if self._folders.get(folder) == mark
+            ]
+            for folder in cleared:
+                del self._folders[folder]
+            if cleared:
+                with Session() as session:
+                    session.query(DirtyFolder).filter(DirtyFolder.path.in_(cleared)).delete(synchronize_session=False)
+                    session.commit()
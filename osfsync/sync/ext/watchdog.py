@@ -6,8 +6,10 @@ import threading
 from watchdog.events import EVENT_TYPE_DELETED, FileSystemEventHandler
 
 from osfsync import settings, utils
+from osfsync.database import close_session
 from osfsync.exceptions import NodeNotFound
 from osfsync.sync.utils import EventConsolidator
+from osfsync.utils.hashing import HashPool
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +38,7 @@ def sha256_from_event(event):
         return None
 
     try:
-        return utils.hash_file(Path(getattr(event, 'dest_path', event.src_path)))
+        return HashPool().hash(Path(getattr(event, 'dest_path', event.src_path)))
     except (IsADirectoryError, PermissionError):
         return None
 
@@ -71,13 +73,17 @@ class ConsolidatedEventHandler(FileSystemEventHandler):
         with self.lock:
             # Create events after all other types, and parent folder creation events happen before child files
             logger.debug('Flushing event cache; Emitting {} events'.format(len(self._event_cache.events)))
-            for event in self._event_cache.events:
-                logger.info('Emitting event: {}'.format(event))
-                try:
-                    super().dispatch(event)
-                except (NodeNotFound,) as e:
-                    logger.warning(e)
-                except Exception:
-                    logger.exception('Failure while dispatching watchdog event: {}'.format(event))
+            try:
+                for event in self._event_cache.events:
+                    logger.info('Emitting event: {}'.format(event))
+                    try:
+                        super().dispatch(event)
+                    except (NodeNotFound,) as e:
+                        logger.warning(e)
+                    except Exception:
+                        logger.exception('Failure while dispatching watchdog event: {}'.format(event))
+            finally:
+                # Each flush runs on a fresh timer thread
+                close_session()
 
             self._event_cache.clear()
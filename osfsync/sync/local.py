@@ -8,6 +8,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from osfsync import utils
 from osfsync.utils.authentication import get_current_user
 from osfsync.exceptions import NodeNotFound
+from osfsync.sync.ext.dirty import DirtyJournal
 from osfsync.sync.ext.watchdog import ConsolidatedEventHandler
 from osfsync.tasks import operations
 from osfsync.tasks.operations import OperationContext
@@ -39,11 +40,15 @@ class LocalSyncWorker(ConsolidatedEventHandler, metaclass=Singleton):
         self.folder = user.folder
         if unschedule:
             self.observer.unschedule_all()
+            # Nothing was watching the new folder until now
+            DirtyJournal().mark(self.folder)
         logger.debug('Setting observed path to {}'.format(self.folder))
         self.observer.schedule(self, self.folder, recursive=True)
 
     def start(self):
         logger.debug('Starting watchdog observer')
+        # Anything may have changed between the last audit and the observer starting
+        DirtyJournal().mark(self.folder)
         self.observer.start()
 
     def stop(self):
@@ -60,6 +65,8 @@ class LocalSyncWorker(ConsolidatedEventHandler, metaclass=Singleton):
         logger.debug('LocalSyncWorker Stopped')
 
     def dispatch(self, event):
+        # Journal even the events being ignored: the next audit still needs to look at those folders
+        DirtyJournal().mark_event(event)
         if self.ignore.is_set():
             return logger.debug('Ignoring event {}'.format(event))
         super().dispatch(event)
@@ -10,8 +10,9 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from osfsync import settings
 
-from osfsync.client.osf import OSFClient, ClientLoadError
+from osfsync.client.osf import OSFClient, ClientLoadError, RemoteCache
 
+from osfsync.database import reset_session
 from osfsync.database import Session
 from osfsync.database.models import Node, File
 
@@ -20,10 +21,13 @@ from osfsync.sync.exceptions import FolderNotInFileSystem
 from osfsync.sync.ext.auditor import (
     Auditor,
 )
+from osfsync.sync.ext.crawler import walk_nodes
+from osfsync.sync.ext.dirty import DirtyJournal
 
 from osfsync.tasks.notifications import Notification
 from osfsync.tasks.resolution import RESOLUTION_MAP
 from osfsync.tasks.queue import OperationWorker
+from osfsync.tasks.transfers import TransferStats
 
 from osfsync.utils import EventType
 from osfsync.utils import Singleton
@@ -38,6 +42,7 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
         self.user = get_current_user()
         self.__stop = threading.Event()
         self._sync_now_event = threading.Event()
+        self._last_full_audit = None
 
         if not os.path.isdir(self.user.folder):
             raise FolderNotInFileSystem
@@ -48,6 +53,9 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
             nodes = session.query(Node).filter(Node.sync).all()
         for node in nodes:
             self._preprocess_node(node)
+        # Finish whatever the previous run left queued before looking for new work
+        if OperationWorker().resume():
+            OperationWorker().join_queue()
         # session.commit()
         # TODO No need for this check
         self._check()
@@ -68,6 +76,7 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
 
             logger.info('Beginning remote sync')
             LocalSyncWorker().ignore.set()
+            reset_session()
 
             # Ensure selected node directories exist and db entries created
             with Session() as session:
@@ -97,7 +106,7 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
             # watchdog observer does not capture any events triggered by the application itself.
             time.sleep(10)
             LocalSyncWorker().ignore.clear()
-            logger.info('Finished remote sync')
+            logger.info('Finished remote sync; {}; {}; {}'.format(TransferStats(), OSFClient().limiter, RemoteCache()))
         logger.info('Stopped RemoteSyncWorker')
 
     def stop(self):
@@ -108,22 +117,20 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
 
     def _orphan_children(self, node, remote_children):
         """It's a hard world out there...
-        Delete the database record for any descendant not mirrored remotely.
+        Delete the database record for any child not mirrored remotely.
         Via cascade this will also remove any descedant Nodes and Files.
         The effect of this action is that any files associated with a child Node
         locally for which the remote Node has been deleted are explicitly removed
         from OSFO's auditing and will be ignored.
+        Children that do still exist are orphaned in turn as _preprocess_node reaches them.
         """
-        children_ids = [c.id for c in remote_children]
-        for record in node.children:
+        children_ids = {c.id for c in remote_children}
+        for record in list(node.children):
             if record.id not in children_ids:
                 with Session() as session:
                     session.delete(record)
                     session.commit()
                 logger.info("Deleted remotely deleted database Node<{}>".format(record.id))
-            else:
-                remote_child = OSFClient().get_node(record.id)
-                self._orphan_children(record, remote_child.get_children(lazy=False))
 
     def _preprocess_node(self, node, *, delete=True):
         with Session() as session:
@@ -149,10 +156,16 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
                     return
                 else:  # TODO: maybe handle other statuses here
                     raise
-            stack = remote_node.get_children(lazy=False)
-            self._orphan_children(node, stack)
-            while len(stack):
-                child = stack.pop(0)
+
+            # Children of several components are fetched at once. walk_nodes yields every node before
+            # its children, so a child's parent always has a database record by the time it is reached.
+            for visit in walk_nodes([remote_node], lambda remote: (None, remote.get_children(lazy=False))):
+                if visit.error:
+                    raise visit.error
+                child = visit.item
+                if child is remote_node:
+                    self._orphan_children(node, visit.children)
+                    continue
                 # Ensure the database contains a Node record for each node in the project heirarchy.
                 # This must guarentee the remote/database representations of the project heirarchy are
                 # fully congruent.
@@ -176,9 +189,7 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
                     session.add(db_child)
                     session.commit()
                 nodes.append(db_child)
-                children = child.get_children(lazy=False)
-                self._orphan_children(db_child, children)
-                stack = stack + children
+                self._orphan_children(db_child, visit.children)
 
             for node in nodes:
                 local = Path(os.path.join(node.path, settings.OSF_STORAGE_FOLDER))
@@ -186,10 +197,30 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
                     logger.warning('Clearing files for node {}'.format(node))
                     session.query(File).filter(File.node_id == node.id).delete()
                 os.makedirs(str(local), exist_ok=True)
+            session.commit()
+
+    def _audit(self):
+        # A journal is only trustworthy while watchdog has been watching the entire time
+        full = (
+            self._last_full_audit is None
+            or not LocalSyncWorker().is_alive()
+            or time.time() - self._last_full_audit >= settings.FULL_AUDIT_INTERVAL
+        )
+        started = time.time()
+        dirty = DirtyJournal().snapshot()
+        if full:
+            logger.info('Auditing the entire local tree')
+            events = Auditor().audit()
+            self._last_full_audit = started
+        else:
+            logger.info('Auditing {} dirty local folders'.format(len(dirty)))
+            events = Auditor(dirty=dirty).audit()
+        DirtyJournal().clear(dirty)
+        return events
 
     def _check(self):
         resolutions = []
-        local_events, remote_events = Auditor().audit()
+        local_events, remote_events = self._audit()
 
         for is_folder in (True, False):
             for conflict in sorted(set(local_events.keys()) & set(remote_events.keys()),
@@ -252,9 +283,11 @@ class RemoteSyncWorker(threading.Thread, metaclass=Singleton):
 
         directories = sorted(directories, key=lambda x: getattr(x, 'dest_path', x.src_path).count(os.path.sep))
 
-        for operation in itertools.chain(resolutions, (event.operation() for event in directories),
-                                         (event.operation() for event in td.children())):
-            OperationWorker().put(operation)
+        OperationWorker().put_all(itertools.chain(
+            resolutions,
+            (event.operation() for event in directories),
+            (event.operation() for event in td.children())
+        ))
 
         OperationWorker().join_queue()
 
@@ -0,0 +1,123 @@
+"""Durable record of queued operations, so work interrupted by a crash or restart can be resumed"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+from osfsync.client import osf as osf_client
+from osfsync.client.osf import OSFClient
+from osfsync.database import models
+from osfsync.database import Session
+from osfsync.tasks import operations
+from osfsync.tasks.operations import OperationContext
+from osfsync.utils import db_to_remote
+
+logger = logging.getLogger(__name__)
+
+
+def _dump_context(context):
+    remote = context._remote
+    return {
+        'local': str(context._local) if context._local else None,
+        'db': context._db.id if context._db else None,
+        'node': context._node.id if context._node else None,
+        'remote': {
+            'id': remote.id,
+            'kind': remote.kind,
+            'parent': remote.parent.id if remote.parent else None,
+        } if remote else None,
+        'is_folder': context._is_folder,
+        'check_is_folder': context._check_is_folder,
+    }
+
+
+def _load_context(session, state):
+    db = node = remote = None
+    if state['db']:
+        db = session.query(models.File).get(state['db'])
+        if db is None:
+            raise LookupError('File {} is no longer in the database'.format(state['db']))
+    if state['node']:
+        node = session.query(models.Node).get(state['node'])
+        if node is None:
+            raise LookupError('Node {} is no longer in the database'.format(state['node']))
+    if state['remote']:
+        cls = osf_client.Folder if state['remote']['kind'] == 'folder' else osf_client.File
+        remote = cls.load(OSFClient().request_session, state['remote']['id'])
+        if state['remote']['parent']:
+            parent = session.query(models.File).get(state['remote']['parent'])
+            if parent is None:
+                raise LookupError('Parent {} is no longer in the database'.format(state['remote']['parent']))
+            remote.parent = db_to_remote(parent)
+    return OperationContext(
+        local=Path(state['local']) if state['local'] else None,
+        db=db,
+        remote=remote,
+        node=node,
+        is_folder=state['is_folder'],
+        check_is_folder=state['check_is_folder'],
+    )
+
+
+def dump(operation):
+    """
+    :param operation: A queued operation
+    :return: (idempotency key, JSON description) of operation
+    """
+    contexts = [operation._context]
+    if isinstance(operation, operations.MoveOperation):
+        contexts.append(operation._dest_context)
+    description = json.dumps({
+        'operation': type(operation).__name__,
+        'contexts': [_dump_context(context) for context in contexts],
+    }, sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest(), description
+
+
+def load(session, description):
+    """Rebuild the operation a JSON description was made from"""
+    description = json.loads(description)
+    cls = getattr(operations, description['operation'])
+    return cls(*(_load_context(session, state) for state in description['contexts']))
+
+
+def record(entries):
+    """
+    Add operations to the journal in a single transaction, skipping those already there
+
+    :param list entries: (key, description) of each operation, as returned by dump
+    """
+    if not entries:
+        return
+    with Session() as session:
+        session.execute(
+            models.JournalEntry.__table__.insert().prefix_with('OR IGNORE'),
+            [{'key': key, 'operation': description} for key, description in entries]
+        )
+        session.commit()
+
+
+def forget(session, keys):
+    """Remove operations from the journal. The caller commits, together with the operations' own changes."""
+    if keys:
+        session.query(models.JournalEntry).filter(
+            models.JournalEntry.key.in_(keys)
+        ).delete(synchronize_session=False)
+
+
+def pending():
+    """
+    Yield (key, operation) for every operation in the journal, oldest first. Entries that can no longer be
+    turned back into an operation are dropped; the next audit will find whatever work they stood for.
+    """
+    with Session() as session:
+        entries = session.query(models.JournalEntry).order_by(models.JournalEntry.id).all()
+        for entry in entries:
+            try:
+                operation = load(session, entry.operation)
+            except Exception:
+                logger.exception('Could not resume journaled operation {!r}; dropping it'.format(entry))
+                forget(session, [entry.key])
+                session.commit()
+                continue
+            yield entry.key, operation
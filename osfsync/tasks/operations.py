@@ -6,14 +6,20 @@ import shutil
 
 from pathlib import Path
 
+from sqlalchemy import inspect
+
 from osfsync import settings
 from osfsync import utils
 from osfsync.client import osf as osf_client
 from osfsync.client.osf import OSFClient
 from osfsync.database import models
+from osfsync.database import commit
+from osfsync.database import rebind
 from osfsync.database import Session
+from osfsync.tasks import transfers
 from osfsync.tasks.notifications import Notification
 from osfsync.utils.authentication import get_current_user
+from osfsync.utils.hashing import HashPool
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +31,22 @@ def permission_error_notification(file_or_folder, file_name, node_title):
         'have write permission to the project.'.format(file_or_folder, file_name, node_title)
     )
 
+
+def _fetch(remote, path):
+    """Bring the content of a remote file to path, copying it from another tracked file if one has it"""
+    sha256 = remote.extra['hashes']['sha256']
+    mtime = getattr(remote, 'date_modified', None)
+    if not transfers.reuse(path, sha256, exclude=remote.id, mtime=mtime):
+        transfers.download(remote.raw['links']['download'], path, size=remote.size, sha256=sha256, mtime=mtime)
+
+
+def _identity(obj):
+    if obj is None:
+        return None
+    identity = inspect(obj).identity
+    return identity[0] if identity else None
+
+
 class OperationContext:
     """Store common data describing an operation"""
     def __init__(self, *, local=None, db=None, remote=None, node=None, is_folder=False, check_is_folder=True):
@@ -36,15 +58,25 @@ class OperationContext:
         self._check_is_folder = check_is_folder
 
     def __repr__(self):
-        return '<{}(node={}, local={}, db={}, remote={})>'.format(self.__class__.__name__, self._node, self._local, self._db, self._remote)
+        # Rows may belong to another thread's session; their ids can be read without loading anything through it
+        return '<{}(node={}, local={}, db={}, remote={})>'.format(
+            self.__class__.__name__,
+            _identity(self._node),
+            self._local,
+            _identity(self._db),
+            self._remote.id if self._remote else None,
+        )
 
     @property
     def node(self):
         if self._node:
+            # Contexts are built on one thread and run on another
+            self._node = rebind(self._node)
             return self._node
 
         if self._db:
-            self._node = self._db.node
+            db = self.db
+            self._node = db.node if db is not None else None
         elif self._local:
             self._node = utils.extract_node(str(self._local))
         elif self._remote:
@@ -55,6 +87,7 @@ class OperationContext:
     @property
     def db(self):
         if self._db:
+            self._db = rebind(self._db)
             return self._db
         if self._local:
             self._db = utils.local_to_db(
@@ -81,7 +114,8 @@ class OperationContext:
         if self._local:
             return self._local
         if self._db:
-            self._local = Path(self._db.path)
+            db = self.db
+            self._local = Path(db.path) if db is not None else None
         return self._local
 
 
@@ -137,12 +171,7 @@ class LocalCreateFile(BaseOperation):
         with Session() as session:
             db_parent = session.query(models.File).filter(models.File.id == self.remote.parent.id).one()
         path = os.path.join(db_parent.path, self.remote.name)
-        # TODO: Create temp file in target directory while downloading, and rename when done. (check that no temp file exists)
-        resp = OSFClient().request('GET', self.remote.raw['links']['download'], stream=True)
-        with open(path, 'wb') as fobj:
-            for chunk in resp.iter_content(chunk_size=1024 * 64):
-                if chunk:
-                    fobj.write(chunk)
+        _fetch(self.remote, path)
 
         # After file is saved, create a new database object to track the file
         #   If the task fails, the database task will be kicked off separately by the auditor on a future cycle
@@ -176,14 +205,15 @@ class LocalUpdateFile(BaseOperation):
         with Session() as session:
             db_file = session.query(models.File).filter(models.File.id == self.remote.id).one()
 
-        tmp_path = os.path.join(db_file.parent.path, '.~tmp.{}'.format(db_file.name))
+        if transfers.unchanged(db_file.path, self.remote.extra['hashes']['sha256']):
+            # i.e. only the modification time changed, or both sides were changed the same way
+            logger.debug('{} already matches the OSF; not downloading it'.format(db_file.path))
+            transfers.TransferStats().count(skipped_downloads=1, bytes_saved=self.remote.size or 0)
+            return DatabaseUpdateFile(
+                OperationContext(db=db_file, remote=self.remote, node=db_file.node)
+            ).run()
 
-        resp = OSFClient().request('GET', self.remote.raw['links']['download'], stream=True)
-        with open(tmp_path, 'wb') as fobj:
-            for chunk in resp.iter_content(chunk_size=1024 * 64):
-                if chunk:
-                    fobj.write(chunk)
-        shutil.move(tmp_path, db_file.path)
+        _fetch(self.remote, db_file.path)
 
         DatabaseUpdateFile(
             OperationContext(db=db_file, remote=self.remote, node=db_file.node)
@@ -219,10 +249,12 @@ class RemoteCreateFile(BaseOperation):
             return RemoteUpdateFile(self._context).run()
 
         parent = utils.local_to_db(self.local.parent, self.node)
+        if self._copy_on_server(parent):
+            return
 
         url = '{}/v1/resources/{}/providers/{}/{}'.format(settings.FILE_BASE, self.node.id, parent.provider, parent.osf_path)
-        with self.local.open(mode='rb') as fobj:
-            resp = OSFClient().request('PUT', url, data=fobj, params={'name': self.local.name})
+        sent = transfers.upload(url, str(self.local), params={'name': self.local.name})
+        resp = sent.resp
         data = resp.json()
         if resp.status_code == http.client.FORBIDDEN:
             permission_error_notification('file', self.local.name, self.node.title)
@@ -233,12 +265,84 @@ class RemoteCreateFile(BaseOperation):
             # WB id are <provider>/<id>
             remote.id = remote.id.replace(remote.provider + '/', '')
             remote.parent = parent
+            transfers.verify_upload(str(self.local), sent, remote.extra['hashes']['sha256'])
 
             DatabaseCreateFile(
                 OperationContext(remote=remote, node=self.node)
             ).run()
             Notification().info('Uploaded New File: {} in {}'.format(self.db.pretty_path, self.node.title))
 
+    def _copy_on_server(self, parent):
+        """
+        Have WaterButler copy a tracked file with the same content into place, i.e. when the user duplicated a
+        file, so that none of its bytes are uploaded again
+
+        :param models.File parent: The folder the file is created in
+        :return bool: Whether the file was created
+        """
+        try:
+            size = self.local.stat().st_size
+        except OSError:
+            return False
+        if size < settings.SERVER_COPY_MIN_SIZE:
+            # Uploading it costs no more than asking for a copy
+            return False
+        with Session() as session:
+            candidate = session.query(models.File.id).filter(
+                models.File.size == size,
+                models.File.kind == models.File.FILE,
+                models.File.sha256.isnot(None),
+            ).first()
+        # Only hash the file when something tracked could have the same content
+        if candidate is None:
+            return False
+        try:
+            sha256 = HashPool().hash(self.local)
+        except OSError:
+            return False
+        with Session() as session:
+            source = session.query(models.File).filter(
+                models.File.sha256 == sha256,
+                models.File.size == size,
+                models.File.kind == models.File.FILE,
+            ).first()
+        if source is None:
+            return False
+
+        # The same endpoint RemoteMove posts to, which is the source's links.move
+        url = '{}/v1/resources/{}/providers/{}/{}'.format(settings.FILE_BASE, source.node_id, source.provider, source.osf_path)
+        resp = OSFClient().request('POST', url, json={
+            'action': 'copy',
+            'path': parent.osf_path if parent.parent else '/',
+            'rename': self.local.name,
+            'resource': self.node.id,
+            'provider': parent.provider,
+            # Never replace a file already at the destination; 409 instead, and the file is uploaded normally
+            'conflict': 'warn',
+        })
+        if resp.status_code != http.client.CREATED:
+            logger.info('Could not copy {} to {} on the OSF ({}); uploading it instead'.format(
+                source.pretty_path, self.local, resp.status_code
+            ))
+            return False
+
+        remote = osf_client.File(None, resp.json()['data'])
+        # WB id are <provider>/<id>
+        remote.id = remote.id.replace(remote.provider + '/', '')
+        remote.parent = parent
+        DatabaseCreateFile(
+            OperationContext(remote=remote, node=self.node)
+        ).run()
+        transfers.TransferStats().count(copied=1, bytes_saved=source.size or 0)
+
+        if remote.extra['hashes']['sha256'] != sha256:
+            # The source changed on the OSF since it was last synced, so the copy needs the local content after all
+            logger.info('Copy of {} on the OSF is out of date; uploading it'.format(self.local))
+            RemoteUpdateFile(OperationContext(local=self.local, node=self.node)).run()
+        else:
+            Notification().info('Uploaded New File: {} in {}'.format(self.db.pretty_path, self.node.title))
+        return True
+
 
 class RemoteCreateFolder(BaseOperation):
     """Upload a folder (and contents) to the OSF and create multiple DB instances to track changes"""
@@ -274,9 +378,20 @@ class RemoteUpdateFile(BaseOperation):
             logger.debug('File not yet tracked; will run create operation instead')
             return RemoteCreateFile(self._context).run()
 
+        if transfers.unchanged(str(self.local), self.db.sha256):
+            logger.debug('{} already matches the OSF; not uploading it'.format(self.local))
+            transfers.TransferStats().count(skipped_uploads=1, bytes_saved=self.db.size or 0)
+            if self._context._remote is not None:
+                DatabaseUpdateFile(
+                    OperationContext(remote=self._context._remote, db=self.db, node=self.node)
+                ).run()
+            return
+
         url = '{}/v1/resources/{}/providers/{}/{}'.format(settings.FILE_BASE, self.node.id, self.db.provider, self.db.osf_path)
-        with open(str(self.local), 'rb') as fobj:
-            resp = OSFClient().request('PUT', url, data=fobj)
+        sent = transfers.upload(url, str(self.local))
+        # Whatever the crawler saw of this file is now out of date
+        osf_client.RemoteCache().invalidate(('files', self.db.id))
+        resp = sent.resp
         data = resp.json()
         if resp.status_code == http.client.FORBIDDEN:
             permission_error_notification('file', self.local.name, self.node.title)
@@ -287,6 +402,7 @@ class RemoteUpdateFile(BaseOperation):
             # WB id are <provider>/<id>
             remote.id = remote.id.replace(remote.provider + '/', '')
             remote.parent = self.db.parent
+            transfers.verify_upload(str(self.local), sent, remote.extra['hashes']['sha256'])
             DatabaseUpdateFile(
                 OperationContext(remote=remote, db=self.db, node=self.node)
             ).run()
@@ -298,6 +414,7 @@ class RemoteDelete(BaseOperation):
 
     def _run(self):
         resp = OSFClient().request('DELETE', self.remote.raw['links']['delete'])
+        osf_client.RemoteCache().invalidate(('files', self.remote.id))
         with Session() as session:
             db_model = session.query(models.File).filter(models.File.id == self.remote.id).one()
         if resp.status_code == http.client.FORBIDDEN:
@@ -338,7 +455,7 @@ class DatabaseCreateFile(BaseOperation):
                 md5=self.remote.extra['hashes']['md5'],
                 sha256=self.remote.extra['hashes']['sha256'],
             ))
-            session.commit()
+            commit(session)
 
 
 class DatabaseCreateFolder(BaseOperation):
@@ -356,7 +473,7 @@ class DatabaseCreateFolder(BaseOperation):
                 parent_id=parent,
                 node_id=self.node.id
             ))
-            session.commit()
+            commit(session)
 
 
 class DatabaseUpdateFile(BaseOperation):
@@ -376,7 +493,7 @@ class DatabaseUpdateFile(BaseOperation):
 
         with Session() as session:
             session.add(self.db)
-            session.commit()
+            commit(session)
 
 
 class DatabaseUpdateFolder(BaseOperation):
@@ -393,7 +510,7 @@ class DatabaseUpdateFolder(BaseOperation):
 
         with Session() as session:
             session.add(self.db)
-            session.commit()
+            commit(session)
 
 
 class DatabaseDelete(BaseOperation):
@@ -401,12 +518,15 @@ class DatabaseDelete(BaseOperation):
     def _run(self):
         with Session() as session:
             session.delete(self.db)
-            session.commit()
+            commit(session)
 
 
 # Auditor looks for operations by specific names; DRY redundant implementations
 DatabaseDeleteFolder = DatabaseDeleteFile = DatabaseDelete
 
+# Operations that only touch the database
+DATABASE_OPERATIONS = (DatabaseCreateFile, DatabaseCreateFolder, DatabaseUpdateFile, DatabaseUpdateFolder, DatabaseDelete)
+
 
 class RemoteMove(MoveOperation):
     """Move an item on the OSF; subclass for file or folder variants"""
@@ -429,6 +549,7 @@ class RemoteMove(MoveOperation):
                                        'rename': self._dest_context.local.name,
                                        'resource': self._dest_context.node.id,
                                    })
+        osf_client.RemoteCache().invalidate(('files', self.remote.id))
 
         data = resp.json()
         if resp.status_code == http.client.FORBIDDEN:
@@ -1,20 +1,97 @@
+import collections
+import itertools
 import logging
-import queue
+import os
 import threading
 
 from osfsync import settings
+from osfsync.database import reset_session
+from osfsync.database import Session
+from osfsync.database import WriteBatch
 from osfsync.exceptions import NodeNotFound
+from osfsync.sync.ext.dirty import DirtyJournal
+from osfsync.sync.ext.dirty import is_within
+from osfsync.tasks import journal
+from osfsync.tasks import operations
 from osfsync.tasks.notifications import Notification
+from osfsync.tasks.operations import DATABASE_OPERATIONS
 from osfsync.utils import Singleton
+from osfsync.utils.authentication import get_current_user
 
 logger = logging.getLogger(__name__)
 
+# Operations that can be coalesced while still queued
+UPDATES = (operations.LocalUpdateFile, operations.RemoteUpdateFile, operations.DatabaseUpdateFile, operations.DatabaseUpdateFolder)
+MOVES = (operations.LocalMove, operations.RemoteMove)
+
+
+class Job:
+    """An operation waiting in, or taken from, the OperationWorker's queue"""
+
+    def __init__(self, operation, key=None):
+        self.operation = operation
+        self.paths = self._paths(operation)
+        # Idempotency key of the operation's journal entry
+        self.key = key
+
+    @staticmethod
+    def _paths(operation):
+        paths = []
+        for context in (operation._context, getattr(operation, '_dest_context', None)):
+            if context is None:
+                continue
+            if context.local is None:
+                # Nothing to go on; order it against everything else
+                return None
+            paths.append(str(context.local).rstrip(os.path.sep))
+        return paths
+
+    def conflicts(self, other):
+        """Whether self and other touch the same subtree, so must not run at the same time or out of order"""
+        if self.paths is None or other.paths is None:
+            return True
+        return any(is_within(a, b) or is_within(b, a) for a in self.paths for b in other.paths)
+
 
 class OperationWorker(threading.Thread, metaclass=Singleton):
+    """
+    Runs queued operations on OPERATION_WORKERS threads.
+
+    Operations whose paths are unrelated run concurrently. An operation never starts while an earlier one on
+    the same path, an ancestor or a descendant is queued or running, so a folder is created before its
+    children and a move excludes both its source and destination subtrees until it is done.
+
+    An operation only counts as done once its database changes are committed, so the next operation on a
+    related path, and anyone waiting on join_queue, find them in the database.
+
+    Operations that have not started yet are coalesced with ones queued later for the same path, so only the
+    final state is transferred; see _coalesce.
+
+    Every queued operation is also written to the journal in the database, and only removed from it in the
+    same transaction that commits its changes. resume() queues whatever a previous run left unfinished.
+    """
+
     def __init__(self):
         super().__init__()
-        self._queue = queue.Queue()
+        self.workers = settings.OPERATION_WORKERS
         self.__stop = threading.Event()
+        self._condition = threading.Condition()
+        self._pending = []
+        # path -> the last queued job touching it. Running jobs are removed.
+        self._latest = {}
+        # Journal key -> the queued jobs recorded under it, in queue order. Running jobs are removed.
+        self._keys = {}
+        # Journal key -> number of jobs recorded under it that are queued, running or not yet committed. Its
+        # journal entry is only forgotten once the last of them is gone.
+        self._holders = collections.Counter()
+        # Incremented whenever journal entries are forgotten; see _queue
+        self._epoch = 0
+        # Number of operations saved, by the kind of coalescing that saved them
+        self.coalesced = collections.Counter()
+        # Jobs that are running, or finished but not yet committed
+        self._active = []
+        self._unfinished = 0
+        self._threads = []
 
     def start(self, *args, **kwargs):
         logger.debug('Starting OperationWorker')
@@ -22,34 +99,324 @@ class OperationWorker(threading.Thread, metaclass=Singleton):
 
     def run(self):
         logger.info('Start processing queue')
-        while not self.__stop.is_set():
-            job = self._queue.get()
-            if job is None:
-                self._queue.task_done()
-                continue
+        for i in range(1, self.workers):
+            thread = threading.Thread(target=self._work, name='OperationWorker-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._work()
+        for thread in self._threads:
+            thread.join()
+        logger.debug('OperationWorker stopped')
+
+    def _work(self):
+        # Jobs run by this thread whose database changes are still in its open batch
+        finished = []
+        with WriteBatch() as batch:
+            while True:
+                job = self._take(block=False)
+                if job is None:
+                    # Make everything done so far durable and visible before waiting for more
+                    self._commit(batch, finished)
+                    job = self._take(block=True)
+                    if job is None:
+                        break
+
+                if not isinstance(job.operation, DATABASE_OPERATIONS):
+                    # Anything else may take minutes; don't hold the database's write lock meanwhile
+                    self._commit(batch, finished)
+                if not batch.pending:
+                    reset_session()
+
+                failed = not self._run(job, batch, finished)
+                finished.append(job)
+                if failed or not batch.pending or batch.expired or self._blocking(finished):
+                    self._commit(batch, finished)
+
+    def _run(self, job, batch, finished):
+        """
+        :param Job job: The job to run
+        :param WriteBatch batch: The batch job's database changes go into
+        :param list finished: Jobs whose database changes are already in batch
+        :return bool: Whether job succeeded
+        """
+        try:
+            job.operation.run(dry=settings.DRY)
+        except (NodeNotFound,) as e:
+            logger.warning(e)
+        except Exception as e:
+            logger.exception(e)
+            self._recover(job, batch, finished)
+            return False
+        return True
+
+    def _recover(self, failed, batch, finished):
+        """Roll back the batch a failed job was adding to, and have the next audit redo everything it held"""
+        # A failed flush leaves the session unusable until it is rolled back, and takes the whole batch with it
+        batch.discard()
+        try:
+            # The database no longer matches the local folders; make sure the next audit looks at them
+            for job in itertools.chain(finished, [failed]):
+                local = job.operation.local
+                DirtyJournal().mark(local.parent if local is not None else get_current_user().folder)
+
+            operation = failed.operation
+            file_name = operation.local.name if operation.local is not None else operation
+            Notification().error('Error while updating the file {} in project {}.'.format(file_name, operation.node.title))
+        except Exception:
+            logger.exception('Could not recover from a failed operation')
+
+    def _take(self, *, block):
+        with self._condition:
+            while True:
+                for i, job in enumerate(itertools.islice(self._pending, settings.OPERATION_LOOKAHEAD)):
+                    if not any(job.conflicts(other) for other in itertools.chain(self._active, self._pending[:i])):
+                        del self._pending[i]
+                        self._unindex(job)
+                        self._unqueue(job)
+                        self._active.append(job)
+                        return job
+                if not block or (self.__stop.is_set() and not self._pending):
+                    return None
+                self._condition.wait()
+
+    def _blocking(self, finished):
+        """Whether a queued job is waiting on one of the given jobs"""
+        with self._condition:
+            return any(
+                job.conflicts(done)
+                for job in itertools.islice(self._pending, settings.OPERATION_LOOKAHEAD)
+                for done in finished
+            )
 
+    def _commit(self, batch, finished):
+        with self._condition:
+            # An identical operation may have been queued again while this one ran
+            done = [job.key for job in finished if self._release(job.key)]
+        try:
+            with Session() as session:
+                # Part of the batch's transaction, so operations leave the journal exactly when their changes land
+                journal.forget(session, done)
+                batch.commit()
+                session.commit()
+        except Exception:
+            logger.exception('Could not commit a batch of database changes')
+            batch.discard()
             try:
-                job.run(dry=settings.DRY)
-            except (NodeNotFound,) as e:
-                logger.warning(e)
-            except Exception as e:
-                logger.exception(e)
-
-                file_name = job.local.name
-                project_name = job.node.title
-                Notification().error('Error while updating the file {} in project {}.'.format(file_name, project_name))
-            finally:
-                self._queue.task_done()
-        logger.debug('OperationWorker stopped')
+                # Which changes were lost is unknown, so have the next audit look at everything
+                DirtyJournal().mark(get_current_user().folder)
+            except Exception:
+                logger.exception('Could not mark the lost changes for the next audit')
+        with self._condition:
+            for job in finished:
+                self._active.remove(job)
+            self._unfinished -= len(finished)
+            self._condition.notify_all()
+        finished.clear()
+        self._settle(done)
 
     def stop(self):
         logger.debug('Stopping OperationWorker')
         self.__stop.set()
-        self._queue.put(None)
+        with self._condition:
+            self._condition.notify_all()
         self.join_queue()
 
-    def put(self, operation):
-        self._queue.put(operation)
+    def put(self, operation, *, key=None):
+        """
+        :param operation: The operation to queue
+        :param str key: Journal key of the operation, if it is already journaled
+        """
+        if key is None:
+            return self.put_all([operation])
+        self._queue([Job(operation, key)], [])
+
+    def put_all(self, operations):
+        """Queue operations in order, journaling all of them in a single transaction"""
+        jobs, entries = [], []
+        for operation in operations:
+            key, description = journal.dump(operation)
+            jobs.append(Job(operation, key))
+            entries.append((key, description))
+        self._queue(jobs, entries)
+
+    def _queue(self, jobs, entries):
+        epoch = self._epoch
+        journal.record(entries)
+
+        # Journal writes wait on the database, and must never happen while holding the condition
+        obsolete, fresh = [], []
+        with self._condition:
+            for job in jobs:
+                if not self._coalesce(job, obsolete, fresh):
+                    self._pending.append(job)
+                    self._index(job)
+                    self._hold(job)
+                    self._unfinished += 1
+            if self._epoch != epoch:
+                # The last job of one of these keys may have committed, and forgotten the entry just recorded
+                fresh.extend(entry for entry in entries if self._holders[entry[0]])
+            self._condition.notify_all()
+
+        stale = self._record(fresh)
+        if obsolete:
+            with Session() as session:
+                journal.forget(session, obsolete)
+                session.commit()
+        self._settle(obsolete + stale)
+
+    def _record(self, entries):
+        """
+        Journal entries for queued jobs, forgetting them again if their jobs committed meanwhile
+
+        :return list: The keys forgotten again
+        """
+        journal.record(entries)
+        with self._condition:
+            stale = [key for key, _ in entries if not self._holders[key]]
+        if stale:
+            with Session() as session:
+                journal.forget(session, stale)
+                session.commit()
+        return stale
+
+    def _settle(self, forgotten):
+        """Journal again any of the forgotten keys that jobs were queued under while they were being forgotten"""
+        while forgotten:
+            with self._condition:
+                self._epoch += 1
+                revived = {
+                    job.key: journal.dump(job.operation)[1]
+                    for job in itertools.chain(self._pending, self._active)
+                    if self._holders[job.key] and job.key in forgotten
+                }
+            forgotten = self._record(list(revived.items()))
+
+    def resume(self):
+        """
+        Queue every operation a previous run journaled but did not finish
+
+        :return: The number of operations resumed
+        """
+        resumed = 0
+        for key, operation in journal.pending():
+            self.put(operation, key=key)
+            resumed += 1
+        if resumed:
+            logger.info('Resuming {} operations from the journal'.format(resumed))
+        return resumed
+
+    def _coalesce(self, job, obsolete, fresh):
+        """
+        Fold job into a queued operation on the same path that has not started yet. Returns True if nothing
+        needs to be queued for job any more. Journal keys that no longer stand for queued work are added to
+        obsolete, and (key, description) of new journal entries to fresh.
+
+        * identical operations, e.g. one resumed from the journal and found again: only one is kept
+        * update + update: only the later update is kept
+        * remote create + remote update: the create uploads the latest content anyway
+        * remote create + remote delete: neither is needed
+        * remote update + remote delete: only the delete is kept
+        * move a -> b + move b -> c: a single move a -> c, or nothing at all if c is a
+        """
+        if job.key in self._keys and self._can_merge(self._keys[job.key][-1], job):
+            return self._count('merged', job)
+        if not job.paths:
+            return False
+        queued = self._latest.get(job.paths[0])
+        if queued is None or not self._can_merge(queued, job):
+            return False
+        first, then = queued.operation, job.operation
+
+        if isinstance(first, MOVES) and type(first) is type(then):
+            if queued.paths[-1] != job.paths[0]:
+                return False
+            self._unindex(queued)
+            self._drop(queued, obsolete)
+            self._drop(job, obsolete)
+            if queued.paths[0] == job.paths[-1]:
+                self._pending.remove(queued)
+                self._unfinished -= 1
+                return self._count('cancelled', job, saved=2)
+            queued.operation = type(first)(first._context, then._dest_context)
+            queued.paths = queued.paths[:1] + job.paths[-1:]
+            queued.key, description = journal.dump(queued.operation)
+            fresh.append((queued.key, description))
+            self._hold(queued)
+            self._index(queued)
+            return self._count('collapsed', job)
+
+        if queued.paths != job.paths:
+            return False
+        if (
+            (isinstance(first, UPDATES) and type(first) is type(then))
+            or (isinstance(first, operations.RemoteUpdateFile) and isinstance(then, operations.RemoteDelete))
+        ):
+            # The later operation takes the place of the queued one
+            self._drop(queued, obsolete)
+            queued.operation, queued.key = then, job.key
+            self._hold(queued)
+            return self._count('merged', job)
+        if isinstance(first, operations.RemoteCreateFile) and isinstance(then, operations.RemoteUpdateFile):
+            self._drop(job, obsolete)
+            return self._count('merged', job)
+        if isinstance(first, operations.RemoteCreateFile) and isinstance(then, operations.RemoteDelete):
+            self._drop(queued, obsolete)
+            self._drop(job, obsolete)
+            self._unindex(queued)
+            self._pending.remove(queued)
+            self._unfinished -= 1
+            return self._count('cancelled', job, saved=2)
+        return False
+
+    def _can_merge(self, queued, job):
+        # Merging moves job's effect to where queued sits in the queue, which is only safe if nothing
+        # in between touches the same subtree
+        index = self._pending.index(queued)
+        return not any(other.conflicts(job) for other in self._pending[index + 1:])
+
+    def _count(self, kind, job, *, saved=1):
+        self.coalesced[kind] += saved
+        logger.debug('Coalesced {!r} into a queued operation ({})'.format(job.operation, kind))
+        return True
+
+    def _hold(self, job):
+        self._keys.setdefault(job.key, []).append(job)
+        self._holders[job.key] += 1
+
+    def _unqueue(self, job):
+        """Take a job that is no longer queued off its key. The key stays held until _release."""
+        jobs = self._keys[job.key]
+        jobs.remove(job)
+        if not jobs:
+            del self._keys[job.key]
+
+    def _release(self, key):
+        """:return bool: Whether the last job held under key is gone, so its journal entry can be forgotten"""
+        self._holders[key] -= 1
+        if self._holders[key] > 0:
+            return False
+        del self._holders[key]
+        return True
+
+    def _drop(self, job, obsolete):
+        """Forget about a job coalesced away, whether it was queued or is only being put"""
+        if job in self._keys.get(job.key, ()):
+            self._unqueue(job)
+            if self._release(job.key):
+                obsolete.append(job.key)
+        elif not self._holders[job.key]:
+            obsolete.append(job.key)
+
+    def _index(self, job):
+        for path in job.paths or ():
+            self._latest[path] = job
+
+    def _unindex(self, job):
+        for path in job.paths or ():
+            if self._latest.get(path) is job:
+                del self._latest[path]
 
     def join_queue(self):
-        return self._queue.join()
+        with self._condition:
+            while self._unfinished:
+                self._condition.wait()
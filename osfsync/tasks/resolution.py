@@ -5,12 +5,11 @@ from osfsync.database import Session
 from osfsync.tasks import interventions
 from osfsync.tasks.interventions import Intervention
 from osfsync.utils import EventType
-from osfsync.utils import hash_file
+from osfsync.utils.hashing import HashPool
 
 
 def prompt_user(local, remote, local_events, remote_events):
-    # TODO Pass around pre computed SHAs
-    if local.context.local and remote.context.remote and hash_file(local.context.local) == \
+    if local.context.local and remote.context.remote and HashPool().hash(local.context.local) == \
             remote.context.remote.extra['hashes']['sha256']:
         return db_create(local, remote, local_events, remote_events)
     return Intervention().resolve(interventions.RemoteLocalFileConflict(local, remote))
@@ -81,8 +80,7 @@ def handle_move_src_update(local, remote, local_events, remote_events):
 
 
 def move_to_conflict(local, remote, local_events, remote_events):
-    # TODO Pass around pre computed SHAs
-    if hash_file(local.context.local) == remote.contexts[1].remote.extra['hashes']['sha256']:
+    if HashPool().hash(local.context.local) == remote.contexts[1].remote.extra['hashes']['sha256']:
         if remote.contexts[0].db:
             if remote.is_directory:
                 return [operations.DatabaseUpdateFolder(operations.OperationContext(
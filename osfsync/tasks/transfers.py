@@ -0,0 +1,497 @@
+"""Moving file contents between the OSF and the local disk"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import errno
+import hashlib
+import http.client
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+
+import requests
+
+from osfsync import settings
+from osfsync.client.osf import OSFClient
+from osfsync.database import models
+from osfsync.database import Session
+from osfsync.utils import Singleton
+from osfsync.utils.hashing import HashCache
+from osfsync.utils.hashing import HashPool
+from osfsync.utils.hashing import stat_key
+
+logger = logging.getLogger(__name__)
+
+
+# Partial downloads live next to their destination under this prefix; see settings.IGNORED_PATTERNS
+TEMP_PREFIX = '.~tmp.'
+
+# Failures after which the bytes already received are still good, and the download can carry on from there
+RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class TransferError(Exception):
+    pass
+
+
+class TransferStats(metaclass=Singleton):
+    """Running totals of the file contents moved, and not moved, between the OSF and the local disk"""
+
+    COUNTERS = (
+        'downloads', 'uploads', 'bytes_received', 'bytes_sent',
+        'skipped_downloads', 'skipped_uploads', 'reused', 'copied', 'bytes_saved',
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+    def count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def __repr__(self):
+        return '<{}({})>'.format(
+            self.__class__.__name__,
+            ', '.join('{}={}'.format(name, getattr(self, name)) for name in self.COUNTERS)
+        )
+
+
+def unchanged(path, sha256):
+    """
+    Whether the file at path already holds the content with the given hash, in which case transferring it
+    either way would be a waste. Hashes are taken from the HashCache where possible.
+
+    :param str path:
+    :param str sha256:
+    :return bool:
+    """
+    if not sha256:
+        return False
+    try:
+        return HashPool().hash(Path(path)) == sha256
+    except OSError:
+        return False
+
+
+def temp_path(path):
+    """:return str: Where a partial download of path is kept"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, TEMP_PREFIX + tail)
+
+
+def _meta_path(tmp):
+    return tmp + '.meta'
+
+
+def _discard(tmp):
+    for path in (tmp, _meta_path(tmp)):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+class _Partial:
+    """The bytes of a download received so far, and their running hash"""
+
+    def __init__(self, tmp):
+        self.tmp = tmp
+        # Bytes that came over the network, as opposed to from an earlier attempt
+        self.received = 0
+        self.restart()
+
+    def restart(self):
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+
+    def resume(self, expected):
+        """
+        Keep the bytes of an earlier attempt to download the same content, hashing them once. Anything left
+        over from a different version of the file is thrown away.
+        """
+        try:
+            with open(_meta_path(self.tmp)) as fp:
+                previous = json.load(fp)
+            size = os.path.getsize(self.tmp)
+        except (OSError, ValueError):
+            previous, size = None, 0
+
+        # Without a hash there is no telling whether the bytes on disk belong to the current version
+        if expected['sha256'] and previous == expected and (expected['size'] is None or size <= expected['size']):
+            if size:
+                logger.info('Resuming download of {} at byte {}'.format(self.tmp, size))
+            with open(self.tmp, 'rb') as fobj:
+                for chunk in iter(lambda: fobj.read(settings.DOWNLOAD_CHUNK_SIZE), b''):
+                    self.sha256.update(chunk)
+                    self.offset += len(chunk)
+            return
+
+        _discard(self.tmp)
+        with open(_meta_path(self.tmp), 'w') as fp:
+            json.dump(expected, fp)
+
+    def fetch(self, url):
+        """Append the content of url from the current offset onwards"""
+        headers = {'Range': 'bytes={}-'.format(self.offset)} if self.offset else {}
+        resp = OSFClient().request(
+            'GET', url,
+            stream=True,
+            headers=headers,
+            timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
+        )
+        with contextlib.closing(resp):
+            overrun = self.offset and resp.status_code == http.client.REQUESTED_RANGE_NOT_SATISFIABLE
+            if not overrun:
+                self._write(url, resp)
+        if overrun:
+            # Only once the response above has given up its connection
+            logger.warning('Partial download {} is longer than the file; starting over'.format(self.tmp))
+            self.restart()
+            self.fetch(url)
+
+    def _write(self, url, resp):
+        resp.raise_for_status()
+        if self.offset and resp.status_code != http.client.PARTIAL_CONTENT:
+            logger.debug('Server ignored the Range header for {}; starting over'.format(url))
+            self.restart()
+
+        with open(self.tmp, 'r+b' if self.offset else 'wb') as fobj:
+            fobj.seek(self.offset)
+            fobj.truncate()
+            for chunk in resp.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    fobj.write(chunk)
+                    self.sha256.update(chunk)
+                    self.offset += len(chunk)
+                    self.received += len(chunk)
+
+
+class _RangesUnsupported(Exception):
+    pass
+
+
+class _Segmented:
+    """
+    A download fetched as several byte ranges at once, each written where it belongs in a preallocated temp
+    file. The sidecar records which segments are complete, so those are kept by a later attempt.
+    """
+
+    def __init__(self, tmp, size, sha256):
+        self.tmp = tmp
+        self.size = size
+        self.segment_size = -(-size // settings.DOWNLOAD_SEGMENTS)
+        self.expected = {'size': size, 'sha256': sha256, 'segment_size': self.segment_size}
+        self.received = 0
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def _resume(self):
+        try:
+            with open(_meta_path(self.tmp)) as fp:
+                previous = json.load(fp)
+            on_disk = os.path.getsize(self.tmp)
+        except (OSError, ValueError):
+            previous, on_disk = {}, None
+
+        if (
+            self.expected['sha256'] and on_disk == self.size
+            and {key: previous.get(key) for key in self.expected} == self.expected
+        ):
+            self._done = set(previous.get('done', []))
+            logger.info('Resuming download of {} with {} segments done'.format(self.tmp, len(self._done)))
+            return
+        _discard(self.tmp)
+        self._save()
+
+    def _save(self):
+        meta = _meta_path(self.tmp)
+        with open(meta + '.new', 'w') as fp:
+            json.dump(dict(self.expected, done=sorted(self._done)), fp)
+        os.replace(meta + '.new', meta)
+
+    def fetch(self, url):
+        """:return tuple: (bytes in the file, SHA256 hash of the file, bytes that came over the network)"""
+        self._resume()
+        fd = os.open(self.tmp, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            _preallocate(fd, self.size)
+            starts = [start for start in range(0, self.size, self.segment_size) if start not in self._done]
+            with ThreadPoolExecutor(max_workers=settings.DOWNLOAD_SEGMENTS) as executor:
+                futures = [
+                    executor.submit(self._fetch_segment, url, fd, start, min(start + self.segment_size, self.size) - 1)
+                    for start in starts
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+
+        # Segments arrive out of order, so the hash can only be taken once they are all in
+        sha256 = hashlib.sha256()
+        with open(self.tmp, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(settings.DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        return self.size, sha256.hexdigest(), self.received
+
+    def _fetch_segment(self, url, fd, start, end):
+        offset, attempt = start, 0
+        while offset <= end:
+            try:
+                resp = OSFClient().request(
+                    'GET', url,
+                    stream=True,
+                    headers={'Range': 'bytes={}-{}'.format(offset, end)},
+                    timeout=(settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT),
+                )
+                with contextlib.closing(resp):
+                    resp.raise_for_status()
+                    if resp.status_code != http.client.PARTIAL_CONTENT:
+                        raise _RangesUnsupported(url)
+                    for chunk in resp.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - offset]
+                        if chunk:
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            with self._lock:
+                                self.received += len(chunk)
+                if offset <= end:
+                    raise requests.exceptions.ChunkedEncodingError('Response ended at byte {}'.format(offset))
+            except RESUMABLE_ERRORS as e:
+                attempt += 1
+                if attempt > settings.DOWNLOAD_RETRIES:
+                    raise
+                logger.warning('Download of {} interrupted at byte {} ({}); resuming'.format(self.tmp, offset, e))
+
+        with self._lock:
+            self._done.add(start)
+            self._save()
+
+
+def _preallocate(fd, size):
+    """Reserve the space for a file up front, so writes at any offset can not fail for lack of it"""
+    posix_fallocate = getattr(os, 'posix_fallocate', None)
+    if posix_fallocate is not None:
+        try:
+            posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by every filesystem
+            pass
+    os.ftruncate(fd, size)
+
+
+def _stream(url, tmp, size, sha256, path):
+    """:return tuple: (bytes in the file, SHA256 hash of the file, bytes that came over the network)"""
+    partial = _Partial(tmp)
+    partial.resume({'size': size, 'sha256': sha256})
+
+    attempt = 0
+    # Everything may have arrived before the previous attempt failed
+    while not (partial.offset and partial.offset == size):
+        try:
+            partial.fetch(url)
+            break
+        except RESUMABLE_ERRORS as e:
+            attempt += 1
+            if attempt > settings.DOWNLOAD_RETRIES:
+                raise
+            logger.warning('Download of {} interrupted at byte {} ({}); resuming'.format(path, partial.offset, e))
+    return partial.offset, partial.sha256.hexdigest(), partial.received
+
+
+def download(url, path, *, size=None, sha256=None, mtime=None):
+    """
+    Download url to path. path is only replaced, atomically, once every byte has arrived and been verified.
+
+    Bytes are received into a temp file next to path, together with a sidecar recording the size and hash
+    they add up to. A dropped connection is resumed with a Range request, up to settings.DOWNLOAD_RETRIES
+    times, and whatever was received survives a failed operation or a restart for the next attempt.
+
+    Files of at least settings.SEGMENTED_DOWNLOAD_MIN_SIZE are split into settings.DOWNLOAD_SEGMENTS ranges
+    fetched over parallel connections, where the platform has os.pwrite and the server honours ranges.
+    Otherwise the content is hashed as it arrives. The hash is checked against sha256 and recorded in the
+    HashCache, so the file is never read back by the auditor just to hash it.
+
+    :param str url:
+    :param str path: Where the file ends up
+    :param int size: Expected size in bytes, if known
+    :param str sha256: Expected hash, if known. Only downloads with a known hash are ever resumed.
+    :param datetime.datetime mtime: Modification time to give the file, i.e. the server's
+    :return str: The SHA256 hash of the downloaded content
+    """
+    tmp = temp_path(path)
+    fetched = None
+    if (
+        size is not None and size >= settings.SEGMENTED_DOWNLOAD_MIN_SIZE
+        and settings.DOWNLOAD_SEGMENTS > 1 and hasattr(os, 'pwrite')
+    ):
+        try:
+            fetched = _Segmented(tmp, size, sha256).fetch(url)
+        except _RangesUnsupported:
+            logger.debug('Server ignored the Range header for {}; downloading it in one piece'.format(url))
+    if fetched is None:
+        fetched = _stream(url, tmp, size, sha256, path)
+    length, received, transferred = fetched
+
+    if size is not None and length != size:
+        _discard(tmp)
+        raise TransferError('Downloaded {} bytes of {}, expected {}'.format(length, path, size))
+    if sha256 and received != sha256:
+        _discard(tmp)
+        raise TransferError('Downloaded {} with hash {}, expected {}'.format(path, received, sha256))
+
+    if mtime is not None:
+        # Also moves the file out of the HashCache's racy window, so its hash can be cached right away
+        os.utime(tmp, (time.time(), mtime.timestamp()))
+    os.replace(tmp, path)
+    _discard(tmp)
+    HashCache().record(path, received)
+    TransferStats().count(downloads=1, bytes_received=transferred)
+    return received
+
+
+# copy_file_range fails with these where the kernel or filesystem can not copy between the two files
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def _copy(src, dst):
+    """Copy the content of src to dst, within the kernel where the platform allows"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is not None:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                if e.errno not in _COPY_UNSUPPORTED:
+                    raise
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, settings.DOWNLOAD_CHUNK_SIZE)
+
+
+def reuse(path, sha256, *, exclude=None, mtime=None):
+    """
+    Create path from a tracked local file that already holds the content with the given hash, rather than
+    downloading it. Only files that still hash to sha256 are used, and path is replaced atomically.
+
+    :param str path: Where the file ends up
+    :param str sha256: The content wanted
+    :param str exclude: Id of the File being downloaded, which can not be its own source
+    :param datetime.datetime mtime: Modification time to give the file, i.e. the server's
+    :return bool: Whether path was created
+    """
+    if not sha256:
+        return False
+    with Session() as session:
+        sources = [
+            source.path
+            for source in session.query(models.File).filter(
+                models.File.sha256 == sha256,
+                models.File.kind == models.File.FILE,
+                models.File.id != exclude,
+            )
+        ]
+
+    # Kept apart from any partial download of path, which is still good if no copy can be made
+    tmp = temp_path(path) + '.copy'
+    for source in sources:
+        if source == path:
+            continue
+        try:
+            st = os.stat(source)
+            if not unchanged(source, sha256):
+                continue
+            _copy(source, tmp)
+            # The source may have been written to while being copied
+            if stat_key(os.stat(source)) != stat_key(st):
+                continue
+        except OSError:
+            logger.debug('Could not copy {} to {}'.format(source, path), exc_info=True)
+            continue
+
+        logger.info('Copying {} from {} instead of downloading it'.format(path, source))
+        if mtime is not None:
+            os.utime(tmp, (time.time(), mtime.timestamp()))
+        os.replace(tmp, path)
+        _discard(temp_path(path))
+        HashCache().record(path, sha256)
+        TransferStats().count(reused=1, bytes_saved=st.st_size)
+        return True
+
+    _discard(tmp)
+    return False
+
+
+# What an upload sent: the response, the SHA256 hash of the bytes sent, and the stat of the file beforehand
+Sent = collections.namedtuple('Sent', ['resp', 'sha256', 'stat'])
+
+
+class HashingReader:
+    """Wraps a file opened for reading, hashing every byte read through it"""
+
+    def __init__(self, fobj):
+        self._fobj = fobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, *args):
+        chunk = self._fobj.read(*args)
+        self.sha256.update(chunk)
+        return chunk
+
+    def __len__(self):
+        # Lets requests send a Content-Length instead of a chunked body
+        return os.fstat(self._fobj.fileno()).st_size - self._fobj.tell()
+
+
+def upload(url, path, **kwargs):
+    """
+    PUT the content of path to url, hashing it as it is sent
+
+    :param str url:
+    :param str path:
+    :return Sent:
+    """
+    st = os.stat(path)
+    with open(path, 'rb') as fobj:
+        reader = HashingReader(fobj)
+        resp = OSFClient().request('PUT', url, data=reader, **kwargs)
+    TransferStats().count(uploads=1, bytes_sent=st.st_size)
+    return Sent(resp, reader.sha256.hexdigest(), st)
+
+
+def verify_upload(path, sent, sha256):
+    """
+    Check the hash the server reports for an upload against what was sent. If they match and the file was
+    not touched in the meantime, the hash is recorded in the HashCache.
+
+    :param str path:
+    :param Sent sent:
+    :param str sha256: The hash reported by the server
+    :return bool: Whether the server received exactly what was sent
+    """
+    if sent.sha256 != sha256:
+        logger.warning('Uploaded {} with hash {}, but the server reports {}'.format(path, sent.sha256, sha256))
+        return False
+    try:
+        unchanged = stat_key(os.stat(path)) == stat_key(sent.stat)
+    except OSError:
+        unchanged = False
+    if unchanged:
+        HashCache().store(sent.stat, sha256)
+    return True
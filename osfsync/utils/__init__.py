@@ -1,8 +1,15 @@
 import re
 import hashlib
+import itertools
+import logging
 import os
+import threading
+from collections import namedtuple
+from collections import OrderedDict
 
 from enum import Enum
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
 from sqlalchemy.orm.exc import NoResultFound
 
 from osfsync import settings
@@ -12,6 +19,8 @@ from osfsync.exceptions import NodeNotFound
 from osfsync.utils.authentication import get_current_user
 
 
+logger = logging.getLogger(__name__)
+
 IGNORE_RE = re.compile(r'.*{}({})'.format(re.escape(os.path.sep), '|'.join(settings.IGNORED_PATTERNS)))
 
 
@@ -68,15 +77,118 @@ def extract_node(path):
         raise NodeNotFound(path)
 
 
-def local_to_db(local, node, *, is_folder=False, check_is_folder=True):
+class PathCache:
+    """
+    LRU of (node id, local path) -> File id, or None if the path has no File.
+
+    Ids rather than ORM objects are kept so a stale entry can never hand out a detached or deleted row.
+    The whole cache is dropped whenever a File is written to the database, and again once that write is
+    committed or rolled back. Every drop starts a new generation; lookups made in an earlier one are not stored.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None, False
+            return self._entries[key], True
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+
+_path_cache = PathCache(settings.DB_PATH_CACHE_SIZE)
+
+
+def _files_written(session):
+    # Other threads keep reading the committed rows until the session commits, and may cache them meanwhile
+    session.info['files_written'] = True
+    _path_cache.clear()
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _invalidate_path_cache(session, flush_context):
+    if any(isinstance(obj, models.File) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        _files_written(session)
+
+
+@event.listens_for(OrmSession, 'after_bulk_update')
+@event.listens_for(OrmSession, 'after_bulk_delete')
+def _invalidate_path_cache_bulk(context):
+    if context.mapper is None or context.mapper.class_ is models.File:
+        _files_written(context.session)
+
+
+@event.listens_for(OrmSession, 'after_commit')
+@event.listens_for(OrmSession, 'after_rollback')
+def _settle_path_cache(session):
+    if session.info.pop('files_written', False):
+        _path_cache.clear()
+
+
+def resolve_path(local, node):
+    """
+    Find the File stored at a local path with one indexed (node_id, parent_id, name) lookup per path component
+
+    :param local: Absolute local path, as a str or pathlib.Path
+    :param models.Node node: The node containing local
+    :return: The models.File, or None if there is no such File
+    """
+    local = str(local).rstrip(os.path.sep)
+    key = (node.id, local)
+    generation = _path_cache.generation
     with Session() as session:
-        db = session.query(models.File).filter(models.File.parent == None, models.File.node == node).one()  # noqa
-    parts = str(local).replace(node.path, '').split(os.path.sep)
-    for part in parts:
-        for child in db.children:
-            if child.name == part:
-                db = child
-    if db.path.rstrip(os.path.sep) != str(local).rstrip(os.path.sep) or (check_is_folder and db.is_folder != (local.is_dir() or is_folder)):
+        file_id, hit = _path_cache.get(key)
+        if hit:
+            if file_id is None:
+                return None
+            db = session.query(models.File).get(file_id)
+            if db is not None:
+                return db
+
+        file_id = None
+        parts = local[len(node.path):].split(os.path.sep) if local.startswith(node.path + os.path.sep) else []
+        # parts[0] is the empty string before the leading separator
+        if parts[1:2] == [settings.OSF_STORAGE_FOLDER]:
+            file_id = session.query(models.File.id).filter(
+                models.File.node_id == node.id,
+                models.File.parent_id == None  # noqa
+            ).limit(1).scalar()
+            for part in parts[2:]:
+                if file_id is None:
+                    break
+                file_id = session.query(models.File.id).filter(
+                    models.File.node_id == node.id,
+                    models.File.parent_id == file_id,
+                    models.File.name == part
+                ).limit(1).scalar()
+        if not session.info.get('files_written'):
+            # Otherwise what was found may only be visible to this session, until it commits
+            _path_cache.put(key, file_id, generation)
+        return session.query(models.File).get(file_id) if file_id else None
+
+
+def local_to_db(local, node, *, is_folder=False, check_is_folder=True):
+    db = resolve_path(local, node)
+    if db is None or (check_is_folder and db.is_folder != (local.is_dir() or is_folder)):
         return None
     return db
 
@@ -86,8 +198,8 @@ def db_to_remote(db):
     from osfsync.client import osf
 
     if db.parent is None:
-        return _remote_root(db)
-    return osf.StorageObject.load(osf.OSFClient().request_session, db.id)
+        return osf.RemoteCache().get(('storage', db.node.id, db.provider), lambda: _remote_root(db))
+    return osf.RemoteCache().get(('files', db.id), lambda: osf.StorageObject.load(osf.OSFClient().request_session, db.id))
 
 
 def _remote_root(db):
@@ -102,3 +214,45 @@ def _remote_root(db):
 
 def is_ignored(name):
     return IGNORE_RE.match(name) is not None
+
+
+# A single item found by walk_local. stat is only populated for files.
+LocalEntry = namedtuple('LocalEntry', ['rel_path', 'is_dir', 'stat'])
+
+
+def walk_local(root, *, base):
+    """
+    Iteratively yield a LocalEntry for every file and folder below root, skipping ignored names.
+
+    Ignored folders are pruned before they are descended into. Folder vs file is decided from the
+    information os.scandir already has, so only files incur a stat call.
+
+    :param str root: Folder to walk; it is not itself yielded
+    :param str base: Prefix of root, ending in a path separator, that rel_paths are relative to
+    :return: generator of LocalEntry. Folder rel_paths end in a path separator
+    """
+    offset = len(base)
+    stack = [str(root)]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = os.scandir(folder)
+        except (FileNotFoundError, PermissionError) as e:
+            # Removed, or made unreadable, since its parent was listed
+            logger.info('Skipping {} ({})'.format(folder, e))
+            continue
+        with entries:
+            for entry in entries:
+                # Ignore matches full paths
+                if is_ignored(entry.path):
+                    continue
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    yield LocalEntry(entry.path[offset:] + os.path.sep, True, None)
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    # Removed since the directory was listed
+                    continue
+                yield LocalEntry(entry.path[offset:], False, st)
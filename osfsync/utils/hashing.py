@@ -0,0 +1,235 @@
+"""Hashing of local files: a persistent cache so unchanged files are never re-read, and a shared
+pool of hashing threads so the files that did change are read in parallel"""
+from concurrent.futures import Future
+import enum
+import itertools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from osfsync import settings
+from osfsync.utils import Singleton
+from osfsync.utils import hash_file
+
+logger = logging.getLogger(__name__)
+
+
+# Files modified within this many seconds of being hashed are not cached. Filesystems with coarse
+# timestamps could otherwise record a hash for content that is rewritten within the same tick.
+RACY_WINDOW = 2
+
+
+def stat_key(st):
+    """
+    The identity of a file's content as far as the filesystem can tell us without reading it
+
+    :param os.stat_result st:
+    :return tuple: (device, inode, size, mtime_ns, ctime_ns)
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache(metaclass=Singleton):
+    """
+    SHA256 hashes of local files keyed on (device, inode, size, mtime_ns, ctime_ns).
+
+    Stored in its own sqlite file next to the osf.db database. Everything in here can be recomputed,
+    so writes are not synced to disk and are only committed every COMMIT_EVERY entries or on flush.
+    """
+
+    COMMIT_EVERY = 500
+
+    def __init__(self, path=None):
+        self.path = path or settings.PROJECT_HASH_CACHE_FILE
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            '  device INTEGER NOT NULL,'
+            '  inode INTEGER NOT NULL,'
+            '  size INTEGER NOT NULL,'
+            '  mtime_ns INTEGER NOT NULL,'
+            '  ctime_ns INTEGER NOT NULL,'
+            '  sha256 TEXT NOT NULL,'
+            '  PRIMARY KEY (device, inode)'
+            ')'
+        )
+        self._conn.commit()
+
+    def lookup(self, st):
+        """
+        Return the cached hash for a file, or None if the file has changed since it was hashed
+
+        :param os.stat_result st:
+        """
+        if not st.st_ino:
+            # Some filesystems (network shares, FAT) do not expose stable inode numbers
+            return None
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT size, mtime_ns, ctime_ns, sha256 FROM hashes WHERE device = ? AND inode = ?',
+                    (st.st_dev, st.st_ino)
+                ).fetchone()
+        except OverflowError:
+            return None
+        if row is None or tuple(row[:3]) != stat_key(st)[2:]:
+            return None
+        return row[3]
+
+    def store(self, st, sha256):
+        """
+        Remember the hash of a file's content as of the given stat result
+
+        :param os.stat_result st:
+        :param str sha256:
+        """
+        if not st.st_ino or time.time() - st.st_mtime < RACY_WINDOW:
+            return
+        try:
+            with self._lock:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO hashes (device, inode, size, mtime_ns, ctime_ns, sha256) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    stat_key(st) + (sha256,)
+                )
+                self._uncommitted += 1
+                if self._uncommitted >= self.COMMIT_EVERY:
+                    self._commit()
+        except OverflowError:
+            logger.debug('Inode of {} is too large to cache'.format(st))
+
+    def hash(self, path, *, st=None):
+        """
+        Return the SHA256 hash of a file, only reading it if it has changed since it was last hashed
+
+        :param pathlib.Path path:
+        :param os.stat_result st: A stat of path the caller already has on hand, if any
+        :return str:
+        """
+        path = Path(path)
+        st = st or os.stat(str(path))
+        sha256 = self.lookup(st)
+        if sha256 is not None:
+            return sha256
+
+        sha256 = hash_file(path)
+        # Only trust the hash if nothing touched the file while it was being read
+        if stat_key(os.stat(str(path))) == stat_key(st):
+            self.store(st, sha256)
+        return sha256
+
+    def record(self, path, sha256):
+        """
+        Seed the cache with a hash computed elsewhere, i.e. while the file was being written
+
+        :param pathlib.Path path:
+        :param str sha256:
+        """
+        self.store(os.stat(str(path)), sha256)
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if self._uncommitted:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+        del type(self.__class__)._instances[self.__class__]
+
+
+class Priority(enum.IntEnum):
+    """Order in which queued hashes are computed; lower values go first"""
+    # Something is waiting on the result to make a sync decision, i.e. a watchdog event or conflict
+    URGENT = 0
+    # Part of a bulk scan, such as an audit of every local file
+    BATCH = 1
+
+
+class HashPool(metaclass=Singleton):
+    """
+    A bounded pool of threads shared by everything that hashes local files.
+
+    hashlib releases the GIL while digesting, so threads are enough to spread the work over every
+    core. Urgent requests jump ahead of any batch work already queued. Hashes already in the
+    HashCache are resolved immediately without touching the queue.
+    """
+
+    def __init__(self, *, workers=None):
+        self._workers = workers or settings.HASH_WORKERS
+        self._queue = queue.PriorityQueue()
+        # Keeps equal priorities first in, first out and ensures futures are never compared
+        self._counter = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, path, *, priority=Priority.BATCH, st=None):
+        """
+        Schedule a file to be hashed
+
+        :param pathlib.Path path:
+        :param Priority priority:
+        :param os.stat_result st: A stat of path the caller already has on hand, if any
+        :return concurrent.futures.Future: Resolves to the SHA256 hex digest of the file
+        """
+        future = Future()
+        try:
+            st = st or os.stat(str(path))
+        except OSError as e:
+            future.set_exception(e)
+            return future
+
+        sha256 = HashCache().lookup(st)
+        if sha256 is not None:
+            future.set_result(sha256)
+            return future
+
+        self._ensure_started()
+        self._queue.put((priority, next(self._counter), path, st, future))
+        return future
+
+    def map(self, paths, *, priority=Priority.BATCH):
+        """
+        Schedule a batch of files to be hashed
+
+        :param iterable paths:
+        :param Priority priority:
+        :return list: A future for each path, in the same order
+        """
+        return [self.submit(path, priority=priority) for path in paths]
+
+    def hash(self, path, *, priority=Priority.URGENT):
+        """Hash a single file, blocking until the result is available"""
+        return self.submit(path, priority=priority).result()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._work, name='HashPool-{}'.format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            _, _, path, st, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(HashCache().hash(path, st=st))
+            except Exception as e:
+                future.set_exception(e)
@@ -63,3 +63,97 @@ def wipe(ctx, hard=True):
     else:
         print("rm '{0}'".format(settings.PROJECT_DB_FILE))
         print("rm '{0}'".format(settings.PROJECT_LOG_FILE))
+
+
+@task
+def db_benchmark(ctx, readers=4, seconds=5, rows=2000):
+    """
+    Measure database lookups per second while a writer commits continuously, with a single lock-guarded
+    session (how OSF Sync used to share the database) and with per-thread sessions on a WAL database
+
+    :param int readers: Number of reader threads
+    :param int seconds: Duration of each run
+    :param int rows: Number of files in the benchmark database
+    """
+    import contextlib
+    import random
+    import tempfile
+    import threading
+    import time
+
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from sqlalchemy.pool import QueuePool
+
+    tmpdir = tempfile.TemporaryDirectory()
+    # Importing osfsync.database opens, creates and migrates the database in settings; keep the real one out of it
+    settings.PROJECT_DB_FILE = os.path.join(tmpdir.name, 'osf.db')
+    from osfsync import database
+    from osfsync.database.models import Base, File, Node, User
+
+    def setup(path):
+        engine = create_engine('sqlite:///{}'.format(path))
+        Base.metadata.create_all(engine)
+        engine.execute(User.__table__.insert(), id='user', full_name='', login='', oauth_token='')
+        engine.execute(Node.__table__.insert(), id='node', user_id='user', sync=True, title='node')
+        engine.execute(File.__table__.insert(), [
+            dict(id=str(i), name=str(i), kind=File.FILE, provider='osfstorage', user_id='user', node_id='node',
+                 rel_path=str(i))
+            for i in range(rows)
+        ])
+        engine.dispose()
+
+    def run(sessions, lock):
+        stop = threading.Event()
+        counts = []
+
+        def read():
+            count = 0
+            while not stop.is_set():
+                with lock:
+                    session = sessions()
+                    session.query(File).filter(File.rel_path == str(random.randrange(rows))).one()
+                    session.commit()
+                count += 1
+            counts.append(count)
+
+        def write():
+            while not stop.is_set():
+                with lock:
+                    session = sessions()
+                    session.query(File).filter(File.id == str(random.randrange(rows))).update({'size': random.randrange(1 << 20)})
+                    session.commit()
+
+        threads = [threading.Thread(target=read) for _ in range(readers)] + [threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / seconds
+
+    with tmpdir:
+        path = os.path.join(tmpdir.name, 'shared.db')
+        setup(path)
+        engine = create_engine('sqlite:///{}'.format(path), connect_args={'check_same_thread': False})
+        shared = sessionmaker(bind=engine)()
+        before = run(lambda: shared, threading.RLock())
+        engine.dispose()
+
+        path = os.path.join(tmpdir.name, 'wal.db')
+        setup(path)
+        engine = create_engine(
+            'sqlite:///{}'.format(path),
+            connect_args={'check_same_thread': False, 'timeout': settings.DB_BUSY_TIMEOUT},
+            poolclass=QueuePool,
+            pool_size=readers + 1,
+        )
+        event.listen(engine, 'connect', database._configure_connection)
+        # suppress() with no arguments stands in for a lock that is never taken
+        after = run(scoped_session(sessionmaker(bind=engine)), contextlib.suppress())
+        engine.dispose()
+        database.engine.dispose()
+
+    print('Shared session, rollback journal: {:10.1f} lookups/s'.format(before))
+    print('Per-thread sessions, WAL:         {:10.1f} lookups/s'.format(after))
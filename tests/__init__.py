@@ -4,3 +4,4 @@ from osfsync import settings
 
 # override the default database name when running tests
 settings.PROJECT_DB_FILE = os.path.join(settings.PROJECT_DB_DIR, 'test.db')
+settings.PROJECT_HASH_CACHE_FILE = os.path.join(settings.PROJECT_DB_DIR, 'test-hashes.db')
@@ -1,8 +1,19 @@
+import os
 from pathlib import Path
+from unittest import mock
 
+import pytest
+
+from osfsync import settings
+from osfsync.database import Session
+from osfsync.database.models import Node
+from osfsync.sync.ext import auditor
 from osfsync.sync.ext.auditor import Audit
 from osfsync.sync.ext.auditor import Auditor
+from osfsync.sync.ext.dirty import DirtyJournal
 from osfsync.utils import EventType
+from osfsync.utils import hash_file
+from osfsync.utils import walk_local
 
 from tests.base import OSFOTestBase
 
@@ -59,3 +70,34 @@ class TestAuditor(OSFOTestBase):
         assert len(changes[EventType.DELETE]) == 0
         assert str(mock_paths[0]) in changes[EventType.CREATE]
         assert str(mock_paths[3]) in changes[EventType.CREATE]
+
+
+class TestCollectLocal(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_journal(self, initdir):
+        type(DirtyJournal)._instances.pop(DirtyJournal, None)
+        yield
+        type(DirtyJournal)._instances.pop(DirtyJournal, None)
+
+    def test_file_deleted_after_walk_is_skipped(self):
+        with Session() as session:
+            node = session.query(Node).filter(Node.sync).first()
+            storage = os.path.join(node.path, settings.OSF_STORAGE_FOLDER)
+        doomed = os.path.join(storage, 'doomed.txt')
+        kept = os.path.join(storage, 'kept.txt')
+        os.makedirs(storage, exist_ok=True)
+        self._make_dummy_file(doomed)
+        self._make_dummy_file(kept)
+
+        def walk_then_delete(*args, **kwargs):
+            entries = list(walk_local(*args, **kwargs))
+            if os.path.exists(doomed):
+                os.remove(doomed)
+            return iter(entries)
+
+        with mock.patch.object(auditor, 'walk_local', walk_then_delete):
+            local_map = Auditor().collect_all_local({})
+        assert not any(path.endswith('doomed.txt') for path in local_map)
+        assert local_map[kept[len(str(self.root_dir)) + 1:]].sha256 == hash_file(Path(kept))
+        assert list(DirtyJournal().snapshot()) == [storage]
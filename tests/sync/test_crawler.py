@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+
+import pytest
+
+from osfsync.client.osf import RemoteCache
+from osfsync.sync.ext.crawler import RemoteCrawler
+from osfsync.sync.ext.crawler import walk_nodes
+
+from tests.utils import fail_after
+
+
+class FakeStorageObject:
+
+    def __init__(self, name, kind='file', children=(), parent=None, error=None):
+        self.id = 'id-{}'.format(name)
+        self.name = name
+        self.kind = kind
+        self.provider = 'osfstorage'
+        self.parent = parent
+        self.extra = {'hashes': {'sha256': 'sha-{}'.format(name)}}
+        self._children = list(children)
+        self._error = error
+        for child in self._children:
+            child.parent = self
+
+    def get_children(self, **kwargs):
+        if self._error:
+            raise self._error
+        return self._children
+
+
+def Folder(name, *children, **kwargs):
+    return FakeStorageObject(name, kind='folder', children=children, **kwargs)
+
+
+def File(name):
+    return FakeStorageObject(name)
+
+
+def crawl(*roots, workers=3):
+    crawler = RemoteCrawler(workers=workers).start()
+    for node_id, root in roots:
+        crawler.add(node_id, root, node_id)
+    crawler.close()
+    return crawler.join()
+
+
+class TestRemoteCrawler:
+
+    @pytest.fixture(autouse=True)
+    def z_cache(self):
+        type(RemoteCache)._instances.pop(RemoteCache, None)
+        yield
+        type(RemoteCache)._instances.pop(RemoteCache, None)
+
+    @fail_after(timeout=5)
+    def test_crawl(self):
+        root = Folder('root', File('a.txt'), Folder('data', File('b.csv'), Folder('empty')), File('.DS_Store'))
+        crawler = crawl(('node', root))
+
+        assert set(crawler.results) == {
+            'node' + os.path.sep,
+            os.path.join('node', 'a.txt'),
+            os.path.join('node', 'data', ''),
+            os.path.join('node', 'data', 'b.csv'),
+            os.path.join('node', 'data', 'empty', ''),
+        }
+        assert crawler.results[os.path.join('node', 'data', 'b.csv')][:2] == ('id-b.csv', 'sha-b.csv')
+        assert crawler.stats.folders == 3
+        assert crawler.stats.files == 2
+        assert not crawler.failed
+
+    @fail_after(timeout=5)
+    def test_found_objects_are_cached(self):
+        root = Folder('root', File('a.txt'), Folder('data', File('b.csv')))
+        crawl(('node', root))
+
+        def load():
+            raise AssertionError('Should have been cached')
+        assert RemoteCache().get(('files', 'id-b.csv'), load).name == 'b.csv'
+        assert RemoteCache().get(('files', 'id-data'), load).kind == 'folder'
+        assert RemoteCache().get(('storage', 'node', 'osfstorage'), load) is root
+        assert RemoteCache().hits == 3
+
+    @fail_after(timeout=5)
+    def test_failed_folder_does_not_hang(self):
+        broken = Folder('broken', error=ValueError('Server error'))
+        crawler = crawl(
+            ('bad', Folder('root', broken, Folder('fine', File('c.txt')))),
+            ('good', Folder('root', File('d.txt'))),
+        )
+
+        assert crawler.failed == {'bad'}
+        assert list(crawler.stats.errors) == [os.path.join('bad', 'broken')]
+        assert os.path.join('bad', 'fine', 'c.txt') in crawler.results
+        assert os.path.join('good', 'd.txt') in crawler.results
+
+    @fail_after(timeout=5)
+    def test_nothing_to_crawl(self):
+        crawler = crawl()
+        assert crawler.results == {}
+        assert crawler.stats.wall_time >= 0
+
+
+class TestWalkNodes:
+
+    TREE = {
+        'project': ['a', 'b'],
+        'a': ['a1', 'a2'],
+        'b': ['b1'],
+        'a1': ['a1x'],
+    }
+
+    def _parents(self):
+        return {child: parent for parent, children in self.TREE.items() for child in children}
+
+    @fail_after(timeout=5)
+    def test_parents_are_visited_first(self):
+        parents = self._parents()
+        seen = []
+        for visit in walk_nodes(['project'], lambda item: (item.upper(), self.TREE.get(item, [])), workers=3):
+            assert visit.error is None
+            assert visit.value == visit.item.upper()
+            assert visit.item == 'project' or parents[visit.item] in seen
+            seen.append(visit.item)
+        assert sorted(seen) == sorted(['project', 'a', 'b', 'a1', 'a2', 'b1', 'a1x'])
+
+    @fail_after(timeout=5)
+    def test_error_skips_descendants(self):
+        def expand(item):
+            if item == 'a':
+                raise ValueError('Server error')
+            return None, self.TREE.get(item, [])
+
+        visits = {visit.item: visit for visit in walk_nodes(['project'], expand, workers=2)}
+        assert set(visits) == {'project', 'a', 'b', 'b1'}
+        assert isinstance(visits['a'].error, ValueError)
+
+    @fail_after(timeout=5)
+    def test_fan_out_is_bounded(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def expand(item):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return None, ['{}.{}'.format(item, i) for i in range(4)] if len(item) < 5 else []
+
+        assert len(list(walk_nodes(['r'], expand, workers=3))) == 1 + 4 + 16
+        assert active[1] == 3
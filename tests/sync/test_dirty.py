@@ -0,0 +1,112 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from osfsync import settings
+from osfsync.sync.ext.auditor import Audit
+from osfsync.sync.ext.auditor import Auditor
+from osfsync.sync.ext.dirty import DirtyJournal
+from osfsync.utils import hash_file
+
+from tests.base import OSFOTestBase
+
+
+class TestDirtyJournal(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_journal(self, request):
+        type(DirtyJournal)._instances.pop(DirtyJournal, None)
+        self.journal = DirtyJournal()
+        request.addfinalizer(lambda: type(DirtyJournal)._instances.pop(DirtyJournal, None))
+
+    def test_mark_keeps_outermost_folder(self):
+        base = os.path.join(str(self.root_dir), 'project')
+        self.journal.mark(os.path.join(base, 'a', 'b'))
+        self.journal.mark(os.path.join(base, 'a', 'c'))
+        self.journal.mark(os.path.join(base, 'a'))
+        self.journal.mark(os.path.join(base, 'a', 'd'))
+        assert set(self.journal.snapshot()) == {os.path.join(base, 'a')}
+
+    def test_mark_does_not_confuse_prefixes(self):
+        base = os.path.join(str(self.root_dir), 'project')
+        self.journal.mark(os.path.join(base, 'a'))
+        self.journal.mark(os.path.join(base, 'ab'))
+        assert set(self.journal.snapshot()) == {os.path.join(base, 'a'), os.path.join(base, 'ab')}
+
+    def test_clear_keeps_folders_marked_after_snapshot(self):
+        base = os.path.join(str(self.root_dir), 'project')
+        self.journal.mark(os.path.join(base, 'a'))
+        self.journal.mark(os.path.join(base, 'b'))
+        snapshot = self.journal.snapshot()
+        self.journal.mark(os.path.join(base, 'b'))
+        self.journal.clear(snapshot)
+        assert set(self.journal.snapshot()) == set()
+
+        self.journal.mark(os.path.join(base, 'b', 'c'))
+        snapshot = self.journal.snapshot()
+        self.journal.mark(os.path.join(base, 'b'))
+        self.journal.clear(snapshot)
+        assert set(self.journal.snapshot()) == {os.path.join(base, 'b')}
+
+    def test_journal_is_persistent(self):
+        folder = os.path.join(str(self.root_dir), 'project', 'a')
+        self.journal.mark(folder)
+        type(DirtyJournal)._instances.pop(DirtyJournal)
+        assert set(DirtyJournal().snapshot()) == {folder}
+
+
+class TestIncrementalAudit(OSFOTestBase):
+
+    def _storage(self):
+        return os.path.join(str(self.root_dir), self.PROJECT_STRUCTURE[0]['rel_path'], settings.OSF_STORAGE_FOLDER)
+
+    def _snapshot(self, auditor):
+        acc, pending = {}, []
+        auditor._collect_node_local(self._storage(), acc, {}, pending)
+        for audit, future in pending:
+            audit.sha256 = future.result()
+        # Pretend the database is in sync with what is on disk
+        return {path: Audit(i, audit.sha256, path) for i, (path, audit) in enumerate(acc.items())}
+
+    def _collect(self, auditor, db_map):
+        acc, pending = {}, []
+        auditor._collect_node_local(self._storage(), acc, db_map, pending, sorted(db_map))
+        for audit, future in pending:
+            audit.sha256 = future.result()
+        return acc
+
+    def test_only_dirty_folders_are_rescanned(self):
+        db_map = self._snapshot(Auditor())
+        project = self.PROJECT_STRUCTURE[0]
+        dirty_folder = os.path.join(self._storage(), project['files'][0]['name'])
+        clean_folder = os.path.join(self._storage(), project['files'][1]['name'])
+        changed = os.path.join(dirty_folder, project['files'][0]['children'][0]['name'])
+
+        with open(changed, 'w') as fp:
+            fp.write('Changed')
+        self._make_dummy_file(os.path.join(clean_folder, 'unnoticed.txt'))
+
+        local_map = self._collect(Auditor(dirty={dirty_folder: 1}), db_map)
+        rel_changed = changed[len(str(self.root_dir)) + 1:]
+        assert local_map[rel_changed].sha256 == hash_file(Path(changed))
+        assert local_map[rel_changed].fid == db_map[rel_changed].fid
+        assert not any(path.endswith('unnoticed.txt') for path in local_map)
+        assert set(local_map) == set(db_map)
+
+    def test_deleted_dirty_folder_is_dropped(self):
+        db_map = self._snapshot(Auditor())
+        project = self.PROJECT_STRUCTURE[0]
+        dirty_folder = os.path.join(self._storage(), project['files'][0]['name'])
+        self.root_dir.join(dirty_folder[len(str(self.root_dir)) + 1:]).remove()
+
+        local_map = self._collect(Auditor(dirty={dirty_folder: 1}), db_map)
+        rel_folder = dirty_folder[len(str(self.root_dir)) + 1:]
+        assert not any(path.startswith(rel_folder) for path in local_map)
+        assert len(local_map) == len(db_map) - 2
+
+    def test_dirty_ancestor_rescans_everything(self):
+        db_map = self._snapshot(Auditor())
+        self._make_dummy_file(os.path.join(self._storage(), 'new.txt'))
+        local_map = self._collect(Auditor(dirty={str(self.root_dir): 1}), db_map)
+        assert len(local_map) == len(db_map) + 1
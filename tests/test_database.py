@@ -0,0 +1,342 @@
+import os
+from pathlib import Path
+import threading
+from unittest import mock
+
+import pytest
+from sqlalchemy import event
+
+from osfsync import settings
+from osfsync.database import backfill_paths
+from osfsync.database import close_session
+from osfsync.database import commit
+from osfsync.database import engine
+from osfsync.database import rebind
+from osfsync.database import reset_session
+from osfsync.database import Session
+from osfsync.database import WriteBatch
+from osfsync.database.models import File, JournalEntry, Node
+from osfsync.utils import local_to_db
+from osfsync.utils import _path_cache
+from osfsync.utils import resolve_path
+
+from tests.base import OSFOTestBase
+
+
+class TestMaterializedPaths(OSFOTestBase):
+
+    def _add(self, id, name, *, kind=File.FOLDER, parent=None):
+        with Session() as session:
+            session.add(File(
+                id=id,
+                name=name,
+                kind=kind,
+                provider='osfstorage',
+                user_id='fake_user_id',
+                node_id=self.PROJECT_STRUCTURE[0]['id'],
+                parent_id=parent
+            ))
+            session.commit()
+            return session.query(File).get(id)
+
+    def _tree(self):
+        self._add('root', 'osfstorage')
+        self._add('data', 'data', parent='root')
+        self._add('raw', 'raw', parent='data')
+        return self._add('lies', 'lies.csv', kind=File.FILE, parent='raw')
+
+    def _storage(self):
+        project = self.PROJECT_STRUCTURE[0]
+        return os.path.join('{} - {}'.format(project['name'], project['id']), settings.OSF_STORAGE_FOLDER)
+
+    def test_paths_are_stored(self):
+        lies = self._tree()
+        expected = os.path.join(self._storage(), 'data', 'raw', 'lies.csv')
+        assert lies.rel_path == expected
+        assert lies.pretty_path == os.path.join('data', 'raw', 'lies.csv')
+        with Session() as session:
+            assert session.query(File.id).filter(File.rel_path == expected).scalar() == 'lies'
+
+    def test_parent_in_same_flush(self):
+        with Session() as session:
+            for id, name, parent in (('root', 'osfstorage', None), ('data', 'data', 'root')):
+                session.add(File(
+                    id=id,
+                    name=name,
+                    kind=File.FOLDER,
+                    provider='osfstorage',
+                    user_id='fake_user_id',
+                    node_id=self.PROJECT_STRUCTURE[0]['id'],
+                    parent_id=parent
+                ))
+            session.commit()
+            assert session.query(File.rel_path).filter(File.id == 'data').scalar() == os.path.join(self._storage(), 'data', '')
+
+    def test_renaming_folder_moves_descendants(self):
+        self._tree()
+        with Session() as session:
+            data = session.query(File).get('data')
+            data.name = 'truth'
+            session.commit()
+            paths = dict(session.query(File.id, File.rel_path))
+
+        assert paths['data'] == os.path.join(self._storage(), 'truth', '')
+        assert paths['raw'] == os.path.join(self._storage(), 'truth', 'raw', '')
+        assert paths['lies'] == os.path.join(self._storage(), 'truth', 'raw', 'lies.csv')
+
+    def test_reparenting_by_id(self):
+        self._tree()
+        self._add('other', 'other', parent='root')
+        with Session() as session:
+            raw = session.query(File).get('raw')
+            raw.parent_id = 'other'
+            session.commit()
+            assert session.query(File).get('lies').rel_path == os.path.join(self._storage(), 'other', 'raw', 'lies.csv')
+
+    def test_renaming_node_moves_files(self):
+        self._tree()
+        with Session() as session:
+            node = session.query(Node).one()
+            node.title = 'Renamed'
+            session.commit()
+            storage = os.path.join('Renamed - {}'.format(node.id), settings.OSF_STORAGE_FOLDER)
+            assert session.query(File).get('lies').rel_path == os.path.join(storage, 'data', 'raw', 'lies.csv')
+
+    def test_backfill(self):
+        self._tree()
+        with Session() as session:
+            session.execute(File.__table__.update().values(rel_path=None))
+            session.commit()
+            session.expire_all()
+            backfill_paths(session)
+            assert session.query(File).filter(File.rel_path.is_(None)).count() == 0
+            assert session.query(File).get('lies').rel_path == os.path.join(self._storage(), 'data', 'raw', 'lies.csv')
+
+
+class TestResolvePath(OSFOTestBase):
+
+    def _add(self, id, name, *, kind=File.FOLDER, parent=None):
+        with Session() as session:
+            session.add(File(
+                id=id,
+                name=name,
+                kind=kind,
+                provider='osfstorage',
+                user_id='fake_user_id',
+                node_id=self.PROJECT_STRUCTURE[0]['id'],
+                parent_id=parent
+            ))
+            session.commit()
+
+    def _node(self):
+        with Session() as session:
+            return session.query(Node).one()
+
+    def _local(self, *parts):
+        return os.path.join(self._node().path, settings.OSF_STORAGE_FOLDER, *parts)
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_files(self, initdir):
+        self._add('root', 'osfstorage')
+        self._add('data', 'data', parent='root')
+        self._add('lies', 'lies.csv', kind=File.FILE, parent='data')
+        yield
+        # Nodes loaded here hold on to their User, which would clash with the next test's
+        with Session() as session:
+            session.expunge_all()
+
+    def test_resolve(self):
+        node = self._node()
+        assert resolve_path(self._local(), node).id == 'root'
+        assert resolve_path(self._local('data') + os.path.sep, node).id == 'data'
+        assert resolve_path(Path(self._local('data', 'lies.csv')), node).id == 'lies'
+        assert resolve_path(self._local('data', 'truth.csv'), node) is None
+        assert resolve_path(os.path.join(node.path, 'elsewhere', 'data'), node) is None
+
+    def test_local_to_db_checks_kind(self):
+        node = self._node()
+        assert local_to_db(Path(self._local('data', 'lies.csv')), node).id == 'lies'
+        assert local_to_db(Path(self._local('data', 'lies.csv')), node, is_folder=True) is None
+
+    def test_cache_is_invalidated_by_writes(self):
+        node = self._node()
+        path = self._local('data', 'truth.csv')
+        assert resolve_path(path, node) is None
+        self._add('truth', 'truth.csv', kind=File.FILE, parent='data')
+        assert resolve_path(path, node).id == 'truth'
+
+        with Session() as session:
+            session.query(File).get('truth').name = 'false.csv'
+            session.commit()
+        assert resolve_path(path, node) is None
+
+    def test_cache_is_invalidated_when_writes_are_committed(self):
+        node = self._node()
+        path = self._local('data', 'lies.csv')
+
+        def lookup():
+            # Another thread only sees what is committed
+            found = resolve_path(path, node)
+            close_session()
+            return found.id
+
+        with Session() as session:
+            session.query(File).get('lies').name = 'truth.csv'
+            session.flush()
+            thread = threading.Thread(target=lookup)
+            thread.start()
+            thread.join()
+            session.commit()
+        assert resolve_path(path, node) is None
+
+    def test_lookups_from_before_a_write_are_not_cached(self):
+        node = self._node()
+        path = self._local('data', 'lies.csv')
+        get = _path_cache.get
+
+        def get_then_commit_elsewhere(key):
+            found = get(key)
+            # Another thread's write lands while this lookup is made
+            _path_cache.clear()
+            return found
+
+        with mock.patch.object(_path_cache, 'get', get_then_commit_elsewhere):
+            assert resolve_path(path, node).id == 'lies'
+        assert _path_cache.get((node.id, path)) == (None, False)
+        assert resolve_path(path, node).id == 'lies'
+        assert _path_cache.get((node.id, path)) == ('lies', True)
+
+    def test_bulk_writes_to_other_tables_keep_the_cache(self):
+        node = self._node()
+        path = self._local('data', 'lies.csv')
+        resolve_path(path, node)
+        with Session() as session:
+            session.query(JournalEntry).delete()
+            session.commit()
+        assert _path_cache.get((node.id, path)) == ('lies', True)
+        with Session() as session:
+            session.query(File).filter(File.id == 'lies').update({'name': 'truth.csv'})
+            session.commit()
+        assert _path_cache.get((node.id, path)) == (None, False)
+
+    def test_cached_lookup_skips_queries(self):
+        node = self._node()
+        path = self._local('data', 'lies.csv')
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        # Keep a reference so the row stays in the session's identity map
+        lies = resolve_path(path, node)
+        assert lies.id == 'lies'
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            assert resolve_path(path, node) is lies
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        assert statements == []
+
+
+class TestThreadSessions(OSFOTestBase):
+
+    def _in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_wal(self):
+        with engine.connect() as con:
+            assert con.execute('PRAGMA journal_mode').scalar() == 'wal'
+
+    def test_threads_have_their_own_session(self):
+        def current():
+            with Session() as session:
+                return session
+
+        assert self._in_thread(current) is not current()
+
+    def test_rebind(self):
+        with Session() as session:
+            node = session.query(Node).one()
+
+        def rebound():
+            other = rebind(node)
+            with Session() as session:
+                return other is not node and other.id == node.id and other in session
+
+        assert self._in_thread(rebound)
+        assert rebind(node) is node
+
+    def test_reset_session_sees_other_threads(self):
+        with Session() as session:
+            node = session.query(Node).one()
+            assert node.title != 'Renamed'
+
+        def rename():
+            with Session() as session:
+                session.query(Node).one().title = 'Renamed'
+                session.commit()
+
+        self._in_thread(rename)
+        reset_session()
+        assert node.title == 'Renamed'
+
+
+class TestWriteBatch(OSFOTestBase):
+
+    def _create(self, id):
+        with Session() as session:
+            session.add(File(
+                id=id,
+                name=id,
+                kind=File.FOLDER,
+                provider='osfstorage',
+                user_id='fake_user_id',
+                node_id=self.PROJECT_STRUCTURE[0]['id'],
+            ))
+            commit(session)
+
+    def _committed(self):
+        # Counted on another thread, which only sees committed rows
+        result = []
+
+        def count():
+            with Session() as session:
+                result.append(session.query(File).count())
+            close_session()
+
+        thread = threading.Thread(target=count)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_commit_without_batch(self):
+        self._create('a')
+        assert self._committed() == 1
+
+    def test_batch_commits_when_full(self):
+        with WriteBatch(size=3, latency=60) as batch:
+            self._create('a')
+            self._create('b')
+            assert batch.pending == 2
+            assert self._committed() == 0
+            self._create('c')
+            assert batch.pending == 0
+            assert self._committed() == 3
+            self._create('d')
+        assert self._committed() == 4
+
+    def test_batch_commits_when_expired(self):
+        with WriteBatch(size=100, latency=0) as batch:
+            self._create('a')
+            assert batch.pending == 0
+        assert self._committed() == 1
+
+    def test_batched_rows_are_visible_to_their_thread(self):
+        with WriteBatch(size=100, latency=60):
+            self._create('a')
+            with Session() as session:
+                assert session.query(File).get('a').rel_path
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from osfsync.utils import hash_file
+from osfsync.utils.hashing import HashCache
+from osfsync.utils.hashing import HashPool
+from osfsync.utils.hashing import Priority
+
+
+@pytest.fixture
+def cache(tmpdir):
+    cache = HashCache(path=str(tmpdir.join('hashes.db')))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def pool(cache):
+    pool = HashPool(workers=1)
+    yield pool
+    del type(HashPool)._instances[HashPool]
+
+
+def _old_file(tmpdir, name, content):
+    path = tmpdir.join(name)
+    path.write(content)
+    # Push the mtime outside of the racy window so the hash is allowed into the cache
+    stamp = time.time() - 60
+    os.utime(str(path), (stamp, stamp))
+    return path
+
+
+def test_hash_matches_hash_file(cache, tmpdir):
+    path = _old_file(tmpdir, 'data.csv', 'a,b,c')
+    assert cache.hash(str(path)) == hash_file(path)
+
+
+def test_unchanged_file_is_not_reread(cache, tmpdir):
+    path = _old_file(tmpdir, 'data.csv', 'a,b,c')
+    expected = cache.hash(str(path))
+    with mock.patch('osfsync.utils.hashing.hash_file') as hash_mock:
+        assert cache.hash(str(path)) == expected
+        assert not hash_mock.called
+
+
+def test_modified_file_is_rehashed(cache, tmpdir):
+    path = _old_file(tmpdir, 'data.csv', 'a,b,c')
+    cache.hash(str(path))
+    path.write('d,e,f')
+    assert cache.hash(str(path)) == hash_file(path)
+
+
+def test_recently_modified_file_is_not_cached(cache, tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write('a,b,c')
+    cache.hash(str(path))
+    assert cache.lookup(os.stat(str(path))) is None
+
+
+def test_record_seeds_cache(cache, tmpdir):
+    path = _old_file(tmpdir, 'data.csv', 'a,b,c')
+    cache.record(str(path), 'precomputed')
+    assert cache.hash(str(path)) == 'precomputed'
+
+
+def test_cache_persists(tmpdir):
+    path = _old_file(tmpdir, 'data.csv', 'a,b,c')
+    cache = HashCache(path=str(tmpdir.join('hashes.db')))
+    expected = cache.hash(str(path))
+    cache.close()
+
+    cache = HashCache(path=str(tmpdir.join('hashes.db')))
+    try:
+        assert cache.lookup(os.stat(str(path))) == expected
+    finally:
+        cache.close()
+
+
+def test_pool_map_preserves_order(pool, tmpdir):
+    paths = [tmpdir.join('{}.txt'.format(i)) for i in range(10)]
+    for i, path in enumerate(paths):
+        path.write(str(i))
+    futures = pool.map(str(path) for path in paths)
+    assert [f.result(timeout=5) for f in futures] == [hash_file(path) for path in paths]
+
+
+def test_pool_reports_missing_files(pool, tmpdir):
+    with pytest.raises(FileNotFoundError):
+        pool.hash(str(tmpdir.join('missing.txt')))
+
+
+def test_pool_urgent_jumps_queue(pool, tmpdir):
+    paths = [tmpdir.join('{}.txt'.format(i)) for i in range(4)]
+    for i, path in enumerate(paths):
+        path.write(str(i))
+
+    order = []
+    release = threading.Event()
+    real_hash = HashCache.hash
+
+    def slow_hash(self, path, **kwargs):
+        release.wait(timeout=5)
+        order.append(os.path.basename(str(path)))
+        return real_hash(self, path, **kwargs)
+
+    with mock.patch.object(HashCache, 'hash', slow_hash):
+        # The single worker picks up the first file and blocks; everything else is queued behind it
+        futures = pool.map(str(path) for path in paths[:3])
+        time.sleep(0.1)
+        urgent = pool.submit(str(paths[3]), priority=Priority.URGENT)
+        release.set()
+        urgent.result(timeout=5)
+        for future in futures:
+            future.result(timeout=5)
+
+    assert order == ['0.txt', '3.txt', '1.txt', '2.txt']
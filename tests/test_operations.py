@@ -0,0 +1,213 @@
+import http.client
+import os
+from pathlib import Path
+import threading
+from unittest import mock
+
+import pytest
+
+from osfsync import settings
+from osfsync.client import osf as osf_client
+from osfsync.database import close_session
+from osfsync.database import Session
+from osfsync.database.models import File
+from osfsync.database.models import Node
+from osfsync.tasks import operations
+from osfsync.tasks import transfers
+from osfsync.tasks.operations import OperationContext
+from osfsync.tasks.transfers import TransferStats
+from osfsync.utils import hash_file
+
+from tests.base import OSFOTestBase
+
+
+class TestTransfers(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_files(self, initdir):
+        type(TransferStats)._instances.pop(TransferStats, None)
+        type(osf_client.RemoteCache)._instances.pop(osf_client.RemoteCache, None)
+        with Session() as session:
+            self.node = session.query(Node).one()
+        self.local = Path(os.path.join(self.node.path, settings.OSF_STORAGE_FOLDER, 'notes.txt'))
+        os.makedirs(str(self.local.parent), exist_ok=True)
+        self._make_dummy_file(str(self.local))
+        self.sha256 = hash_file(self.local)
+
+        with Session() as session:
+            for id, name, kind, parent in (('root', 'osfstorage', File.FOLDER, None), ('notes', 'notes.txt', File.FILE, 'root')):
+                session.add(File(
+                    id=id,
+                    name=name,
+                    kind=kind,
+                    provider='osfstorage',
+                    user_id='fake_user_id',
+                    node_id=self.node.id,
+                    parent_id=parent,
+                    sha256=self.sha256 if kind == File.FILE else None,
+                    size=self.local.stat().st_size if kind == File.FILE else None,
+                ))
+            session.commit()
+        # The files here are tiny
+        with mock.patch.object(settings, 'SERVER_COPY_MIN_SIZE', 0):
+            yield
+        with Session() as session:
+            session.expunge_all()
+
+    def _data(self, sha256, *, id='notes', name='notes.txt'):
+        return {
+            'id': id,
+            'type': 'files',
+            'attributes': {
+                'name': name,
+                'kind': 'file',
+                'provider': 'osfstorage',
+                'size': 43,
+                'extra': {'hashes': {'sha256': sha256, 'md5': 'new md5'}},
+            },
+            'links': {'download': 'https://files.example/notes'},
+        }
+
+    def _remote(self, sha256, **kwargs):
+        remote = osf_client.File(None, self._data(sha256, **kwargs))
+        with Session() as session:
+            remote.parent = session.query(File).get('root')
+        return remote
+
+    def test_unchanged_file_is_not_uploaded(self):
+        with mock.patch.object(transfers, 'upload') as upload:
+            operations.RemoteUpdateFile(OperationContext(local=self.local, node=self.node)).run()
+        assert not upload.called
+        assert TransferStats().skipped_uploads == 1
+
+    def test_unchanged_file_is_not_downloaded(self):
+        with mock.patch.object(transfers, 'download') as download:
+            operations.LocalUpdateFile(OperationContext(remote=self._remote(self.sha256), node=self.node)).run()
+        assert not download.called
+        assert TransferStats().skipped_downloads == 1
+        with Session() as session:
+            # The metadata is still brought up to date
+            assert session.query(File).get('notes').md5 == 'new md5'
+
+    def test_changed_file_is_downloaded(self):
+        with mock.patch.object(transfers, 'download') as download, mock.patch.object(operations, 'Notification'):
+            operations.LocalUpdateFile(OperationContext(remote=self._remote('a newer version'), node=self.node)).run()
+        assert download.call_args[0] == ('https://files.example/notes', str(self.local))
+        assert TransferStats().skipped_downloads == 0
+
+    def test_known_content_is_copied_locally(self):
+        with mock.patch.object(transfers, 'download') as download, mock.patch.object(operations, 'Notification'):
+            operations.LocalCreateFile(OperationContext(remote=self._remote(self.sha256, id='twin', name='twin.txt'), node=self.node)).run()
+        assert not download.called
+        assert (self.local.parent / 'twin.txt').read_bytes() == self.local.read_bytes()
+        assert TransferStats().reused == 1
+        with Session() as session:
+            assert session.query(File).get('twin').sha256 == self.sha256
+
+    def test_modified_copy_is_not_reused(self):
+        self.local.write_text('Changed since it was synced')
+        with mock.patch.object(transfers, 'download') as download, mock.patch.object(operations, 'Notification'):
+            operations.LocalCreateFile(OperationContext(remote=self._remote(self.sha256, id='twin', name='twin.txt'), node=self.node)).run()
+        assert download.called
+        assert TransferStats().reused == 0
+
+    def _duplicate(self):
+        duplicate = self.local.parent / 'copy of notes.txt'
+        duplicate.write_bytes(self.local.read_bytes())
+        return duplicate
+
+    def test_duplicate_is_copied_on_server(self):
+        duplicate = self._duplicate()
+        resp = mock.Mock(status_code=http.client.CREATED)
+        resp.json.return_value = {'data': self._data(self.sha256, id='osfstorage/copied', name=duplicate.name)}
+        with mock.patch.object(operations, 'OSFClient') as client, mock.patch.object(transfers, 'upload') as upload, \
+                mock.patch.object(operations, 'Notification'):
+            client.return_value.request.return_value = resp
+            operations.RemoteCreateFile(OperationContext(local=duplicate, node=self.node)).run()
+
+        assert not upload.called
+        method, url = client.return_value.request.call_args[0]
+        assert (method, url.rsplit('/', 2)[1:]) == ('POST', ['osfstorage', 'notes'])
+        assert client.return_value.request.call_args[1]['json']['action'] == 'copy'
+        assert client.return_value.request.call_args[1]['json']['conflict'] == 'warn'
+        assert TransferStats().copied == 1
+        with Session() as session:
+            assert session.query(File).get('copied').name == duplicate.name
+
+    def test_failed_copy_falls_back_to_upload(self):
+        duplicate = self._duplicate()
+        sent = transfers.Sent(mock.Mock(status_code=http.client.CREATED), self.sha256, duplicate.stat())
+        sent.resp.json.return_value = {'data': self._data(self.sha256, id='osfstorage/uploaded', name=duplicate.name)}
+        with mock.patch.object(operations, 'OSFClient') as client, \
+                mock.patch.object(transfers, 'upload', return_value=sent) as upload, \
+                mock.patch.object(operations, 'Notification'):
+            client.return_value.request.return_value = mock.Mock(status_code=http.client.CONFLICT)
+            operations.RemoteCreateFile(OperationContext(local=duplicate, node=self.node)).run()
+
+        assert upload.called
+        assert TransferStats().copied == 0
+        with Session() as session:
+            assert session.query(File).get('uploaded').name == duplicate.name
+
+    def test_file_of_unknown_size_is_not_hashed_before_upload(self):
+        other = self.local.parent / 'other.txt'
+        other.write_text('Nothing tracked is this long')
+        with mock.patch.object(operations, 'HashPool') as pool, mock.patch.object(operations, 'OSFClient') as client:
+            assert not operations.RemoteCreateFile(OperationContext(local=other, node=self.node))._copy_on_server(None)
+        assert not pool.called
+        assert not client.called
+
+    def test_small_duplicate_is_uploaded_without_hashing(self):
+        duplicate = self._duplicate()
+        with mock.patch.object(settings, 'SERVER_COPY_MIN_SIZE', duplicate.stat().st_size + 1), \
+                mock.patch.object(operations, 'HashPool') as pool, mock.patch.object(operations, 'OSFClient') as client:
+            assert not operations.RemoteCreateFile(OperationContext(local=duplicate, node=self.node))._copy_on_server(None)
+        assert not pool.called
+        assert not client.called
+
+    def test_copy_replacing_a_file_is_not_accepted(self):
+        duplicate = self._duplicate()
+        with mock.patch.object(operations, 'OSFClient') as client:
+            client.return_value.request.return_value = mock.Mock(status_code=http.client.OK)
+            with Session() as session:
+                parent = session.query(File).get('root')
+            assert not operations.RemoteCreateFile(OperationContext(local=duplicate, node=self.node))._copy_on_server(parent)
+        assert TransferStats().copied == 0
+
+    def test_remote_comes_from_crawl(self):
+        remote = self._remote(self.sha256)
+        osf_client.RemoteCache().put(('files', 'notes'), remote)
+        with Session() as session:
+            db = session.query(File).get('notes')
+        with mock.patch.object(osf_client.StorageObject, 'load') as load:
+            assert OperationContext(db=db, node=self.node).remote is remote
+        assert not load.called
+
+    def test_uploaded_file_is_forgotten(self):
+        osf_client.RemoteCache().put(('files', 'notes'), self._remote(self.sha256))
+        self.local.write_text('Changed since it was synced')
+        sent = transfers.Sent(mock.Mock(status_code=http.client.OK), 'new', self.local.stat())
+        sent.resp.json.return_value = {'data': self._data('new')}
+        with mock.patch.object(transfers, 'upload', return_value=sent), mock.patch.object(operations, 'Notification'):
+            operations.RemoteUpdateFile(OperationContext(local=self.local, node=self.node)).run()
+        assert osf_client.RemoteCache().get(('files', 'notes'), lambda: 'reloaded') == 'reloaded'
+
+    def test_context_built_on_another_thread_loads_through_this_one(self):
+        with Session() as session:
+            context = OperationContext(db=session.query(File).get('notes'))
+            session.expire_all()
+
+        result = []
+
+        def read():
+            with Session() as session:
+                node = context.node
+                result.append((node in session, context.local, repr(context)))
+            close_session()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        assert result == [(True, self.local, '<OperationContext(node={}, local={}, db=notes, remote=None)>'.format(
+            self.node.id, self.local
+        ))]
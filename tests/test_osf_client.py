@@ -0,0 +1,443 @@
+import datetime
+import http.client
+import io
+import threading
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+from osfsync import settings
+from osfsync.client import osf as osf_client
+from osfsync.client.osf import AdaptiveLimiter
+from osfsync.client.osf import RemoteCache
+from osfsync.client.osf import ThrottledSession
+
+from tests.utils import fail_after
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """Answers every request after a short delay, recording how many were in flight at once"""
+
+    def __init__(self, statuses=(), *, upload_time=0):
+        super().__init__()
+        # Extra seconds taken by requests with a body
+        self.upload_time = upload_time
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.sent = 0
+        # Status code and headers of the first few responses; the rest are 200
+        self.statuses = list(statuses)
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02 + (self.upload_time if request.body is not None else 0))
+        with self.lock:
+            self.active -= 1
+            self.sent += 1
+            status, headers = self.statuses.pop(0) if self.statuses else (200, {})
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers.update(headers)
+        resp.request = request
+        resp.url = request.url
+        resp.raw = io.BytesIO(b'{}')
+        return resp
+
+    def close(self):
+        pass
+
+
+def _session(limit, statuses=(), **kwargs):
+    session = ThrottledSession(AdaptiveLimiter(initial=limit, maximum=limit))
+    adapter = FakeAdapter(statuses, **kwargs)
+    session.mount('https://', adapter)
+    return session, adapter
+
+
+class TestThrottledSession:
+
+    @fail_after(timeout=5)
+    def test_requests_in_flight_are_limited(self):
+        session, adapter = _session(3)
+        threads = [threading.Thread(target=session.get, args=('https://api.example/',)) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert adapter.peak == 3
+
+    @fail_after(timeout=5)
+    def test_streamed_response_holds_slot_until_closed(self):
+        session, _ = _session(1)
+        resp = session.get('https://files.example/', stream=True)
+        assert session.limiter.in_flight == 1
+        resp.close()
+        resp.close()
+        assert session.limiter.in_flight == 0
+
+    def test_failed_request_releases_slot(self):
+        session = ThrottledSession(AdaptiveLimiter(initial=1, maximum=1))
+        for _ in range(2):
+            try:
+                session.get('unsupported://nowhere')
+            except requests.exceptions.InvalidSchema:
+                pass
+        assert session.limiter.in_flight == 0
+
+
+class TestAdaptiveLimiter:
+
+    def test_window_grows_while_healthy(self):
+        limiter = AdaptiveLimiter(initial=2, maximum=4)
+        for _ in range(20):
+            limiter.record(latency=0.1, status=200)
+        assert limiter.window == 4
+        assert limiter.decisions['increase'] == 2
+
+    def test_window_halves_on_push_back(self):
+        limiter = AdaptiveLimiter(initial=8, maximum=8)
+        limiter.record(latency=0.1, status=429)
+        assert limiter.window == 4
+        # A burst of errors only counts once
+        limiter.record(error=True)
+        assert limiter.window == 4
+        assert limiter.decisions['decrease'] == 1
+
+    def test_slow_responses_count_as_push_back(self):
+        limiter = AdaptiveLimiter(initial=8, maximum=8)
+        limiter.record(latency=0.1, status=200)
+        limiter.record(latency=0.1 * settings.HTTP_LATENCY_FACTOR * 2, status=200)
+        assert limiter.window == 4
+
+    def test_window_never_drops_below_minimum(self):
+        limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=8)
+        with mock.patch.object(settings, 'HTTP_DECREASE_INTERVAL', 0):
+            for _ in range(5):
+                limiter.record(status=503)
+        assert limiter.window == 1
+
+    @fail_after(timeout=5)
+    def test_throttled_request_is_retried_after_wait(self):
+        session, adapter = _session(4, statuses=[(429, {'Retry-After': '0.2'})])
+        started = time.monotonic()
+        resp = session.get('https://api.example/')
+        assert resp.status_code == 200
+        assert adapter.sent == 2
+        assert time.monotonic() - started >= 0.2
+        assert session.limiter.decisions['pause'] == 1
+        assert session.limiter.decisions['decrease'] == 1
+
+    @fail_after(timeout=5)
+    def test_large_uploads_do_not_shrink_window(self):
+        session, adapter = _session(8, upload_time=0.2)
+        with mock.patch.object(settings, 'HTTP_DECREASE_INTERVAL', 0):
+            for _ in range(3):
+                session.get('https://api.example/')
+            for _ in range(3):
+                resp = session.put('https://files.example/', data=io.BytesIO(b'data' * 1000))
+                assert resp.elapsed.total_seconds() > 0.2
+        assert session.limiter.window == 8
+        assert session.limiter.decisions['decrease'] == 0
+
+    def test_streamed_upload_is_not_retried(self):
+        session, adapter = _session(4, statuses=[(429, {'Retry-After': '0'})])
+        resp = session.put('https://files.example/', data=io.BytesIO(b'data'))
+        assert resp.status_code == 429
+        assert adapter.sent == 1
+
+
+class FakeListing:
+    """A listing of `total` files served `per_page` at a time, slowly enough for requests to overlap"""
+
+    URL = 'https://api.example/v2/nodes/node/files/osfstorage/'
+
+    def __init__(self, total, per_page, *, counted=True):
+        self.total = total
+        self.per_page = per_page
+        self.counted = counted
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.requested = []
+
+    def get(self, url, *, params=None, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        page = (params or {}).get('page', 1)
+        if '?page=' in url:
+            url, page = url.split('?page=')
+            page = int(page)
+        with self.lock:
+            self.active -= 1
+            self.requested.append(page)
+
+        start = (page - 1) * self.per_page
+        data = {
+            'data': [self._file(i) for i in range(start, min(start + self.per_page, self.total))],
+            'links': {'next': '{}?page={}'.format(self.URL, page + 1) if start + self.per_page < self.total else None},
+        }
+        if self.counted:
+            data['links']['meta'] = {'total': self.total, 'per_page': self.per_page}
+        resp = mock.Mock(status_code=200, headers={})
+        resp.json.return_value = data
+        return resp
+
+    def _file(self, i):
+        return {'id': str(i), 'type': 'files', 'attributes': {'name': '{}.txt'.format(i), 'kind': 'file'}}
+
+    def folder(self):
+        return osf_client.Folder(self, {
+            'id': 'folder',
+            'type': 'files',
+            'attributes': {'name': 'osfstorage', 'kind': 'folder'},
+            'relationships': {'files': {'links': {'related': {'href': self.URL}}}},
+        })
+
+
+class TestPagination:
+
+    @fail_after(timeout=5)
+    def test_pages_are_fetched_concurrently_in_order(self):
+        listing = FakeListing(total=95, per_page=10)
+        with mock.patch.object(settings, 'PAGE_PREFETCH_WORKERS', 3):
+            children = listing.folder().get_children()
+        assert [child.name for child in children] == ['{}.txt'.format(i) for i in range(95)]
+        assert sorted(listing.requested) == list(range(1, 11))
+        assert listing.peak == 3
+
+    @fail_after(timeout=5)
+    def test_prefetch_stops_when_listing_is_abandoned(self):
+        listing = FakeListing(total=1000, per_page=10)
+        with mock.patch.object(settings, 'PAGE_PREFETCH_WORKERS', 2):
+            items = listing.folder().fetch_related('files')
+            assert next(items)['id'] == '0'
+            items.close()
+        # The first page, and no more than the lookahead beyond it
+        assert len(listing.requested) <= 1 + 2 * 2
+
+    @fail_after(timeout=5)
+    def test_next_links_are_followed_without_a_count(self):
+        listing = FakeListing(total=25, per_page=10, counted=False)
+        children = listing.folder().get_children()
+        assert [child.name for child in children] == ['{}.txt'.format(i) for i in range(25)]
+        assert listing.requested == [1, 2, 3]
+        assert listing.peak == 1
+
+
+class TestRemoteCache:
+
+    def setup_method(self, method):
+        type(RemoteCache)._instances.pop(RemoteCache, None)
+
+    def teardown_method(self, method):
+        type(RemoteCache)._instances.pop(RemoteCache, None)
+
+    @fail_after(timeout=5)
+    def test_concurrent_loads_are_made_once(self):
+        release = threading.Event()
+        loads = []
+
+        def load():
+            loads.append(1)
+            release.wait()
+            return 'remote object'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(RemoteCache().get(('files', 'id'), load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while RemoteCache()._flights.shared < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert loads == [1]
+        assert results == ['remote object'] * 5
+        # Loaded once, then served from the cache
+        assert RemoteCache().get(('files', 'id'), None) == 'remote object'
+        assert RemoteCache().hits == 1
+
+    def test_expired_objects_are_loaded_again(self):
+        RemoteCache().put(('files', 'id'), 'old')
+        with mock.patch.object(settings, 'REMOTE_CACHE_TTL', -1):
+            RemoteCache().put(('files', 'expired'), 'old')
+        assert RemoteCache().get(('files', 'id'), lambda: 'new') == 'old'
+        assert RemoteCache().get(('files', 'expired'), lambda: 'new') == 'new'
+        RemoteCache().invalidate(('files', 'id'))
+        assert RemoteCache().get(('files', 'id'), lambda: 'new') == 'new'
+
+    def test_expired_objects_are_dropped(self):
+        with mock.patch.object(settings, 'REMOTE_CACHE_TTL', -1):
+            RemoteCache().put(('files', 'a'), 'old')
+            RemoteCache().put(('files', 'b'), 'old')
+        assert list(RemoteCache()._objects) == []
+        RemoteCache().put(('files', 'c'), 'new')
+        with mock.patch.object(time, 'monotonic', return_value=time.monotonic() + settings.REMOTE_CACHE_TTL + 1):
+            assert RemoteCache().get(('files', 'd'), lambda: 'loaded') == 'loaded'
+        assert list(RemoteCache()._objects) == [('files', 'd')]
+
+    def test_size_is_bounded(self):
+        with mock.patch.object(settings, 'REMOTE_CACHE_SIZE', 2):
+            for name in ('a', 'b', 'c'):
+                RemoteCache().put(('files', name), name)
+            # Put again, so it is now the newest
+            RemoteCache().put(('files', 'b'), 'b')
+            RemoteCache().put(('files', 'd'), 'd')
+        assert list(RemoteCache()._objects) == [('files', 'b'), ('files', 'd')]
+
+    def test_failed_loads_are_not_cached(self):
+        def fail():
+            raise osf_client.ClientLoadError(status=500)
+        with pytest.raises(osf_client.ClientLoadError):
+            RemoteCache().get(('nodes', 'id'), fail)
+        assert RemoteCache().get(('nodes', 'id'), lambda: 'node') == 'node'
+
+    @fail_after(timeout=5)
+    def test_identical_page_requests_are_sent_once(self):
+        listing = FakeListing(total=5, per_page=10)
+        threads = [threading.Thread(target=osf_client.StorageObject.load, args=(listing, 'folder')) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(listing.requested) < 4
+
+
+class TestResources:
+
+    DATA = {
+        'id': 'abc12',
+        'type': 'files',
+        'attributes': {
+            'name': 'data.csv',
+            'kind': 'file',
+            'provider': 'osfstorage',
+            'path': '/abc12',
+            'size': 1024,
+            'date_modified': '2016-01-05T17:32:09.000Z',
+            'last_touched': None,
+            'tags': ['lots', 'of', 'tags'],
+            'extra': {'hashes': {'sha256': 'sha', 'md5': 'md5'}, 'downloads': 3},
+        },
+        'links': {'download': 'https://files.example/abc12'},
+        'relationships': {'versions': {'links': {'related': {'href': 'https://api.example/versions/'}}}},
+    }
+
+    def test_attributes_are_read_lazily(self):
+        remote = osf_client.File(None, self.DATA, parent=None)
+        assert not hasattr(remote, '__dict__')
+        assert remote._dates is None
+        assert remote.name == 'data.csv'
+        assert remote.date_modified == datetime.datetime(2016, 1, 5, 17, 32, 9, tzinfo=datetime.timezone.utc)
+        assert remote.date_modified is remote.date_modified
+        assert remote.last_touched is None
+        assert not hasattr(remote, 'date_created')
+        remote.id = 'moved'
+        assert remote.id == 'moved'
+
+    def test_compact_keeps_what_the_audit_needs(self):
+        remote = osf_client.File(None, osf_client.StorageObject.compact(self.DATA))
+        assert (remote.id, remote.name, remote.kind, remote.size) == ('abc12', 'data.csv', 'file', 1024)
+        assert remote.extra == {'hashes': {'sha256': 'sha', 'md5': 'md5'}}
+        assert remote.raw['links'] == self.DATA['links']
+        assert remote.date_modified.year == 2016
+        assert not hasattr(remote, 'tags')
+        assert remote.raw['relationships'] == {}
+
+    @fail_after(timeout=5)
+    def test_compact_folders_can_be_listed(self):
+        listing = FakeListing(total=3, per_page=10)
+        folder = osf_client.Folder(listing, osf_client.StorageObject.compact(listing.folder().raw))
+        children = folder.get_children(compact=True)
+        assert [child.name for child in children] == ['0.txt', '1.txt', '2.txt']
+        assert all(child.parent is folder for child in children)
+
+
+class FakeTree:
+    """
+    Serves folder listings with ETags, answering 304 when the listing has not changed. A folder's entry in its
+    parent's listing does not change when the folder's own contents do, as on the OSF.
+    """
+
+    BASE = 'https://api.example/v2/files/'
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.requests = []
+
+    def _item(self, path, name):
+        kind = 'folder' if isinstance(self.tree.get(path + '/' + name if path else name), list) else 'file'
+        item = {'id': (path + '/' + name) if path else name, 'type': 'files', 'attributes': {
+            'name': name,
+            'kind': kind,
+            'date_modified': '2016-01-05T17:32:09.000Z',
+        }}
+        if kind == 'folder':
+            item['relationships'] = {'files': {'links': {'related': {'href': self.BASE + item['id']}}}}
+        return item
+
+    def get(self, url, *, params=None, headers=None, **kwargs):
+        path = url[len(self.BASE):]
+        data = {'data': [self._item(path, name) for name in self.tree[path]], 'links': {}}
+        etag = '"{}"'.format(hash(tuple(self.tree[path])))
+        not_modified = (headers or {}).get('If-None-Match') == etag
+        self.requests.append((path, not_modified))
+        resp = mock.Mock(status_code=http.client.NOT_MODIFIED if not_modified else http.client.OK, headers={'ETag': etag})
+        resp.json.return_value = data
+        return resp
+
+    def folder(self, path):
+        item = self._item(*path.rpartition('/')[::2]) if '/' in path else self._item('', path)
+        return osf_client.Folder(self, item)
+
+
+class TestListingCache:
+
+    def setup_method(self, method):
+        type(osf_client.ListingCache)._instances.pop(osf_client.ListingCache, None)
+        self.tree = FakeTree({'root': ['sub', 'a.txt'], 'root/sub': ['b.txt']})
+
+    def teardown_method(self, method):
+        type(osf_client.ListingCache)._instances.pop(osf_client.ListingCache, None)
+
+    def _names(self, folder):
+        return [child.name for child in folder.get_children(reuse=True)]
+
+    def test_unmodified_listing_reuses_children(self):
+        first = self.tree.folder('root').get_children(reuse=True)
+        second = self.tree.folder('root').get_children(reuse=True)
+        assert second is first
+        assert self.tree.requests == [('root', False), ('root', True)]
+
+    def test_modified_listing_is_refreshed(self):
+        self._names(self.tree.folder('root'))
+        self.tree.tree['root'].append('c.txt')
+        assert self._names(self.tree.folder('root')) == ['sub', 'a.txt', 'c.txt']
+        assert self.tree.requests[-1] == ('root', False)
+
+    def test_change_in_nested_folder_is_found(self):
+        sub, _ = self.tree.folder('root').get_children(reuse=True)
+        assert self._names(sub) == ['b.txt']
+
+        self.tree.tree['root/sub'].append('new.txt')
+        sub, _ = self.tree.folder('root').get_children(reuse=True)
+        assert self.tree.requests[-1] == ('root', True)
+        assert self._names(sub) == ['b.txt', 'new.txt']
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(settings, 'LISTING_CACHE_SIZE', 1):
+            self._names(self.tree.folder('root'))
+            self._names(self.tree.folder('root/sub'))
+            assert osf_client.ListingCache().children('root') is None
+            assert osf_client.ListingCache().validators(FakeTree.BASE + 'root', {'page[size]': 250}) == {}
+            # The page evicted is requested again in full
+            self._names(self.tree.folder('root'))
+        assert self.tree.requests[-1] == ('root', False)
@@ -0,0 +1,301 @@
+import os
+from pathlib import Path
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from osfsync import settings
+from osfsync.database import models
+from osfsync.database import Session
+from osfsync.database import WriteBatch
+from osfsync.tasks import journal
+from osfsync.tasks import operations
+from osfsync.tasks.operations import OperationContext
+from osfsync.tasks.queue import OperationWorker
+
+from tests.base import OSFOTestBase
+from tests.utils import fail_after
+
+
+class FakeOperation:
+
+    def __init__(self, local, log, *, dest=None, wait=None):
+        self._context = OperationContext(local=local)
+        if dest:
+            self._dest_context = OperationContext(local=dest)
+        self.log = log
+        self.wait = wait
+
+    @property
+    def local(self):
+        return self._context.local
+
+    def run(self, *, dry=False):
+        self.log.append(('start', self.local))
+        if self.wait:
+            self.wait()
+        self.log.append(('end', self.local))
+
+
+class TestOperationWorker(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_worker(self, request):
+        with mock.patch.object(settings, 'OPERATION_WORKERS', 3):
+            self.worker = OperationWorker()
+        self.worker.start()
+        self.log = []
+
+        def stop():
+            self.worker.stop()
+            type(OperationWorker)._instances.pop(OperationWorker, None)
+        request.addfinalizer(stop)
+
+    def _path(self, *parts):
+        return os.path.join(str(self.root_dir), *parts)
+
+    @fail_after(timeout=5)
+    def test_unrelated_operations_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=3)
+        self.worker.put(FakeOperation(self._path('a', 'big.iso'), self.log, wait=barrier.wait))
+        self.worker.put(FakeOperation(self._path('b', 'small.txt'), self.log, wait=barrier.wait))
+        self.worker.join_queue()
+        assert [event for event, _ in self.log] == ['start', 'start', 'end', 'end']
+
+    @fail_after(timeout=5)
+    def test_children_wait_for_their_folder(self):
+        self.worker.put(FakeOperation(self._path('a'), self.log, wait=lambda: time.sleep(0.2)))
+        self.worker.put(FakeOperation(self._path('a', 'child.txt'), self.log))
+        self.worker.put(FakeOperation(self._path('ab.txt'), self.log))
+        self.worker.join_queue()
+
+        order = [(event, str(local)) for event, local in self.log]
+        assert order.index(('end', self._path('a'))) < order.index(('start', self._path('a', 'child.txt')))
+        # A sibling whose name merely starts the same way is not held up
+        assert order.index(('end', self._path('ab.txt'))) < order.index(('end', self._path('a')))
+
+    @fail_after(timeout=5)
+    def test_move_excludes_destination(self):
+        self.worker.put(FakeOperation(self._path('a'), self.log, dest=self._path('b'), wait=lambda: time.sleep(0.2)))
+        self.worker.put(FakeOperation(self._path('b', 'new.txt'), self.log))
+        self.worker.join_queue()
+        assert [str(local) for event, local in self.log] == [self._path('a'), self._path('a'), self._path('b', 'new.txt'), self._path('b', 'new.txt')]
+
+    @fail_after(timeout=5)
+    def test_join_queue_waits_for_everything(self):
+        for i in range(20):
+            self.worker.put(FakeOperation(self._path(str(i)), self.log, wait=lambda: time.sleep(0.01)))
+        self.worker.join_queue()
+        assert len(self.log) == 40
+
+
+class TestFailures(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_worker(self, request):
+        with mock.patch.object(settings, 'OPERATION_WORKERS', 1):
+            self.worker = OperationWorker()
+        request.addfinalizer(lambda: type(OperationWorker)._instances.pop(OperationWorker, None))
+
+    def _create_folder(self, id):
+        remote = mock.Mock(id=id, kind='folder', provider='osfstorage')
+        # Both are arguments of Mock itself
+        remote.name, remote.parent = id, None
+        with Session() as session:
+            node = session.query(models.Node).first()
+        return operations.DatabaseCreateFolder(OperationContext(remote=remote, node=node))
+
+    @fail_after(timeout=10)
+    def test_failed_flush_does_not_stop_the_worker(self):
+        self._create_folder('existing').run()
+        self.worker.start()
+        try:
+            with mock.patch('osfsync.tasks.queue.Notification'):
+                # The second one fails to flush, as the id is taken
+                self.worker.put_all([self._create_folder(id) for id in ('before', 'existing', 'after')])
+                self.worker.join_queue()
+                self.worker.put(self._create_folder('later'))
+                self.worker.join_queue()
+        finally:
+            self.worker.stop()
+        with Session() as session:
+            ids = {file.id for file in session.query(models.File)}
+        assert {'existing', 'after', 'later'} <= ids
+        assert not self.worker._active
+
+
+class TestCoalescing(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_worker(self, request):
+        # Never started, so nothing queued actually runs
+        self.worker = OperationWorker()
+        request.addfinalizer(lambda: type(OperationWorker)._instances.pop(OperationWorker, None))
+
+    def _context(self, *parts):
+        return OperationContext(local=Path(os.path.join(str(self.root_dir), *parts)))
+
+    def _queued(self):
+        return [type(job.operation).__name__ for job in self.worker._pending]
+
+    def test_updates_are_merged(self):
+        for _ in range(5):
+            self.worker.put(operations.RemoteUpdateFile(self._context('notes.txt')))
+        assert self._queued() == ['RemoteUpdateFile']
+        assert self.worker.coalesced['merged'] == 4
+
+    def test_create_absorbs_updates(self):
+        self.worker.put(operations.RemoteCreateFile(self._context('notes.txt')))
+        self.worker.put(operations.RemoteUpdateFile(self._context('notes.txt')))
+        assert self._queued() == ['RemoteCreateFile']
+
+    def test_create_then_delete_cancels(self):
+        self.worker.put(operations.RemoteCreateFile(self._context('notes.txt')))
+        self.worker.put(operations.RemoteUpdateFile(self._context('notes.txt')))
+        self.worker.put(operations.RemoteDelete(self._context('notes.txt')))
+        assert self._queued() == []
+        assert self.worker.coalesced == {'merged': 1, 'cancelled': 2}
+        self.worker.join_queue()
+
+    def test_move_chain_is_collapsed(self):
+        self.worker.put(operations.RemoteMoveFile(self._context('a.txt'), self._context('b.txt')))
+        self.worker.put(operations.RemoteMoveFile(self._context('b.txt'), self._context('c.txt')))
+        assert self._queued() == ['RemoteMoveFile']
+        move = self.worker._pending[0].operation
+        assert (move.local.name, move._dest_context.local.name) == ('a.txt', 'c.txt')
+
+        self.worker.put(operations.RemoteMoveFile(self._context('c.txt'), self._context('a.txt')))
+        assert self._queued() == []
+
+    def test_nothing_merges_across_related_operations(self):
+        self.worker.put(operations.RemoteUpdateFile(self._context('data', 'notes.txt')))
+        self.worker.put(operations.RemoteDelete(self._context('data')))
+        self.worker.put(operations.RemoteUpdateFile(self._context('data', 'notes.txt')))
+        assert self._queued() == ['RemoteUpdateFile', 'RemoteDelete', 'RemoteUpdateFile']
+        assert not self.worker.coalesced
+
+
+class TestJournal(OSFOTestBase):
+
+    @pytest.fixture(scope='function', autouse=True)
+    def z_worker(self, request):
+        self.worker = OperationWorker()
+        request.addfinalizer(lambda: type(OperationWorker)._instances.pop(OperationWorker, None))
+
+    def _context(self, *parts):
+        return OperationContext(local=Path(os.path.join(str(self.root_dir), *parts)))
+
+    def _keys(self):
+        with Session() as session:
+            return [entry.key for entry in session.query(models.JournalEntry).order_by(models.JournalEntry.id)]
+
+    def test_dump_and_load(self):
+        move = operations.LocalMove(self._context('a.txt'), self._context('b.txt'))
+        key, description = journal.dump(move)
+        with Session() as session:
+            loaded = journal.load(session, description)
+        assert type(loaded) is operations.LocalMove
+        assert (loaded.local, loaded._dest_context.local) == (move.local, move._dest_context.local)
+        assert journal.dump(loaded) == (key, description)
+
+    def test_queued_operations_are_journaled(self):
+        self.worker.put(operations.RemoteCreateFile(self._context('a.txt')))
+        self.worker.put(operations.RemoteCreateFile(self._context('b.txt')))
+        assert self._keys() == [job.key for job in self.worker._pending]
+
+    def test_coalesced_operations_leave_the_journal(self):
+        self.worker.put(operations.RemoteCreateFile(self._context('a.txt')))
+        self.worker.put(operations.RemoteDelete(self._context('a.txt')))
+        assert self._keys() == []
+
+    def test_resume_skips_queued_duplicates(self):
+        self.worker.put(operations.RemoteCreateFile(self._context('a.txt')))
+        assert self.worker.resume() == 1
+        assert len(self.worker._pending) == 1
+        assert len(self._keys()) == 1
+
+    def test_unloadable_entries_are_dropped(self):
+        _, description = journal.dump(operations.RemoteCreateFile(self._context('a.txt')))
+        journal.record([('broken', description.replace('RemoteCreateFile', 'NoSuchOperation'))])
+        assert list(journal.pending()) == []
+        assert self._keys() == []
+
+    @fail_after(timeout=5)
+    def test_finished_operations_are_forgotten(self):
+        self.worker.start()
+        try:
+            self.worker.put(FakeOperation(os.path.join(str(self.root_dir), 'a.txt'), []))
+            self.worker.join_queue()
+        finally:
+            self.worker.stop()
+        assert self._keys() == []
+
+    def test_repeated_operation_keeps_its_entry_until_the_last_one_commits(self):
+        log = []
+        for parts in (('x',), ('x', 'child'), ('x',)):
+            self.worker.put(FakeOperation(os.path.join(str(self.root_dir), *parts), log))
+        assert len(self.worker._pending) == 3
+        first_key = self.worker._pending[0].key
+
+        with WriteBatch() as batch:
+            for expected in (['x'], ['x', 'child'], ['x']):
+                job = self.worker._take(block=False)
+                assert job.paths == [os.path.join(str(self.root_dir), *expected)]
+                job.operation.run()
+                self.worker._commit(batch, [job])
+                if expected == ['x']:
+                    # Either the repeated operation or the last one is still to commit
+                    assert (first_key in self._keys()) == bool(self.worker._pending)
+        assert self._keys() == []
+
+    def test_entry_revived_for_a_job_that_commits_meanwhile_is_forgotten(self):
+        log = []
+        path = os.path.join(str(self.root_dir), 'x')
+        self.worker.put(FakeOperation(path, log))
+        first = self.worker._take(block=False)
+        forget, record = journal.forget, journal.record
+        steps = ['put', 'commit']
+
+        def forget_then_queue_again(session, keys):
+            if steps[:1] == ['put']:
+                # Queued again while the first job is leaving the journal
+                self.worker.put(FakeOperation(path, log))
+                steps.pop(0)
+            return forget(session, keys)
+
+        def record_after_commit(entries):
+            if steps == ['commit'] and entries:
+                # ...and committed before its entry is journaled again
+                steps.pop(0)
+                again = self.worker._take(block=False)
+                self.worker._commit(batch, [again])
+            return record(entries)
+
+        with WriteBatch() as batch, \
+                mock.patch.object(journal, 'forget', forget_then_queue_again), \
+                mock.patch.object(journal, 'record', record_after_commit):
+            self.worker._commit(batch, [first])
+        assert not self.worker._pending and not self.worker._active
+        assert self._keys() == []
+
+    @fail_after(timeout=5)
+    def test_repeated_operation_around_a_conflict_runs(self):
+        log = []
+        self.worker.start()
+        try:
+            for parts in (('x',), ('x', 'child'), ('x',)):
+                self.worker.put(FakeOperation(os.path.join(str(self.root_dir), *parts), log))
+            self.worker.join_queue()
+        finally:
+            self.worker.stop()
+        assert [entry for entry in log if entry[0] == 'end'] == [
+            ('end', os.path.join(str(self.root_dir), *parts)) for parts in (('x',), ('x', 'child'), ('x',))
+        ]
+        assert self._keys() == []
+
+    def test_operations_are_journaled_together(self):
+        self.worker.put_all([operations.RemoteCreateFile(self._context(name)) for name in ('a.txt', 'b.txt', 'c.txt')])
+        assert self._keys() == [job.key for job in self.worker._pending]
+        assert len(self._keys()) == 3
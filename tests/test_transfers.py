@@ -0,0 +1,243 @@
+from concurrent.futures import Future
+import datetime
+import hashlib
+import http.client
+import os
+import threading
+from unittest import mock
+
+import pytest
+import requests
+
+from osfsync import settings
+from osfsync.tasks import transfers
+from osfsync.tasks.transfers import download
+from osfsync.tasks.transfers import temp_path
+from osfsync.tasks.transfers import TransferError
+from osfsync.tasks.transfers import upload
+from osfsync.tasks.transfers import verify_upload
+from osfsync.utils import is_ignored
+from osfsync.utils.hashing import HashCache
+
+
+CONTENT = bytes(range(256)) * 64
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body, *, fail_at=None):
+        self.status_code = status_code
+        self.headers = {}
+        self._body = body
+        self._fail_at = fail_at
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self._body), 1000):
+            if self._fail_at is not None and i >= self._fail_at:
+                raise requests.exceptions.ChunkedEncodingError('Connection reset')
+            yield self._body[i:i + 1000]
+
+    def close(self):
+        pass
+
+
+class FakeServer:
+    """Serves CONTENT, dropping the connection after fail_at bytes for the first `failures` requests"""
+
+    def __init__(self, *, failures=0, fail_at=None, ranges=True):
+        self.failures = failures
+        self.fail_at = fail_at
+        self.ranges = ranges
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, *, headers=None, data=None, **kwargs):
+        if method == 'PUT':
+            self.received = data.read()
+            return FakeResponse(http.client.CREATED, b'')
+        headers = headers or {}
+        fail_at = None
+        with self._lock:
+            self.requests.append(headers.get('Range'))
+            if self.failures:
+                self.failures -= 1
+                fail_at = self.fail_at
+        if 'Range' in headers and self.ranges:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            start, end = int(start), int(end or len(CONTENT) - 1)
+            if start > len(CONTENT):
+                return FakeResponse(http.client.REQUESTED_RANGE_NOT_SATISFIABLE, b'')
+            return FakeResponse(http.client.PARTIAL_CONTENT, CONTENT[start:end + 1], fail_at=fail_at)
+        return FakeResponse(http.client.OK, CONTENT, fail_at=fail_at)
+
+
+@pytest.fixture
+def server():
+    server = FakeServer()
+    with mock.patch.object(transfers, 'OSFClient', return_value=server):
+        yield server
+
+
+def _download(path, **kwargs):
+    kwargs.setdefault('size', len(CONTENT))
+    kwargs.setdefault('sha256', SHA256)
+    return download('https://files.example/download', str(path), **kwargs)
+
+
+def test_download(server, tmpdir):
+    path = tmpdir.join('data.bin')
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests == [None]
+    assert tmpdir.listdir() == [path]
+
+
+def test_dropped_connection_is_resumed(server, tmpdir):
+    server.failures, server.fail_at = 2, 5000
+    path = tmpdir.join('data.bin')
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests == [None, 'bytes=5000-', 'bytes=10000-']
+
+
+def test_partial_download_survives_failure(server, tmpdir):
+    server.failures, server.fail_at = settings.DOWNLOAD_RETRIES + 1, 1000
+    path = tmpdir.join('data.bin')
+    path.write_binary(b'old version')
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        _download(path)
+    # The file in place is untouched, and the next attempt carries on where this one stopped
+    assert path.read_binary() == b'old version'
+    assert os.path.getsize(temp_path(str(path))) == 1000 * (settings.DOWNLOAD_RETRIES + 1)
+
+    server.requests.clear()
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests == ['bytes={}-'.format(1000 * (settings.DOWNLOAD_RETRIES + 1))]
+
+
+def test_partial_download_of_other_version_is_discarded(server, tmpdir):
+    path = tmpdir.join('data.bin')
+    server.failures, server.fail_at = settings.DOWNLOAD_RETRIES + 1, 1000
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        _download(path, sha256='an older version')
+
+    server.requests.clear()
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests == [None]
+
+
+def test_server_ignoring_range_starts_over(server, tmpdir):
+    server.failures, server.fail_at, server.ranges = 1, 3000, False
+    path = tmpdir.join('data.bin')
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests == [None, 'bytes=3000-']
+
+
+def test_temp_files_are_ignored(tmpdir):
+    tmp = temp_path(str(tmpdir.join('data.bin')))
+    assert is_ignored(tmp)
+    assert is_ignored(tmp + '.meta')
+    assert not is_ignored(str(tmpdir.join('data.bin')))
+
+
+def test_corrupt_download_is_rejected(server, tmpdir):
+    path = tmpdir.join('data.bin')
+    with pytest.raises(TransferError):
+        _download(path, sha256='not the hash')
+    assert tmpdir.listdir() == []
+
+
+def test_download_seeds_hash_cache(server, tmpdir):
+    path = tmpdir.join('data.bin')
+    modified = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+    assert _download(path, mtime=modified) == SHA256
+    assert os.path.getmtime(str(path)) == pytest.approx(modified.timestamp())
+    assert HashCache().lookup(os.stat(str(path))) == SHA256
+
+
+def test_upload_is_hashed_and_verified(server, tmpdir):
+    path = tmpdir.join('data.bin')
+    path.write_binary(CONTENT)
+    stamp = datetime.datetime.now().timestamp() - 60
+    os.utime(str(path), (stamp, stamp))
+
+    sent = upload('https://files.example/upload', str(path))
+    assert server.received == CONTENT
+    assert sent.sha256 == SHA256
+    assert not verify_upload(str(path), sent, 'what the server got instead')
+    assert HashCache().lookup(os.stat(str(path))) is None
+    assert verify_upload(str(path), sent, SHA256)
+    assert HashCache().lookup(os.stat(str(path))) == SHA256
+
+
+@pytest.fixture
+def segmented():
+    with mock.patch.object(settings, 'SEGMENTED_DOWNLOAD_MIN_SIZE', 1), mock.patch.object(settings, 'DOWNLOAD_SEGMENTS', 4):
+        yield
+
+
+def test_segmented_download(server, segmented, tmpdir):
+    path = tmpdir.join('data.bin')
+    assert _download(path) == SHA256
+    assert path.read_binary() == CONTENT
+    assert set(server.requests) == {'bytes=0-4095', 'bytes=4096-8191', 'bytes=8192-12287', 'bytes=12288-16383'}
+    assert tmpdir.listdir() == [path]
+
+
+def test_segment_is_resumed(server, segmented, tmpdir):
+    server.failures, server.fail_at = 1, 2000
+    path = tmpdir.join('data.bin')
+    _download(path)
+    assert path.read_binary() == CONTENT
+    segments = {'bytes=0-4095', 'bytes=4096-8191', 'bytes=8192-12287', 'bytes=12288-16383'}
+    resumed, = set(server.requests) - segments
+    # Whichever segment failed picks up where its connection dropped
+    assert int(resumed[len('bytes='):].split('-')[0]) % 4096 == 2000
+
+
+def test_completed_segments_survive_failure(server, segmented, tmpdir):
+    path = tmpdir.join('data.bin')
+    server.failures, server.fail_at = settings.DOWNLOAD_RETRIES + 1, 0
+    with mock.patch.object(transfers, 'ThreadPoolExecutor', lambda max_workers: _Serial()):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            _download(path)
+
+    server.requests.clear()
+    _download(path)
+    assert path.read_binary() == CONTENT
+    # Only the segment that failed is fetched again
+    assert server.requests == ['bytes=0-4095']
+
+
+def test_segmented_falls_back_without_ranges(server, segmented, tmpdir):
+    server.ranges = False
+    path = tmpdir.join('data.bin')
+    _download(path)
+    assert path.read_binary() == CONTENT
+    assert server.requests[-1] is None
+
+
+class _Serial:
+    """Stands in for a ThreadPoolExecutor, running everything on the calling thread in submission order"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -0,0 +1,55 @@
+import os
+
+from osfsync.utils import walk_local
+
+
+def _walk(tmpdir):
+    base = str(tmpdir) + os.path.sep
+    return {entry.rel_path: entry for entry in walk_local(str(tmpdir), base=base)}
+
+
+def test_walk_local(tmpdir):
+    tmpdir.ensure('data', 'truth.csv')
+    tmpdir.ensure('data', 'raw', 'lies.csv')
+    tmpdir.ensure('README.md')
+    entries = _walk(tmpdir)
+
+    assert set(entries) == {
+        'README.md',
+        'data' + os.path.sep,
+        os.path.join('data', 'truth.csv'),
+        os.path.join('data', 'raw') + os.path.sep,
+        os.path.join('data', 'raw', 'lies.csv'),
+    }
+    assert entries['data' + os.path.sep].is_dir is True
+    assert entries['data' + os.path.sep].stat is None
+    assert entries['README.md'].is_dir is False
+    assert entries['README.md'].stat.st_size == 0
+
+
+def test_walk_local_skips_ignored(tmpdir):
+    tmpdir.ensure('.DS_Store')
+    tmpdir.ensure('scratch.tmp', 'orphan.txt')
+    tmpdir.ensure('notes.txt')
+    assert set(_walk(tmpdir)) == {'notes.txt'}
+
+
+def test_walk_local_nested(tmpdir):
+    depth = 50
+    path = tmpdir
+    for i in range(depth):
+        path = path.mkdir('d')
+    path.ensure('leaf.txt')
+    assert len(_walk(tmpdir)) == depth + 1
+
+
+def test_walk_local_skips_removed_folders(tmpdir):
+    tmpdir.ensure('gone', 'lost.txt')
+    tmpdir.ensure('kept', 'found.txt')
+    found = []
+    for entry in walk_local(str(tmpdir), base=str(tmpdir) + os.path.sep):
+        found.append(entry.rel_path)
+        if entry.rel_path == 'gone' + os.path.sep:
+            # Removed after being listed, before being descended into
+            tmpdir.join('gone').remove()
+    assert set(found) == {'gone' + os.path.sep, 'kept' + os.path.sep, os.path.join('kept', 'found.txt')}